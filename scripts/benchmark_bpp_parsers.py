@@ -0,0 +1,187 @@
+import os, argparse, time, tempfile
+import numpy as np
+from arnie.utils import bpp_matrix_from_pairs
+from arnie import bpps as B
+
+# Line-by-line parsers as they were before the NumPy/regex rewrite, for comparison.
+
+def legacy_vienna(fname, N):
+    probs = np.zeros([N, N])
+    with open(fname, 'r') as f:
+        for line in f.readlines():
+            if 'ubox' in line:
+                try:
+                    i, j, p, _ = line.split()
+                    i, j, p = int(i)-1, int(j)-1, float(p)**2
+                    probs[i,j] = p
+                    probs[j,i] = p
+                except:
+                    pass
+    return probs
+
+def legacy_contrafold(fname, N):
+    probs = np.zeros([N, N])
+    for line in open(fname).readlines():
+        if len(line.split(':')) > 1:
+            first_ind = int(line.split()[0])-1
+            for x in line.split()[2:]:
+                second_ind = int(x.split(':')[0])-1
+                p = float(x.split(':')[1])
+                probs[first_ind, second_ind] = p
+                probs[second_ind, first_ind] = p
+    return probs
+
+def legacy_rnasoft(fname, N):
+    probs = np.zeros([N, N])
+    for line in open(fname).readlines():
+        i,j,p = int(line.split()[0]), int(line.split()[1]), float(line.split()[2])
+        probs[i,j] = p
+        probs[j,i] = p
+    return probs
+
+def legacy_nupack(fname, N):
+    probs = np.zeros([N, N])
+    with open(fname, 'r') as f:
+        for line in f.readlines():
+            if not line.startswith('%'):
+                fields = line.split()
+                if len(fields) > 1:
+                    if int(fields[1]) <= N:
+                        i, j, p = int(fields[0])-1, int(fields[1])-1, float(fields[2])
+                        probs[i,j] = p
+                        probs[j,i] = p
+    return probs
+
+def legacy_rnastructure(fname, N):
+    probs = np.zeros([N, N])
+    with open(fname, 'r') as f:
+        for line in f.readlines()[2:]:
+            fields = line.split()
+            i, j, p = int(fields[0])-1, int(fields[1])-1, 10**(-1*float(fields[2]))
+            probs[i,j] = p
+            probs[j,i] = p
+    return probs
+
+def legacy_vfold(fname, N):
+    probs = np.zeros([N, N])
+    p_ij_output = np.loadtxt(fname, usecols=(0,2,3))
+    for i,j,p in p_ij_output:
+        probs[int(i-1),int(j-1)] = p
+        probs[int(j-1),int(i-1)] = p
+    return probs
+
+def legacy_linearpartition(fname, N):
+    probs = np.zeros([N, N])
+    for line in open(fname,'r').readlines():
+        if len(line.strip())>0:
+            first_ind, second_ind, p = line.strip().split(' ')
+            first_ind = int(first_ind)-1
+            second_ind = int(second_ind)-1
+            p = float(p)
+            probs[first_ind, second_ind] = p
+            probs[second_ind, first_ind] = p
+    return probs
+
+
+# Synthetic output files in each package's format
+
+def random_pairs(N, density, rng):
+    i, j = np.triu_indices(N, k=4)
+    keep = rng.random(len(i)) < density
+    i, j = i[keep], j[keep]
+    p = 10**rng.uniform(-10, 0, len(i))
+    return i, j, p
+
+# a dot plot written by RNAfold, whose PostScript header and trailer are kept around the synthetic pairs
+DOT_PLOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'test_files', 'GGGGAAAACCCC_dp.ps')
+
+def write_vienna(f, N, i, j, p):
+    with open(DOT_PLOT) as template:
+        lines = template.read().splitlines(True)
+    data = [k for k, line in enumerate(lines) if line.rstrip().endswith('box') and line[0].isdigit()]
+    f.writelines(lines[:data[0]])
+    f.writelines('%d %d %1.9f ubox\n' % (a+1, b+1, np.sqrt(x)) for a, b, x in zip(i, j, p))
+    f.writelines(lines[data[-1]+1:])
+
+def write_contrafold(f, N, i, j, p):
+    rows = {}
+    for a, b, x in zip(i, j, p):
+        rows.setdefault(a, []).append('%d:%g' % (b+1, x))
+    for a in range(N):
+        f.write('%d A %s\n' % (a+1, ' '.join(rows.get(a, []))))
+
+def write_rnasoft(f, N, i, j, p):
+    f.writelines('%d %d %g\n' % (a, b, x) for a, b, x in zip(i, j, p))
+
+def write_nupack(f, N, i, j, p):
+    f.write('%% NUPACK 3.0\n%% Program: pairs\n%%\n%d\n' % N)
+    f.writelines('%d\t%d\t%.6e\n' % (a+1, b+1, x) for a, b, x in zip(i, j, p))
+    f.writelines('%d\t%d\t%.6e\n' % (a+1, N+1, 0.5) for a in range(N))
+
+def write_rnastructure(f, N, i, j, p):
+    f.write('%d\ni\tj\t-log10(Probability)\n' % N)
+    f.writelines('%d\t%d\t%g\n' % (a+1, b+1, -np.log10(x)) for a, b, x in zip(i, j, p))
+
+def write_vfold(f, N, i, j, p):
+    f.writelines('%d A %d %g\n' % (a+1, b+1, x) for a, b, x in zip(i, j, p))
+
+def write_linearpartition(f, N, i, j, p):
+    f.writelines('%d %d %.4e\n' % (a+1, b+1, x) for a, b, x in zip(i, j, p))
+    f.write('\n')
+
+
+# name, file writer, old parser(fname, N), new parser(fname, N) -> (i, j, p)
+FORMATS = [
+    ('Vienna dp.ps', write_vienna, legacy_vienna, lambda fname, N: B.parse_vienna_dot_plot_(fname)),
+    ('CONTRAfold posteriors', write_contrafold, legacy_contrafold, lambda fname, N: B.parse_contrafold_posteriors_(fname)),
+    ('RNAsoft', write_rnasoft, legacy_rnasoft, lambda fname, N: B.parse_pair_table_(fname)),
+    ('NUPACK ppairs', write_nupack, legacy_nupack, B.parse_nupack_ppairs_),
+    ('RNAstructure ProbabilityPlot', write_rnastructure, legacy_rnastructure, lambda fname, N: B.parse_probability_plot_(fname)),
+    ('Vfold pij', write_vfold, legacy_vfold, lambda fname, N: B.parse_vfold_pij_(fname)),
+    ('LinearPartition', write_linearpartition, legacy_linearpartition, lambda fname, N: B.parse_pair_table_(fname, one_indexed=True)),
+]
+
+
+def best_of(n, func):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__=='__main__':
+    p = argparse.ArgumentParser(description=
+        """
+        Time the bpp output parsers against the old line-by-line ones on synthetic files,
+        and check that both give the same matrix (to float rounding).
+        """)
+
+    p.add_argument("-N", "--length", type=int, default=1000, help="sequence length")
+    p.add_argument("-d", "--density", type=float, default=1.0,
+                   help="fraction of possible pairs present in the file (1e-10 cutoffs list nearly all of them)")
+    p.add_argument("-r", "--repeats", type=int, default=3, help="timing repeats, best is reported")
+    p.add_argument("--sparse", action='store_true', help="build sparse matrices with the new parsers")
+
+    args = p.parse_args()
+    N = args.length
+    rng = np.random.default_rng(0)
+    i, j, pr = random_pairs(N, args.density, rng)
+    print('N = %d, %d pairs per file\n' % (N, len(i)))
+    print('%-30s %10s %10s %10s %8s' % ('format', 'MB', 'old (s)', 'new (s)', 'speedup'))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, writer, legacy, parser in FORMATS:
+            fname = os.path.join(tmpdir, 'bpps.txt')
+            with open(fname, 'w') as f:
+                writer(f, N, i, j, pr)
+
+            t_old, old = best_of(args.repeats, lambda: legacy(fname, N))
+            t_new, new = best_of(args.repeats, lambda: bpp_matrix_from_pairs(*parser(fname, N), N, sparse=args.sparse))
+
+            if args.sparse:
+                new = new.toarray()
+            # Vienna squares sqrt(p) as x*x rather than pow(x, 2), which can differ in the last bit
+            assert np.allclose(old, new, rtol=1e-15, atol=0), name
+            print('%-30s %10.1f %10.3f %10.3f %7.1fx' % (name, os.path.getsize(fname)/1e6, t_old, t_new, t_old/t_new))
@@ -0,0 +1,66 @@
+import argparse, time
+import numpy as np
+from arnie.mea.mea import MEA
+
+
+def synthetic_bpps(N, rng):
+    '''random hairpins, plus low-probability noise, with rows summing to < 1'''
+    bpp = np.zeros((N, N))
+    i = 0
+    while i < N - 30:
+        length = rng.integers(4, 10)
+        j = min(i + 2*length + rng.integers(3, 12), N - 1)
+        p = rng.uniform(0.4, 0.9)
+        for k in range(length):
+            bpp[i+k, j-k] = p
+        i = j + rng.integers(1, 20)
+    a, b = np.triu_indices(N, k=4)
+    noise = rng.random(len(a)) < 5/N
+    bpp[a[noise], b[noise]] += 0.01*rng.random(noise.sum())
+    bpp = bpp + bpp.T
+    return bpp/max(1, bpp.sum(axis=0).max()/0.99)
+
+
+def random_sequence_bpps(N, rng, package):
+    from arnie.bpps import bpps
+    return bpps(''.join(rng.choice(list('ACGU'), N)), package=package)
+
+
+def best_of(n, func):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__=='__main__':
+    p = argparse.ArgumentParser(description=
+        """
+        Time the vectorized MEA fill against the cell-by-cell one, and check that both give
+        the same structure.
+        """)
+
+    p.add_argument("-N", "--lengths", type=int, nargs='+', default=[50, 100, 200, 400, 1000],
+                   help="sequence lengths")
+    p.add_argument("-g", "--gamma", type=float, default=1.0, help="MEA gamma")
+    p.add_argument("-p", "--package", help="fold random sequences with this package instead of synthetic bpps")
+    p.add_argument("--max-legacy", type=int, default=400,
+                   help="longest sequence to run the cell-by-cell fill on (it is O(N^3) in Python)")
+    p.add_argument("-r", "--repeats", type=int, default=1, help="timing repeats, best is reported")
+
+    args = p.parse_args()
+    rng = np.random.default_rng(0)
+
+    print('%8s %10s %10s %8s %8s' % ('N', 'old (s)', 'new (s)', 'speedup', 'pairs'))
+    for N in args.lengths:
+        bpp = random_sequence_bpps(N, rng, args.package) if args.package else synthetic_bpps(N, rng)
+        t_new, new = best_of(args.repeats, lambda: MEA(bpp, gamma=args.gamma))
+
+        if N <= args.max_legacy:
+            t_old, old = best_of(args.repeats, lambda: MEA(bpp, gamma=args.gamma, vectorized=False))
+            assert old.structure == new.structure, N
+            print('%8d %10.3f %10.3f %7.1fx %8d' % (N, t_old, t_new, t_old/t_new, len(new.MEA_bp_list)))
+        else:
+            print('%8d %10s %10.3f %8s %8d' % (N, '-', t_new, '-', len(new.MEA_bp_list)))
@@ -45,11 +45,12 @@ def predict_MEA_structures(matrix_list, gamma_min=-7, gamma_max=7, verbose=False
         running_best_gamma = -101
         running_best_struct = ''
 
-        for g in gamma_vals:
+        # one DP fill for all gammas
+        mea_list, metrics_list = mea_gamma_sweep(matrix, [2.0**g for g in gamma_vals])
 
-            mea_cls = MEA(matrix, gamma=2**g)
+        for g, mea_cls, metrics in zip(gamma_vals, mea_list, metrics_list):
 
-            metrics = mea_cls.score_expected() #sen, ppv, mcc, fscore
+            metrics = list(metrics) #sen, ppv, mcc, fscore
             metrics_across_gammas[g].append(metrics)
 
             if metrics[metric_ind] > running_best_value:
@@ -131,33 +132,14 @@ def score_against_true_structs(pred_struct_list, true_struct_list, verbose=False
 
     assert len(pred_structs) == len(true_structs)
 
-    tally, ptl_sen, ptl_ppv, ptl_mcc, ptl_fscore = 0, 0, 0, 0, 0
-
     pdb_indices = [os.path.basename(x).split('.')[0] for x in pred_struct_list]
-    
+
+    table, aggregate = score_ground_truth_batch(pred_structs, true_structs, names=pdb_indices[:len(pred_structs)],
+        weight_by_n_bps=weight_by_n_bps)
     for i in range(len(pred_structs)):
-        
-        sen, ppv, mcc, fscore, N = score_ground_truth(pred_structs[i], true_structs[i])
-        print('Score:\t%s\t%.3f\t%.3f\t%.3f\t%.3f' % (pdb_indices[i], sen, ppv, mcc, fscore))
-
-        if weight_by_n_bps:
-            ptl_sen += sen*N
-            ptl_ppv += ppv*N
-            ptl_mcc += mcc*N
-            ptl_fscore += fscore*N
-            tally += N
-
-        else:
-            ptl_sen += sen
-            ptl_ppv += ppv
-            ptl_mcc += mcc
-            ptl_fscore += fscore
-            tally += 1
-
-    mean_sen = ptl_sen/tally
-    mean_ppv = ptl_ppv/tally
-    mean_mcc = ptl_mcc/tally
-    mean_fscore = ptl_fscore/tally
+        print('Score:\t%s\t%.3f\t%.3f\t%.3f\t%.3f' % (table['name'][i], table['sen'][i], table['ppv'][i], table['mcc'][i], table['fscore'][i]))
+
+    mean_sen, mean_ppv, mean_mcc, mean_fscore = [aggregate[metric] for metric in ['sen', 'ppv', 'mcc', 'fscore']]
 
     print("Avg:\tsen\tppv\tmcc\tfscore\n\t%.3f\t%.3f\t%.3f\t%.3f" % (mean_sen, mean_ppv, mean_mcc, mean_fscore))
 
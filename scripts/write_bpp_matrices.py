@@ -1,5 +1,6 @@
 import sys, os, argparse
 import arnie.bpps as bpps
+from arnie import parallel
 from arnie.utils import write_matrix_to_file
 
 if __name__=='__main__':
@@ -13,6 +14,8 @@ if __name__=='__main__':
     p.add_argument("-o", help="name of output dir")
     p.add_argument("-p", "--package", default='vienna_2',
                    help="Package to use")
+    p.add_argument("-j", "--workers", type=int, default=1,
+                   help="Number of sequences to fold in parallel")
 
     if len(sys.argv)==1:
         p.print_help(sys.stderr)
@@ -23,10 +26,14 @@ if __name__=='__main__':
     if not os.path.exists('./%s' % args.o):
         os.makedirs('./%s' % args.o)
 
-    for seqfile in args.seq_dir:
+    seqs = [open(seqfile,'r').readlines()[-1].rstrip() for seqfile in args.seq_dir]
+    bp_matrices = parallel.map(bpps.bpps, seqs, workers=args.workers, progress=args.workers > 1, package=args.package)
+
+    for seqfile, bp_matrix in zip(args.seq_dir, bp_matrices):
         print(seqfile)
-        seq=open(seqfile,'r').readlines()[-1].rstrip()
+        if isinstance(bp_matrix, parallel.ItemFailure):
+            print('Failed: %s' % bp_matrix.error)
+            continue
         seq_id = os.path.basename(seqfile).replace('.seq','')
-        bp_matrix = bpps.bpps(seq, package=args.package)
         with open("%s/%s.bpps" % (args.o, seq_id),'w') as f:
             write_matrix_to_file(bp_matrix, f)
@@ -1,6 +1,7 @@
 import sys, os, argparse
 import arnie.bpps as bpps
 import numpy as np
+from arnie import parallel
 from arnie.utils import write_vector_to_file
 
 if __name__=='__main__':
@@ -12,6 +13,8 @@ if __name__=='__main__':
                    help="path to dir of *.seq files")
     p.add_argument("-o", help="name of output dir")
     p.add_argument("-p", "--package", default='vienna_2', help="Package to use")
+    p.add_argument("-j", "--workers", type=int, default=1,
+                   help="Number of sequences to fold in parallel")
 
     if len(sys.argv)==1:
         p.print_help(sys.stderr)
@@ -22,12 +25,17 @@ if __name__=='__main__':
     if not os.path.exists('./%s' % args.o):
         os.makedirs('./%s' % args.o)
 
-    for seqfile in args.seq_dir:
+    seqs = [open(seqfile,'r').readlines()[-1].rstrip() for seqfile in args.seq_dir]
+    bp_matrices = parallel.map(bpps.bpps, seqs, workers=args.workers, progress=args.workers > 1, package=args.package)
+
+    for seqfile, bp_matrix in zip(args.seq_dir, bp_matrices):
         print(seqfile)
-        seq=open(seqfile,'r').readlines()[-1].rstrip()
-    	seq_id = os.path.basename(seqfile).replace('.seq','')
+        if isinstance(bp_matrix, parallel.ItemFailure):
+            print('Failed: %s' % bp_matrix.error)
+            continue
+        seq_id = os.path.basename(seqfile).replace('.seq','')
 
-        unp_vector = 1-np.sum(bpps.bpps(seq, package=args.package),axis=0)
+        unp_vector = 1-np.sum(bp_matrix,axis=0)
 
-    	with open("%s/%s.unp" % (args.o, seq_id),'w') as f:
-    		write_vector_to_file(unp_vector, f)
+        with open("%s/%s.unp" % (args.o, seq_id),'w') as f:
+            write_vector_to_file(unp_vector, f)
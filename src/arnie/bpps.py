@@ -3,15 +3,16 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
-from .pfunc import pfunc
-
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
+from .cache import cached
+from .rnalib import use_rnalib_, pfunc_rnalib_
+from .pfunc import pfunc, pfunc_vienna_batch_, pfunc_contrafold_batch_, pfunc_linearpartition_batch_, eternafold_locations_, cutoff_arg_
 
+@cached('bpps')
+@in_scratch_dir
 def bpps(sequence, package='vienna', constraint=None, pseudo=False,
          T=37, coaxial=True, linear=False, dna=False,
         motif=None, dangles=True,param_file=None,reweight=None, beam_size=100, DEBUG=False, threshknot=False,
-        probing_signal=None, probing_kws=None,DIRLOC=None):
+        probing_signal=None, probing_kws=None,DIRLOC=None, sparse=False, bpp_cutoff=None, threads=None):
 
     ''' Compute base pairing probability matrix for RNA sequence.
 
@@ -29,12 +30,19 @@ def bpps(sequence, package='vienna', constraint=None, pseudo=False,
     beam size (int): Beam size for LinearPartition base pair calculation.
     DEBUG (bool): Output command-line calls to packages.
     threshknot (bool): calls threshknot to predict pseudoknots (for contrafold with LinearPartition)
+    sparse (bool): return a symmetric scipy.sparse CSR matrix, built without a dense NxN intermediate
+    bpp_cutoff (float): drop pairs with probability below this. Passed to the package so that it writes
+        less output, where the package has an option for it. Default (None) keeps the package defaults
+        (1e-10, or 1e-6 for LinearPartition); something like 1e-4 makes long sequences much cheaper.
+    threads (int): (RNAstructure only) run partition-smp with this many threads if it is installed ('auto': share of the cores)
 
     Possible packages: 'vienna_2', 'vienna_1','contrafold_1','contrafold_2',
     'nupack_95','nupack_99','rnasoft_2007','rnasoft_1999','rnastructure','vfold_0','vfold_1'
+    vienna_2 runs in-process through the ViennaRNA Python bindings when they are installed
+    (see `rnalib.set_vienna_engine`), otherwise through RNAfold.
 
     Returns
-    array: NxN matrix of base pair probabilities
+    array: NxN matrix of base pair probabilities (scipy.sparse.csr_matrix if sparse=True)
   '''
     package = package.lower()
     try:
@@ -56,86 +64,149 @@ def bpps(sequence, package='vienna', constraint=None, pseudo=False,
         print('Warning: LinearPartition only implemented for vienna, contrafold, eternafold.')
 
     if pkg=='nupack':
-        return bpps_nupack_(sequence, version = version, dangles = dangles, T = T, pseudo=pseudo, dna=dna)
+        return bpps_nupack_(sequence, version = version, dangles = dangles, T = T, pseudo=pseudo, dna=dna, sparse=sparse,
+            bpp_cutoff=bpp_cutoff)
 
     elif pkg=='vfold':
-        return bpps_vfold_(sequence, version = version, T = T, coaxial = coaxial)
+        return bpps_vfold_(sequence, version = version, T = T, coaxial = coaxial, sparse=sparse, bpp_cutoff=bpp_cutoff)
+
+    elif pkg=='vienna' and not linear and use_rnalib_(version=version, motif=motif, param_file=param_file, probing_signal=probing_signal):
+        _, bpp = pfunc_rnalib_(sequence, T=T, bpps=True, dangles=dangles, constraint=constraint,
+            reweight=reweight, probing_signal=probing_signal, probing_kws=probing_kws, sparse=sparse, bpp_cutoff=bpp_cutoff,
+            DEBUG=DEBUG)
+        return bpp
+
     else:
 
         _, tmp_file = pfunc(sequence, package=package, bpps=True, linear=linear,
-            motif=motif, constraint=constraint, T=T, coaxial=coaxial, probing_signal=probing_signal, probing_kws=probing_kws, DIRLOC=package_locs[package],
-             dangles=dangles, param_file=param_file,reweight=reweight, beam_size=beam_size, DEBUG=DEBUG, threshknot=threshknot)
+            motif=motif, constraint=constraint, T=T, coaxial=coaxial, probing_signal=probing_signal, probing_kws=probing_kws, DIRLOC=package_locs.get(package),
+             dangles=dangles, param_file=param_file,reweight=reweight, beam_size=beam_size, DEBUG=DEBUG, threshknot=threshknot,
+             bpp_cutoff=bpp_cutoff, threads=threads)
 
         if linear:
             #parse linearpartition output
-            return bpps_linearpartition_(sequence, tmp_file)
+            return bpps_linearpartition_(sequence, tmp_file, sparse=sparse, bpp_cutoff=bpp_cutoff)
         else:
 
             if 'contrafold' in pkg:
-                return bpps_contrafold_(sequence, tmp_file)
+                return bpps_contrafold_(sequence, tmp_file, sparse=sparse, bpp_cutoff=bpp_cutoff)
             if package=='eternafold':
-                return bpps_contrafold_(sequence, tmp_file)
+                return bpps_contrafold_(sequence, tmp_file, sparse=sparse, bpp_cutoff=bpp_cutoff)
             elif 'vienna' in pkg:
-                return bpps_vienna_(sequence, tmp_file)
+                return bpps_vienna_(sequence, tmp_file, sparse=sparse, bpp_cutoff=bpp_cutoff)
             elif 'rnasoft' in pkg:
-                return bpps_rnasoft_(sequence, tmp_file)
+                return bpps_rnasoft_(sequence, tmp_file, sparse=sparse, bpp_cutoff=bpp_cutoff)
             elif 'rnastructure' in pkg:
-                return bpps_rnastructure_(sequence, tmp_file, coaxial=coaxial)
+                return bpps_rnastructure_(sequence, tmp_file, coaxial=coaxial, sparse=sparse, bpp_cutoff=bpp_cutoff)
 
             else:
                 raise RuntimeError('package not yet implemented')
 
-def bpps_vienna_(sequence, tmp_file):
+@in_scratch_dir
+def bpps_batch(sequences, package='vienna_2', T=37, constraint=None, motif=None, linear=False,
+        dangles=True, param_file=None, reweight=None, jobs=None, batch_size=None, sparse=False, bpp_cutoff=None,
+        DEBUG=False, **kwargs):
+
+    ''' Compute base pairing probability matrices for many RNA sequences, sharing package invocations.
+
+    For vienna, all sequences are sent as one FASTA batch through a single RNAfold run
+    (multithreaded with --jobs if the RNAfold binary supports it), and the per-sequence
+    dot plots are parsed back in input order (with the rnalib engine, see `rnalib.set_vienna_engine`,
+    each sequence is folded in-process instead). For contrafold and eternafold, one input file
+    per sequence is given to a single `contrafold predict --posteriors` call, so the parameter
+    file is only loaded once. With linear=True, all sequences are streamed through the stdin
+    of one LinearPartition process. Other packages and options that can't be batched fall back
+    to one `bpps` call per sequence.
+
+    Args:
+    sequences (list): nucleic acid sequences
+    package (str): as in `bpps`
+    constraint (list): structure constraints, one per sequence (or None)
+    jobs (int): number of RNAfold threads. Default (None) uses all available cores (within arnie.parallel.map, the worker's share).
+    batch_size (int): max number of sequences per package invocation (default: all at once)
+    sparse (bool): return scipy.sparse CSR matrices
+    bpp_cutoff (float): drop pairs with probability below this, as in `bpps`
+    other arguments as in `bpps`
+
+    Returns
+    list of arrays: NxN matrix of base pair probabilities for each sequence, in input order
+    '''
+    package = package.lower()
+    try:
+        pkg, version = package.split('_')
+    except:
+        pkg, version = package, None
+
+    if constraint is not None and len(constraint) != len(sequences):
+        raise ValueError('Need one constraint per sequence for batch mode.')
+
+    if pkg not in ['vienna', 'contrafold', 'eternafold'] or motif is not None \
+        or kwargs.get('probing_signal') is not None or kwargs.get('threshknot') \
+        or (pkg == 'vienna' and not linear and use_rnalib_(version=version, param_file=param_file)):
+        return [bpps(sequence, package=package, T=T, motif=motif, linear=linear, dangles=dangles,
+            param_file=param_file, reweight=reweight, constraint=None if constraint is None else constraint[i],
+            sparse=sparse, bpp_cutoff=bpp_cutoff, DEBUG=DEBUG, **kwargs) for i, sequence in enumerate(sequences)]
+
+    if batch_size is None:
+        batch_size = max(len(sequences), 1)
+
+    bpps_list = []
+    for start in range(0, len(sequences), batch_size):
+        chunk = sequences[start:start+batch_size]
+        chunk_constraints = None if constraint is None else constraint[start:start+batch_size]
+
+        if linear:
+            _, tmp_file = pfunc_linearpartition_batch_(chunk, package=pkg, bpps=True,
+                beam_size=kwargs.get('beam_size', 100), DEBUG=DEBUG, bpp_cutoff=bpp_cutoff)
+            bpps_list.extend(bpps_linearpartition_batch_(chunk, tmp_file, sparse=sparse, bpp_cutoff=bpp_cutoff))
+
+        elif pkg == 'vienna':
+            results = pfunc_vienna_batch_(chunk, version=version, T=T, dangles=dangles,
+                constraints=chunk_constraints, param_file=param_file, reweight=reweight, jobs=jobs, DEBUG=DEBUG,
+                bpp_cutoff=bpp_cutoff)
+            for sequence, (_, tmp_file) in zip(chunk, results):
+                bpps_list.append(bpps_vienna_(sequence, tmp_file, sparse=sparse, bpp_cutoff=bpp_cutoff))
+
+        else:
+            if pkg == 'contrafold':
+                DIRLOC, contrafold_param_file = kwargs.get('DIRLOC', package_locs.get(package)), param_file
+            else:
+                DIRLOC, contrafold_param_file = eternafold_locations_(param_file=param_file, DIRLOC=kwargs.get('DIRLOC'))
+
+            results = pfunc_contrafold_batch_(chunk, version=version, constraints=chunk_constraints, bpps=True,
+                param_file=contrafold_param_file, DIRLOC=DIRLOC, DEBUG=DEBUG, bpp_cutoff=bpp_cutoff)
+            for sequence, (_, tmp_file) in zip(chunk, results):
+                bpps_list.append(bpps_contrafold_(sequence, tmp_file, sparse=sparse, bpp_cutoff=bpp_cutoff))
+
+    return bpps_list
+
+def bpps_vienna_(sequence, tmp_file, sparse=False, bpp_cutoff=None):
 
     dot_fname = tmp_file
 
-    probs=np.zeros([len(sequence), len(sequence)])
-    with open(dot_fname,'r') as f:
-        for line in f.readlines():
-            if 'ubox' in line:
-                try:
-                    i, j, p, _ = line.split()
-                    i, j, p = int(i)-1, int(j)-1, float(p)**2
-                    probs[i,j] = p
-                    probs[j,i] = p
-                except:
-                    pass
+    I, J, P = parse_vienna_dot_plot_(dot_fname)
     os.remove(dot_fname)
-    return probs
+    return bpp_matrix_from_pairs(I, J, P, len(sequence), sparse=sparse, cutoff=bpp_cutoff)
 
-def bpps_contrafold_(sequence, tmp_file):
+def bpps_contrafold_(sequence, tmp_file, sparse=False, bpp_cutoff=None):
 
     fname = tmp_file
 
-    probs=np.zeros([len(sequence), len(sequence)])
-
-    for line in open(fname).readlines():
-        if len(line.split(':')) > 1:
-            first_ind = int(line.split()[0])-1
-            for x in line.split()[2:]:
-                second_ind = int(x.split(':')[0])-1
-                p = float(x.split(':')[1])
-                probs[first_ind, second_ind] = p
-                probs[second_ind, first_ind] = p
-
+    I, J, P = parse_contrafold_posteriors_(fname)
     os.remove(fname)
 
-    return probs
+    return bpp_matrix_from_pairs(I, J, P, len(sequence), sparse=sparse, cutoff=bpp_cutoff)
 
-def bpps_rnasoft_(sequence, tmp_file):
+def bpps_rnasoft_(sequence, tmp_file, sparse=False, bpp_cutoff=None):
     fname = tmp_file
 
-    probs=np.zeros([len(sequence), len(sequence)])
-    for line in open(fname).readlines():
-        i,j,p = int(line.split()[0]), int(line.split()[1]), float(line.split()[2])
-        probs[i,j] = p
-        probs[j,i] = p
-
+    # RNAsoft writes 0-indexed `i j p` lines
+    I, J, P = parse_pair_table_(fname)
     os.remove(fname)
 
-    return probs
+    return bpp_matrix_from_pairs(I, J, P, len(sequence), sparse=sparse, cutoff=bpp_cutoff)
 
-def bpps_nupack_(sequence, version='95', T=37, dangles=True, pseudo=False,dna=False):
+def bpps_nupack_(sequence, version='95', T=37, dangles=True, pseudo=False,dna=False, sparse=False, bpp_cutoff=None):
 
     if not version: version='95'
 
@@ -156,11 +227,11 @@ def bpps_nupack_(sequence, version='95', T=37, dangles=True, pseudo=False,dna=Fa
     seqfile = write([sequence])
 
     command=['%s/pairs' % DIR, '%s' % seqfile.replace('.in',''),
-      '-T', str(T), '-material', material, '-dangles', dangle_option, '-cutoff', '0.0000000001']
+      '-T', str(T), '-material', material, '-dangles', dangle_option, '-cutoff', cutoff_arg_(bpp_cutoff)]
 
     if pseudo:
         command.append('--pseudo')
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
@@ -170,33 +241,21 @@ def bpps_nupack_(sequence, version='95', T=37, dangles=True, pseudo=False,dna=Fa
     ppairs_file = '%s.ppairs' % seqfile.replace('.in','')
     os.remove(seqfile)
 
-    probs=np.zeros([len(sequence), len(sequence)])
-
-    with open(ppairs_file, 'r') as f:
-        for line in f.readlines():
-            if not line.startswith('%'):
-                fields = line.split()
-                if len(fields) > 1:
-                    if int(fields[1]) <= len(sequence):
-                        i, j, p = int(fields[0])-1, int(fields[1])-1, float(fields[2])
-                        probs[i,j] = p
-                        probs[j,i] = p
+    I, J, P = parse_nupack_ppairs_(ppairs_file, len(sequence))
     os.remove(ppairs_file)
 
-    return probs
+    return bpp_matrix_from_pairs(I, J, P, len(sequence), sparse=sparse, cutoff=bpp_cutoff)
 
-def bpps_rnastructure_(sequence, tmp_file, coaxial=True, DEBUG=False):
+def bpps_rnastructure_(sequence, tmp_file, coaxial=True, DEBUG=False, sparse=False, bpp_cutoff=None, keep_pfs=False):
 
     DIR = package_locs['rnastructure']
 
     pfsfile = tmp_file #'%s/rnastructtmp.pfs' % package_locs['TMP']
     outfile = '%s.probs' % (tmp_file.replace('.pfs',''))
-    command = ['%s/ProbabilityPlot' % DIR, pfsfile, outfile, '-t', '-min', '0.0000000001']
-
-    probs=np.zeros([len(sequence), len(sequence)])
+    command = ['%s/ProbabilityPlot' % DIR, pfsfile, outfile, '-t', '-min', cutoff_arg_(bpp_cutoff)]
 
     if DEBUG: print(' '.join(command))
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
@@ -207,32 +266,22 @@ def bpps_rnastructure_(sequence, tmp_file, coaxial=True, DEBUG=False):
         print(stderr)
 
     if p.returncode:
-        raise Exception('RNAstructure ProbabilityPlot failed: on %s\n%s' % (seq, stderr))
-
-    with open(outfile, 'r') as f:
-        for line in f.readlines()[2:]:
-            fields = line.split()
-            i, j, p = int(fields[0])-1, int(fields[1])-1, 10**(-1*float(fields[2]))
-            probs[i,j] = p
-            probs[j,i] = p
+        raise Exception('RNAstructure ProbabilityPlot failed: on %s\n%s' % (sequence, stderr))
 
+    I, J, P = parse_probability_plot_(outfile)
     os.remove(outfile)
-    os.remove(pfsfile)
-    return probs
+    if not keep_pfs:
+        os.remove(pfsfile)
+    return bpp_matrix_from_pairs(I, J, P, len(sequence), sparse=sparse, cutoff=bpp_cutoff)
 
-def bpps_vfold_(sequence, version='0',T=37, coaxial=True, DEBUG=False):
+def bpps_vfold_(sequence, version='0',T=37, coaxial=True, DEBUG=False, sparse=False, bpp_cutoff=None):
     #available versions: 0 for Turner 04 params, 1 for Mfold 2.3 params
 
     DIR = package_locs["vfold"]
 
-    cwd = os.getcwd()
-    os.chdir(DIR) #vfold precompiled binaries don't work being called from elsewhere
+    seqfile = os.path.abspath(write([sequence]))
 
-    if DEBUG: print(os.getcwd())
-
-    seqfile = write([sequence])
-
-    outfile = filename()+'.pij'
+    outfile = os.path.abspath(filename()+'.pij')
 
     if sys.platform=="linux":
         platform='linux'
@@ -243,14 +292,14 @@ def bpps_vfold_(sequence, version='0',T=37, coaxial=True, DEBUG=False):
     else:
         raise RuntimeError('Vfold has binaries for linux, macOS, and win')
 
-    command = ['./Vfold2d_npk_%s.o %d %d %s %s %d' % (platform, int(coaxial), T, seqfile, outfile, int(version))]
+    command = ['./Vfold2d_npk_%s.o' % platform, str(int(coaxial)), str(T), seqfile, outfile, str(int(version))]
 
     if DEBUG: print(' '.join(command))
 
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
+    #vfold precompiled binaries don't work being called from elsewhere
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=DIR)
 
     stdout, stderr = p.communicate()
-    os.chdir(cwd)
 
     if DEBUG:
         print('stdout')
@@ -261,33 +310,122 @@ def bpps_vfold_(sequence, version='0',T=37, coaxial=True, DEBUG=False):
         raise Exception('Vfold2d_npk failed: on %s\n%s' % (sequence, stderr))
 
     os.remove(seqfile)
-    probs = np.zeros([len(sequence),len(sequence)])
-    p_ij_output = np.loadtxt(outfile,usecols=(0,2,3)) #col 0: set of inds 1, col 1: set of inds 2, col 2: bpp
-
-    for i,j,p in p_ij_output:
-        probs[int(i-1),int(j-1)] = p
-        probs[int(j-1),int(i-1)] = p
+    I, J, P = parse_vfold_pij_(outfile)
     os.remove(outfile)
 
-    return probs
+    return bpp_matrix_from_pairs(I, J, P, len(sequence), sparse=sparse, cutoff=bpp_cutoff)
     #output: take second field of last line for Z
 
 
-def bpps_linearpartition_(sequence, tmp_file):
+def bpps_linearpartition_(sequence, tmp_file, sparse=False, bpp_cutoff=None):
 
     fname = tmp_file
 
-    probs=np.zeros([len(sequence), len(sequence)])
+    I, J, P = parse_pair_table_(fname, one_indexed=True)
+    os.remove(fname)
+
+    return bpp_matrix_from_pairs(I, J, P, len(sequence), sparse=sparse, cutoff=bpp_cutoff)
 
-    for line in open(fname,'r').readlines():
-        if len(line.strip())>0:
-            first_ind, second_ind, p = line.strip().split(' ')
-            first_ind = int(first_ind)-1
-            second_ind = int(second_ind)-1
-            p = float(p)
-            probs[first_ind, second_ind] = p
-            probs[second_ind, first_ind] = p
+def bpps_linearpartition_batch_(sequences, tmp_file, sparse=False, bpp_cutoff=None):
+    '''split a LinearPartition bpp file written for several sequences
+    (one blank-line-terminated block per sequence) into per-sequence matrices'''
+
+    with open(tmp_file) as f:
+        text = f.read()
+    os.remove(tmp_file)
+
+    # every block ends with a blank line (a sequence without pairs gives just the blank line)
+    blocks = re.split(r'^[ \t]*\n', text, flags=re.M)
+    if not blocks[-1].strip():
+        blocks = blocks[:-1]
+
+    probs_list = []
+    for sequence, block in zip(sequences, blocks):
+        I, J, P = pairs_from_table_(block, one_indexed=True)
+        probs_list.append(bpp_matrix_from_pairs(I, J, P, len(sequence), sparse=sparse, cutoff=bpp_cutoff))
+
+    if len(probs_list) != len(sequences):
+        raise RuntimeError('LinearPartition bpp output has %d blocks for %d sequences' % (len(probs_list), len(sequences)))
+
+    return probs_list
+
+
+###############################################################################
+# Parsing package output
+###############################################################################
+
+# Each parser returns 0-indexed pair arrays (i, j, p). Files are read in one go and the
+# numbers are parsed by NumPy's C readers instead of line by line in Python.
+
+def _read_table(text, usecols=(0, 1, 2), **kwargs):
+    '''columns of a whitespace-separated table, as float arrays (empty if there are no rows)'''
+    lines = text.splitlines() if isinstance(text, str) else text
+    if not any(line.strip() for line in lines):
+        return [np.zeros(0) for _ in usecols]
+    values = np.loadtxt(lines, usecols=usecols, ndmin=2, **kwargs)
+    return [values[:, k] for k in range(len(usecols))]
+
+
+def _pair_arrays(i, j, p, one_indexed=True):
+    offset = 1 if one_indexed else 0
+    return i.astype(np.int64)-offset, j.astype(np.int64)-offset, p
+
+
+def vienna_dot_plot_pairs_(text):
+    '''upper-triangle `i j sqrt(p) ubox` entries of an RNAfold dot plot'''
+    # the header comment `% i  j  sqrt(p(i,j)) ubox` also ends in ubox
+    lines = [line for line in text.splitlines() if line.rstrip().endswith(' ubox') and not line.startswith('%')]
+    i, j, sqrt_p = _read_table(lines)
+    return _pair_arrays(i, j, sqrt_p*sqrt_p)
+
+
+def parse_vienna_dot_plot_(fname):
+    with open(fname) as f:
+        return vienna_dot_plot_pairs_(f.read())
+
+
+def parse_contrafold_posteriors_(fname):
+    '''CONTRAfold/EternaFold --posteriors output: lines of `i nt j:p j:p ...`'''
+    with open(fname) as f:
+        text = f.read()
+
+    # `i nt` prefixes become -i, which marks where each line starts among the tokens (j, p > 0)
+    tokens = np.fromstring(re.sub(r'\n[ \t]*(\d+)[ \t]+\S+', r'\n-\1', '\n' + text).replace(':', ' '), sep=' ')
+    starts = np.flatnonzero(tokens < 0)
+    counts = (np.diff(np.append(starts, len(tokens))) - 1)//2
+    i = np.repeat(-1*tokens[starts].astype(np.int64), counts)
+    jp = np.delete(tokens, starts).reshape(-1, 2)
+    return _pair_arrays(i, jp[:, 0], jp[:, 1])
+
+
+def pairs_from_table_(text, one_indexed=False):
+    '''`i j p` lines, as written by LinearPartition (1-indexed) and RNAsoft (0-indexed)'''
+    return _pair_arrays(*_read_table(text), one_indexed=one_indexed)
+
+
+def parse_pair_table_(fname, one_indexed=False):
+    with open(fname) as f:
+        return pairs_from_table_(f.read(), one_indexed=one_indexed)
+
+
+def parse_nupack_ppairs_(fname, N):
+    '''NUPACK .ppairs file: `%` comments, the sequence length, then 1-indexed `i j p` lines
+    where j = N+1 holds the unpaired probability of i'''
+    with open(fname) as f:
+        lines = [line for line in f.read().splitlines() if len(line.split()) > 1 and not line.startswith('%')]
+    i, j, p = _pair_arrays(*_read_table(lines))
+    paired = j < N
+    return i[paired], j[paired], p[paired]
+
+
+def parse_probability_plot_(fname):
+    '''RNAstructure `ProbabilityPlot -t` output: two header lines, then `i j -log10(p)`'''
+    with open(fname) as f:
+        i, j, log_p = _read_table(f.read().splitlines()[2:])
+    return _pair_arrays(i, j, 10**(-1*log_p))
 
-    os.remove(fname)
 
-    return probs
+def parse_vfold_pij_(fname):
+    '''Vfold2d .pij file, columns 0, 2 and 3 are i, j and p'''
+    with open(fname) as f:
+        return _pair_arrays(*_read_table(f.read(), usecols=(0, 2, 3)))
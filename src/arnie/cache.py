@@ -0,0 +1,684 @@
+import os, io, json, time, hashlib, tempfile, threading, inspect, functools
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import scipy.sparse
+from .utils import package_locs, bpp_matrix_from_pairs
+from .rnalib import vienna_engine_id_
+
+# arguments that name files: the key uses the file contents, not the path
+FILE_ARGS = ['param_file', 'reweight', 'shape_file', 'dms_file']
+
+# arguments that don't change the result
+IGNORED_ARGS = ['DEBUG', 'threads']
+
+DEFAULT_MAX_BYTES = 2**30
+
+DEFAULT_MEMO_ENTRIES = 256
+DEFAULT_MEMO_BYTES = 2**28
+
+
+class DiskCache:
+    '''Content-addressed store of folding results in a directory.
+
+    Each result is one compressed .npz file named by its key. Writes go to a temporary
+    file that is renamed into place, so concurrent processes (also on a shared filesystem)
+    never see partial entries. Reads refresh a file's mtime and the oldest entries are
+    evicted once the directory grows past `max_bytes`.
+
+    Args:
+        path (str): cache directory, created if needed
+        max_bytes (int): size budget for the directory
+    '''
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._size = None
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+    def __repr__(self):
+        return 'DiskCache(%r, max_bytes=%d)' % (self.path, self.max_bytes)
+
+    def _fname(self, key):
+        return os.path.join(self.path, key[:2], key + '.npz')
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def get(self, key):
+        '''Returns (True, value) if key is in the cache, else (False, None).'''
+        fname = self._fname(key)
+        try:
+            with open(fname, 'rb') as f:
+                value = decode_value(f.read())
+        except (OSError, ValueError, KeyError):
+            # missing, or evicted/corrupted under our feet
+            self._count('misses')
+            return False, None
+
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+        self._count('hits')
+        return True, value
+
+    def put(self, key, value):
+        data = encode_value(value)
+        fname = self._fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+        fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_fname, fname)
+        except BaseException:
+            try:
+                os.remove(tmp_fname)
+            except OSError:
+                pass
+            raise
+        self._count('writes')
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+            over = self._size is None or self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        '''Delete least recently used entries until the cache is under 90% of max_bytes.'''
+        entries = self._entries()
+        now = time.time()
+        size = 0
+        for mtime, nbytes, fname in entries:
+            # leftovers of writers that died
+            if fname.endswith('.tmp') and now - mtime > 3600:
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+            else:
+                size += nbytes
+
+        n_evicted = 0
+        if size > self.max_bytes:
+            for mtime, nbytes, fname in sorted(entries):
+                if size <= 0.9*self.max_bytes:
+                    break
+                if not fname.endswith('.npz'):
+                    continue
+                try:
+                    os.remove(fname)
+                except OSError:
+                    continue
+                size -= nbytes
+                n_evicted += 1
+
+        with self._lock:
+            self._size = size
+            self._stats['evictions'] += n_evicted
+
+    def clear(self):
+        '''Delete all entries.'''
+        for mtime, nbytes, fname in self._entries():
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+
+    def size(self):
+        '''Total bytes on disk.'''
+        return sum(nbytes for _, nbytes, _ in self._entries())
+
+    def stats(self):
+        '''Hit/miss/write/eviction counts for this process.'''
+        with self._lock:
+            stats = dict(self._stats)
+        n_lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits']/n_lookups if n_lookups else 0.0
+        return stats
+
+
+class MemoCache:
+    '''Bounded in-memory LRU of folding results, for calls repeated within one process.
+
+    Arrays are stored as read-only copies, and every hit hands out a fresh writable copy,
+    so callers can modify results as they could before without corrupting later calls.
+
+    Args:
+        max_entries (int): maximum number of results kept
+        max_bytes (int): maximum total size of the results kept
+    '''
+    def __init__(self, max_entries=DEFAULT_MEMO_ENTRIES, max_bytes=DEFAULT_MEMO_BYTES):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __repr__(self):
+        return 'MemoCache(max_entries=%d, max_bytes=%d)' % (self.max_entries, self.max_bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Returns (True, value) if key is in the memo, else (False, None).'''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return True, _thaw(self._entries[key][0])
+            self._stats['misses'] += 1
+            return False, None
+
+    def put(self, key, value):
+        value = _freeze(value)
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, n) = self._entries.popitem(last=False)
+                self._bytes -= n
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''Hit/miss/eviction counts and current size.'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        n_lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits']/n_lookups if n_lookups else 0.0
+        return stats
+
+
+def _freeze(x):
+    if isinstance(x, np.ndarray):
+        x = x.copy()
+        x.flags.writeable = False
+        return x
+    if scipy.sparse.issparse(x):
+        x = x.tocsr(copy=True)
+        for a in [x.data, x.indices, x.indptr]:
+            a.flags.writeable = False
+        return x
+    if isinstance(x, tuple):
+        return tuple(_freeze(y) for y in x)
+    return x
+
+
+def _thaw(x):
+    if isinstance(x, np.ndarray) or scipy.sparse.issparse(x):
+        return x.copy()
+    if isinstance(x, tuple):
+        return tuple(_thaw(y) for y in x)
+    return x
+
+
+def _nbytes(x):
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if scipy.sparse.issparse(x):
+        x = x.tocsr()
+        return x.data.nbytes + x.indices.nbytes + x.indptr.nbytes
+    if isinstance(x, str):
+        return len(x)
+    if isinstance(x, tuple):
+        return sum(_nbytes(y) for y in x)
+    return 32
+
+
+###############################################################################
+# Encoding results
+###############################################################################
+
+def encode_value(value):
+    '''Serialize a result (number, string, dense or sparse bpp matrix or tuple of those) to
+    compressed npz bytes. Symmetric matrices are stored as their nonzero upper triangle.'''
+    arrays = {}
+
+    def encode(x):
+        if isinstance(x, tuple):
+            return {'tuple': [encode(y) for y in x]}
+        if isinstance(x, list):
+            return {'list': [encode(y) for y in x]}
+        if isinstance(x, np.ndarray):
+            name = 'a%d' % len(arrays)
+            if x.ndim == 2 and x.shape[0] == x.shape[1] and np.array_equal(x, x.T):
+                i, j = np.nonzero(np.triu(x))
+                arrays[name + '_i'] = i.astype(np.int32)
+                arrays[name + '_j'] = j.astype(np.int32)
+                arrays[name + '_p'] = x[i, j]
+                return {'sym': name, 'n': x.shape[0], 'dtype': x.dtype.str}
+            arrays[name] = x
+            return {'array': name}
+        if scipy.sparse.issparse(x):
+            name = 'a%d' % len(arrays)
+            symmetric = (x != x.T).nnz == 0
+            x = (scipy.sparse.triu(x) if symmetric else x).tocoo()
+            arrays[name + '_i'] = x.row.astype(np.int32)
+            arrays[name + '_j'] = x.col.astype(np.int32)
+            arrays[name + '_p'] = x.data
+            return {'sparse': name, 'n': x.shape[0], 'symmetric': symmetric}
+        if isinstance(x, np.generic):
+            return {'scalar': x.dtype.str, 'value': x.item()}
+        if x is None or isinstance(x, (bool, int, float, str)):
+            return {'value': x}
+        raise TypeError('cannot cache value of type %s' % type(x).__name__)
+
+    meta = encode(value)
+    buf = io.BytesIO()
+    np.savez_compressed(buf, meta=np.array(json.dumps(meta)), **arrays)
+    return buf.getvalue()
+
+
+def decode_value(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+        arrays = {k: npz[k] for k in npz.files}
+
+    def decode(m):
+        if 'tuple' in m:
+            return tuple(decode(y) for y in m['tuple'])
+        if 'list' in m:
+            return [decode(y) for y in m['list']]
+        if 'sym' in m:
+            name = m['sym']
+            x = np.zeros((m['n'], m['n']), dtype=np.dtype(m['dtype']))
+            i, j = arrays[name + '_i'], arrays[name + '_j']
+            x[i, j] = arrays[name + '_p']
+            x[j, i] = arrays[name + '_p']
+            return x
+        if 'array' in m:
+            return arrays[m['array']]
+        if 'sparse' in m:
+            name = m['sparse']
+            i, j, p = arrays[name + '_i'], arrays[name + '_j'], arrays[name + '_p']
+            if m['symmetric']:
+                return bpp_matrix_from_pairs(i, j, p, m['n'], sparse=True)
+            return scipy.sparse.csr_matrix((p, (i, j)), shape=(m['n'], m['n']))
+        if 'scalar' in m:
+            return np.dtype(m['scalar']).type(m['value'])
+        return m['value']
+
+    return decode(json.loads(str(arrays.pop('meta'))))
+
+
+###############################################################################
+# Keys
+###############################################################################
+
+# (path, mtime, size) -> sha256, so parameter files aren't re-read on every call
+_file_digests = {}
+
+
+def _file_digest(fname):
+    st = os.stat(fname)
+    stamp = (os.path.abspath(fname), st.st_mtime_ns, st.st_size)
+    if stamp not in _file_digests:
+        h = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        if len(_file_digests) > 1024:
+            _file_digests.clear()
+        _file_digests[stamp] = h.hexdigest()
+    return _file_digests[stamp]
+
+
+def _canonical(x):
+    if x is None or isinstance(x, (bool, int, float, str)):
+        return x
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return {'ndarray': x.dtype.str, 'shape': list(x.shape),
+                'sha256': hashlib.sha256(np.ascontiguousarray(x).tobytes()).hexdigest()}
+    if isinstance(x, (list, tuple)):
+        return [_canonical(y) for y in x]
+    if isinstance(x, dict):
+        return {str(k): _canonical(v) for k, v in sorted(x.items())}
+    raise TypeError('cannot make cache key from %s' % type(x).__name__)
+
+
+def make_key(name, arguments):
+    '''Hash of a call: function name, package locations, the normalized sequence and every option.
+
+    Args:
+        name (str): function name
+        arguments (dict): argument name -> value, including defaults; the first entry is the sequence
+    '''
+    arguments = dict(arguments)
+    for arg in IGNORED_ARGS:
+        arguments.pop(arg, None)
+
+    seq_arg = next(iter(arguments))
+    if isinstance(arguments[seq_arg], str):
+        arguments[seq_arg] = ''.join(arguments[seq_arg].split())
+
+    for arg in FILE_ARGS:
+        fname = arguments.get(arg)
+        if isinstance(fname, str) and os.path.isfile(fname):
+            arguments[arg] = {'file_sha256': _file_digest(fname)}
+
+    # the same package name may point at a different build
+    arguments['package_locs'] = package_locs.fingerprint()
+    if str(arguments.get('package', '')).lower().startswith('vienna'):
+        arguments['vienna_engine'] = vienna_engine_id_()
+
+    text = json.dumps([name, _canonical(arguments)], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+###############################################################################
+# Enabling the cache
+###############################################################################
+
+_disk_cache = None
+_disk_cache_checked = False
+
+
+def enable_disk_cache(path=None, max_bytes=DEFAULT_MAX_BYTES):
+    '''Cache results of pfunc, bpps, mfe and free_energy on disk for this process.
+
+    The cache can also be turned on for every process with the environment variable
+    ARNIE_CACHE_DIR (and ARNIE_CACHE_MAX_BYTES).
+
+    Args:
+        path (str): cache directory (default: $ARNIE_CACHE_DIR, else ~/.cache/arnie)
+        max_bytes (int): size budget, least recently used entries are evicted past it
+
+    Returns:
+        DiskCache
+    '''
+    global _disk_cache, _disk_cache_checked
+    if path is None:
+        path = os.environ.get('ARNIE_CACHE_DIR', '~/.cache/arnie')
+    _disk_cache = DiskCache(path, max_bytes=max_bytes)
+    _disk_cache_checked = True
+    return _disk_cache
+
+
+def disable_disk_cache():
+    global _disk_cache, _disk_cache_checked
+    _disk_cache = None
+    _disk_cache_checked = True
+
+
+def get_disk_cache():
+    '''The active DiskCache, or None if caching is off.'''
+    global _disk_cache_checked
+    if not _disk_cache_checked:
+        _disk_cache_checked = True
+        if os.environ.get('ARNIE_CACHE_DIR'):
+            enable_disk_cache(max_bytes=int(float(os.environ.get('ARNIE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))))
+    return _disk_cache
+
+
+@contextmanager
+def disk_cache(path=None, max_bytes=DEFAULT_MAX_BYTES):
+    '''Cache results on disk for the duration of the block, e.g.
+
+        with disk_cache('/scratch/arnie_cache') as cache:
+            bpps(seq, package='eternafold')
+        print(cache.stats())
+    '''
+    global _disk_cache, _disk_cache_checked
+    get_disk_cache()
+    previous = _disk_cache
+    cache = enable_disk_cache(path, max_bytes=max_bytes)
+    try:
+        yield cache
+    finally:
+        _disk_cache = previous
+
+
+_memo = None
+_memo_checked = False
+
+
+def enable_memo(max_entries=DEFAULT_MEMO_ENTRIES, max_bytes=DEFAULT_MEMO_BYTES):
+    '''Keep the results of recent pfunc, bpps, mfe and free_energy calls in memory.
+
+    The memo is off by default; set the environment variable ARNIE_MEMO=1 to turn it on for every process.
+
+    Args:
+        max_entries (int): maximum number of results kept
+        max_bytes (int): maximum total size of the results kept
+
+    Returns:
+        MemoCache
+    '''
+    global _memo, _memo_checked
+    _memo = MemoCache(max_entries=max_entries, max_bytes=max_bytes)
+    _memo_checked = True
+    return _memo
+
+
+def disable_memo():
+    global _memo, _memo_checked
+    _memo = None
+    _memo_checked = True
+
+
+def get_memo():
+    '''The active MemoCache, or None if memoization is off.'''
+    if not _memo_checked:
+        if os.environ.get('ARNIE_MEMO', '0').lower() in ['1', 'true', 'yes', 'on']:
+            enable_memo()
+        else:
+            disable_memo()
+    return _memo
+
+
+def clear_memo():
+    memo = get_memo()
+    if memo is not None:
+        memo.clear()
+
+
+@contextmanager
+def memo(enabled=True, max_entries=DEFAULT_MEMO_ENTRIES, max_bytes=DEFAULT_MEMO_BYTES, clear=False):
+    '''Turn the in-memory memo on (with a fresh, empty memo) or off for the duration of the block.
+
+        with memo(max_entries=10000) as m:
+            for seq in designs:
+                mfe(seq)
+        print(m.stats())
+
+        with memo(False):
+            bpps(seq)   # always runs the package
+
+    Args:
+        enabled (bool): memoize inside the block or not
+        max_entries (int), max_bytes (int): budget of the memo used inside the block
+        clear (bool): instead of a fresh memo, clear and keep using the current one
+    '''
+    global _memo
+    previous = get_memo()
+    if not enabled:
+        disable_memo()
+    elif clear and previous is not None:
+        previous.clear()
+    else:
+        enable_memo(max_entries=max_entries, max_bytes=max_bytes)
+    try:
+        yield _memo
+    finally:
+        _memo = previous
+
+
+def cached(name, skip=()):
+    '''Decorator putting a folding function behind the in-memory memo and the disk cache.
+
+    Args:
+        name (str): name used in the key
+        skip (list): arguments for which a truthy value means the result can't be cached
+            (e.g. pfunc(bpps=True) returns a path to a temporary file)
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            memo, cache = get_memo(), get_disk_cache()
+            if memo is None and cache is None:
+                return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+            if arguments.get('DEBUG') or arguments.get('kwargs', {}).get('DEBUG') \
+                    or any(arguments.get(arg) for arg in skip):
+                return func(*args, **kwargs)
+
+            try:
+                key = make_key(name, arguments)
+            except (TypeError, OSError) as e:
+                print('WARNING: could not make a cache key for %s, running it uncached: %s' % (name, e))
+                return func(*args, **kwargs)
+
+            if memo is not None:
+                hit, value = memo.get(key)
+                if hit:
+                    return value
+
+            if cache is not None:
+                hit, value = cache.get(key)
+                if hit:
+                    if memo is not None:
+                        memo.put(key, value)
+                    return value
+
+            value = func(*args, **kwargs)
+            if cache is not None:
+                try:
+                    cache.put(key, value)
+                except (TypeError, OSError) as e:
+                    print('WARNING: could not cache %s result: %s' % (name, e))
+            if memo is not None:
+                memo.put(key, value)
+            return value
+
+        return wrapper
+    return decorator
+
+
+def cached_batch(name, single, per_item=('constraint',)):
+    '''Decorator putting the batch version of a cached function behind the same memo and disk cache.
+
+    Each sequence is looked up under the key of the corresponding single call (e.g. `pfunc_batch` shares
+    entries with `pfunc`), only the misses go to the batch function, and their results are stored.
+
+    Args:
+        name (str): name used in the key, as for the single function
+        single (callable): the single-sequence function, whose first argument is the sequence
+        per_item (list): batch arguments that hold one value per sequence (or None)
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+        single_signature = inspect.signature(single)
+        seq_arg = next(iter(single_signature.parameters))
+
+        @functools.wraps(func)
+        def wrapper(seqs, *args, **kwargs):
+            memo, cache = get_memo(), get_disk_cache()
+            if memo is None and cache is None:
+                return func(seqs, *args, **kwargs)
+
+            bound = signature.bind(seqs, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            extra = arguments.pop('kwargs', {})
+            if arguments.get('DEBUG') or extra.get('DEBUG'):
+                return func(seqs, *args, **kwargs)
+
+            # arguments of the equivalent single call, without the batch-only ones (jobs, batch_size, ...)
+            shared = {k: v for k, v in arguments.items()
+                if k in single_signature.parameters and k not in per_item and k != seq_arg}
+            shared.update(extra)
+
+            seqs = list(seqs)
+            keys, values, misses = [], [None]*len(seqs), []
+            for i, seq in enumerate(seqs):
+                call = dict(shared, **{arg: arguments[arg][i] for arg in per_item if arguments.get(arg) is not None})
+                try:
+                    single_bound = single_signature.bind(seq, **call)
+                    single_bound.apply_defaults()
+                    keys.append(make_key(name, single_bound.arguments))
+                except (TypeError, OSError) as e:
+                    print('WARNING: could not make a cache key for %s, running it uncached: %s' % (name, e))
+                    return func(seqs, *args, **kwargs)
+
+                if memo is not None:
+                    hit, value = memo.get(keys[i])
+                    if hit:
+                        values[i] = value
+                        continue
+                if cache is not None:
+                    hit, value = cache.get(keys[i])
+                    if hit:
+                        if memo is not None:
+                            memo.put(keys[i], value)
+                        values[i] = value
+                        continue
+                misses.append(i)
+
+            if not misses:
+                return values
+
+            bound.arguments[next(iter(signature.parameters))] = [seqs[i] for i in misses]
+            for arg in per_item:
+                if arguments.get(arg) is not None:
+                    bound.arguments[arg] = [arguments[arg][i] for i in misses]
+
+            for i, value in zip(misses, func(*bound.args, **bound.kwargs)):
+                key = keys[i]
+                values[i] = value
+                if cache is not None:
+                    try:
+                        cache.put(key, value)
+                    except (TypeError, OSError) as e:
+                        print('WARNING: could not cache %s result: %s' % (name, e))
+                if memo is not None:
+                    memo.put(key, value)
+            return values
+
+        return wrapper
+    return decorator
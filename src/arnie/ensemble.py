@@ -0,0 +1,383 @@
+import os, re, sys
+import subprocess as sp
+import numpy as np
+import scipy.sparse
+from .utils import *
+from .pfunc import pfunc, pfunc_batch, cutoff_arg_, log_Z_, Z_kT_, Z_from_log_Z_, rnafold_supports_jobs_
+from .bpps import bpps, bpps_batch, vienna_dot_plot_pairs_
+from .mfe import mfe
+from .free_energy import free_energy
+from .mea.mea import MEA
+from .rnastructure import RNAstructurePartition
+from .rnalib import use_rnalib_, ensemble_rnalib_
+
+ENSEMBLE_QUANTITIES = ('Z', 'bpps', 'mfe', 'mea', 'centroid', 'punp')
+
+# quantities that need base pair probabilities (not just Z) from the package
+_BPP_QUANTITIES = {'bpps', 'mea', 'centroid', 'punp'}
+
+
+class EnsembleResult:
+    '''Ensemble quantities for one sequence, as returned by `fold_ensemble`.
+
+    Attributes are computed on first access and then kept: package output is parsed, and MEA,
+    centroid and unpaired probabilities are derived from the bpps, only when read. Anything the
+    package run didn't provide (because it wasn't in `want`, or the package can't give it in the
+    same run) is computed with a separate `pfunc`/`bpps`/`mfe` call when first read.
+
+    Attributes:
+        Z (float): partition function
+        log_Z (float): natural log of Z, which doesn't overflow for long sequences
+        free_energy (float): ensemble free energy
+        bpps (array): NxN base pair probabilities (scipy.sparse.csr_matrix if sparse=True)
+        mfe (str): MFE structure (Viterbi structure for contrafold/eternafold)
+        dG_MFE (float): free energy of the MFE structure
+        mea (str): maximum expected accuracy structure (gamma=1)
+        centroid (str): centroid structure, pairs with probability > 0.5
+        punp (array): probability of each nucleotide being unpaired
+    '''
+
+    def __init__(self, seq, package='vienna_2', sparse=False, bpp_cutoff=None, **kwargs):
+        self.seq = seq
+        self.package = package
+        self.sparse = sparse
+        self.bpp_cutoff = bpp_cutoff
+        self._kwargs = kwargs
+        self._values = {}
+        self._loaders = {}
+
+    def _get(self, name):
+        if name not in self._values:
+            loader = self._loaders.get(name, getattr(self, '_compute_%s' % name))
+            self._values[name] = loader()
+        return self._values[name]
+
+    Z = property(lambda self: self._get('Z'))
+    log_Z = property(lambda self: self._get('log_Z'))
+    free_energy = property(lambda self: self._get('free_energy'))
+    bpps = property(lambda self: self._get('bpps'))
+    mfe = property(lambda self: self._get('mfe'))
+    dG_MFE = property(lambda self: self._get('dG_MFE'))
+    mea = property(lambda self: self._get('mea'))
+    centroid = property(lambda self: self._get('centroid'))
+    punp = property(lambda self: self._get('punp'))
+
+    def as_dict(self, names=ENSEMBLE_QUANTITIES):
+        '''{name: value} for `names`, computing any that are missing'''
+        return {name: getattr(self, name) for name in names}
+
+    def __repr__(self):
+        return '<EnsembleResult %s, %d nt, computed: %s>' % (self.package, len(self.seq),
+            ', '.join(sorted(self._values)) or 'none')
+
+    # used for anything the package run didn't provide
+
+    def _compute_Z(self):
+        return Z_from_log_Z_(self.log_Z, self.package, T=self._kwargs.get('T', 37), linear=self._kwargs.get('linear', False))
+
+    def _compute_log_Z(self):
+        return pfunc(self.seq, package=self.package, return_log_Z=True, **self._kwargs)
+
+    def _compute_free_energy(self):
+        return pfunc(self.seq, package=self.package, return_free_energy=True, **self._kwargs)
+
+    def _compute_bpps(self):
+        return bpps(self.seq, package=self.package, sparse=self.sparse, bpp_cutoff=self.bpp_cutoff, **self._kwargs)
+
+    def _compute_mfe(self):
+        kwargs = {k: v for k, v in self._kwargs.items() if k != 'DEBUG'}
+        pkg = self.package.lower().split('_')[0]
+        return mfe(self.seq, package=self.package, viterbi=pkg in ['contrafold', 'eternafold'], **kwargs)
+
+    def _compute_dG_MFE(self):
+        return free_energy(self.seq, constraint=self.mfe, package=self.package, ensemble=False, T=self._kwargs.get('T', 37))
+
+    def _compute_mea(self):
+        return MEA(self.bpps).structure
+
+    def _compute_centroid(self):
+        upper = scipy.sparse.triu(self.bpps, k=1, format='coo')
+        paired = upper.data > 0.5
+        return convert_bp_list_to_dotbracket(list(zip(upper.row[paired], upper.col[paired])), len(self.seq))
+
+    def _compute_punp(self):
+        return 1 - np.asarray(self.bpps.sum(axis=0)).ravel()
+
+
+@in_scratch_dir
+def fold_ensemble(seq, package='vienna_2', want=None, T=37, constraint=None, dangles=True, param_file=None,
+        reweight=None, linear=False, bpp_cutoff=None, sparse=False, threads=None, DEBUG=False):
+    ''' Compute several ensemble quantities for RNA sequence from as few package runs as possible.
+
+    For vienna (version 2), a single `RNAfold -p --MEA` run gives the MFE structure and energy,
+    ensemble free energy, centroid, MEA structure and dot plot (or one fold compound does, with the
+    rnalib engine, see `rnalib.set_vienna_engine`). For rnastructure, Z, bpps and the MEA
+    structure (MaxExpect) come from one partition function (see `RNAstructurePartition`). For other
+    packages, one `bpps` run gives bpps, MEA, centroid and punp, while Z and the MFE structure need their own runs.
+
+        Args:
+        seq (str): nucleic acid sequence
+        package (str): as in `bpps`
+        want (iterable): quantities to compute now, from 'Z' (with log_Z), 'bpps', 'mfe', 'mea', 'centroid', 'punp'
+            (default: all). Others are still available from the result, at the cost of extra runs.
+        sparse (bool): return bpps as a scipy.sparse CSR matrix
+        bpp_cutoff (float): drop pairs with probability below this, as in `bpps`
+        threads (int): threads for RNAstructure's SMP programs, as in `pfunc`
+        other arguments as in `pfunc`
+
+    Returns
+        EnsembleResult: lazily evaluated result, e.g. `res.Z`, `res.bpps`, `res.mfe`, `res.mea`
+    '''
+    want = set(ENSEMBLE_QUANTITIES if want is None else want)
+    unknown = want - set(ENSEMBLE_QUANTITIES)
+    if unknown:
+        raise ValueError('Unknown ensemble quantities %s, choose from %s' % (sorted(unknown), ENSEMBLE_QUANTITIES))
+
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    result = EnsembleResult(seq, package=package, sparse=sparse, bpp_cutoff=bpp_cutoff, T=T, constraint=constraint,
+        dangles=dangles, param_file=param_file, reweight=reweight, linear=linear, threads=threads, DEBUG=DEBUG)
+
+    if pkg == 'vienna' and not linear and use_rnalib_(version=version, param_file=param_file):
+        add_rnalib_output_(result, ensemble_rnalib_(seq, want, T=T, constraint=constraint, dangles=dangles,
+            reweight=reweight, sparse=sparse, bpp_cutoff=bpp_cutoff, DEBUG=DEBUG), T=T)
+
+    elif pkg == 'vienna' and (version is None or version.startswith('2')) and not linear:
+        stdout, dot_plot = fold_ensemble_vienna_(seq, want, T=T, constraint=constraint, dangles=dangles,
+            param_file=param_file, reweight=reweight, bpp_cutoff=bpp_cutoff, DEBUG=DEBUG)
+        add_vienna_output_(result, stdout, dot_plot, T=T)
+
+    elif pkg == 'rnastructure' and not linear and want & (_BPP_QUANTITIES | {'Z'}):
+        # everything but the MFE structure comes from one partition save file
+        with RNAstructurePartition(seq, T=T, constraint=constraint, threads=threads, DEBUG=DEBUG) as pf:
+            if 'Z' in want:
+                result._values['free_energy'] = pf.free_energy
+                result._values['log_Z'] = pf.log_Z
+            if want & _BPP_QUANTITIES:
+                result._values['bpps'] = pf.bpps(sparse=sparse, bpp_cutoff=bpp_cutoff)
+            if 'mea' in want:
+                result._values['mea'] = pf.mea()
+        if 'mfe' in want:
+            result.mfe
+
+    else:
+        if want & _BPP_QUANTITIES:
+            result.bpps
+        if 'Z' in want:
+            result.log_Z
+        if 'mfe' in want:
+            result.mfe
+
+    return result
+
+
+@in_scratch_dir
+def fold_ensemble_batch(seqs, package='vienna_2', want=None, T=37, constraint=None, dangles=True, param_file=None,
+        reweight=None, linear=False, bpp_cutoff=None, sparse=False, threads=None, jobs=None, DEBUG=False):
+    ''' Compute several ensemble quantities for many RNA sequences, sharing package invocations.
+
+    For vienna (version 2), all sequences go through one `RNAfold -p --MEA` run as a FASTA batch
+    (multithreaded with --jobs if the RNAfold binary supports it), or one fold compound each with the
+    rnalib engine. For contrafold, eternafold and linear=True, bpps and Z come from `bpps_batch` and
+    `pfunc_batch`. Other packages run `fold_ensemble` on each sequence.
+
+        Args:
+        seqs (list): nucleic acid sequences
+        package (str): as in `fold_ensemble`
+        want (iterable): quantities to compute now, as in `fold_ensemble`
+        constraint (list): structure constraints, one per sequence (or None)
+        jobs (int): number of RNAfold threads, as in `pfunc_batch`
+        other arguments as in `fold_ensemble`
+
+    Returns
+        list of EnsembleResult: one per sequence, in input order
+    '''
+    want = set(ENSEMBLE_QUANTITIES if want is None else want)
+    unknown = want - set(ENSEMBLE_QUANTITIES)
+    if unknown:
+        raise ValueError('Unknown ensemble quantities %s, choose from %s' % (sorted(unknown), ENSEMBLE_QUANTITIES))
+
+    if constraint is not None and len(constraint) != len(seqs):
+        raise ValueError('Need one constraint per sequence for batch mode.')
+
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    options = dict(T=T, dangles=dangles, param_file=param_file, reweight=reweight, linear=linear, DEBUG=DEBUG)
+    results = [EnsembleResult(seq, package=package, sparse=sparse, bpp_cutoff=bpp_cutoff, threads=threads,
+        constraint=None if constraint is None else constraint[i], **options) for i, seq in enumerate(seqs)]
+
+    if pkg == 'vienna' and (version is None or version.startswith('2')) and not linear \
+            and not use_rnalib_(version=version, param_file=param_file):
+        outputs = fold_ensemble_vienna_batch_(seqs, want, T=T, constraints=constraint, dangles=dangles,
+            param_file=param_file, reweight=reweight, bpp_cutoff=bpp_cutoff, jobs=jobs, DEBUG=DEBUG)
+        for result, (stdout, dot_plot) in zip(results, outputs):
+            add_vienna_output_(result, stdout, dot_plot, T=T)
+
+    elif pkg in ['contrafold', 'eternafold'] or linear:
+        if want & _BPP_QUANTITIES:
+            bpps_list = bpps_batch(seqs, package=package, constraint=constraint, sparse=sparse, bpp_cutoff=bpp_cutoff,
+                jobs=jobs, **options)
+            for result, bpp in zip(results, bpps_list):
+                result._values['bpps'] = bpp
+        if 'Z' in want:
+            for result, log_Z in zip(results, pfunc_batch(seqs, package=package, constraint=constraint,
+                    return_log_Z=True, jobs=jobs, **options)):
+                result._values['log_Z'] = log_Z
+        if 'mfe' in want:
+            for result in results:
+                result.mfe
+
+    else:
+        results = [fold_ensemble(seq, package=package, want=want, constraint=None if constraint is None else constraint[i],
+            bpp_cutoff=bpp_cutoff, sparse=sparse, threads=threads, **options) for i, seq in enumerate(seqs)]
+
+    return results
+
+
+def fold_ensemble_vienna_(seq, want, T=37, constraint=None, **kwargs):
+    """run RNAfold once for everything in `want`
+
+    Returns
+        str, str: RNAfold stdout, dot plot contents (None if bpps weren't computed)
+    """
+    return fold_ensemble_vienna_batch_([seq], want, T=T,
+        constraints=None if constraint is None else [constraint], **kwargs)[0]
+
+
+def fold_ensemble_vienna_batch_(seqs, want, T=37, constraints=None, dangles=True, param_file=None, reweight=None,
+        bpp_cutoff=None, jobs=None, DEBUG=False):
+    """run RNAfold once on a FASTA batch, for everything in `want`
+
+    Args:
+        constraints (list): structure constraints, one per sequence (or None)
+        jobs (int): number of RNAfold threads (None: `thread_budget()`, if --jobs is supported)
+
+    Returns
+        list of (str, str): RNAfold output and dot plot contents (None if bpps weren't computed) for each sequence
+    """
+    LOC = package_locs['vienna_2']
+    command = ['%s/RNAfold' % LOC, '-T', str(T), '--noPS']
+
+    if want & _BPP_QUANTITIES:
+        command.extend(['-p', '--bppmThreshold=%s' % cutoff_arg_(bpp_cutoff)])
+        if 'mea' in want:
+            command.append('--MEA')
+    elif 'Z' in want:
+        command.append('-p0')
+
+    if len(seqs) > 1 and jobs != 1 and rnafold_supports_jobs_(LOC):
+        command.append('--jobs=%d' % (thread_budget() if jobs is None else jobs))
+
+    # each record gets a FASTA header, so that RNAfold names its dot plot <id>_dp.ps
+    batch_id = local_rand_filename()
+    record_ids = ['%s_%04d' % (batch_id, i+1) for i in range(len(seqs))]
+
+    lines = []
+    for i, (record_id, seq) in enumerate(zip(record_ids, seqs)):
+        lines.extend(['>%s' % record_id, seq])
+        if constraints is not None:
+            lines.append(constraints[i])
+    fname = write(lines)
+
+    if constraints is not None:
+        command.extend(['-C', '--enforceConstraint'])
+
+    if not dangles:
+        command.append('--dangles=0')
+
+    if reweight is not None:
+        command.append('--commands=%s' % reweight)
+
+    if param_file:
+        command.append('--paramFile=%s' % param_file)
+
+    with open(fname) as f:
+        if DEBUG: print(' '.join(command))
+        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
+    stdout, stderr = p.communicate()
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    if p.returncode:
+        raise Exception('RNAfold failed: on %s\n%s' % (seqs[0] if len(seqs) == 1 else 'batch of %d sequences' % len(seqs), stderr))
+    os.remove(fname)
+
+    dot_plots = {}
+    for record_id in record_ids:
+        for suffix in ['ss', 'dp']:
+            ps_file = scratch_path('%s_%s.ps' % (record_id, suffix))
+            if os.path.exists(ps_file):
+                if suffix == 'dp':
+                    with open(ps_file) as f:
+                        dot_plots[record_id] = f.read()
+                os.remove(ps_file)
+    for ps_file in ['rna.ps', 'dot.ps']:
+        if os.path.exists(scratch_path(ps_file)):
+            os.remove(scratch_path(ps_file))
+
+    if 'omitting constraint' in stderr.decode('utf-8'):
+        raise ValueError('Constraint caused impossible structure')
+
+    # split output on FASTA headers, records come back in input order
+    records = {}
+    for chunk in stdout.decode('utf-8').split('>')[1:]:
+        header, _, body = chunk.partition('\n')
+        records[header.split()[0]] = body
+
+    results = []
+    for record_id, seq in zip(record_ids, seqs):
+        if record_id not in records:
+            raise Exception('RNAfold failed: no output for %s' % seq)
+        results.append((records[record_id], dot_plots.get(record_id)))
+    return results
+
+
+_vienna_mfe = re.compile(r'^(\S+)\s+\(\s*(-?\d+\.\d+)\)\s*$', re.M)
+_vienna_ensemble = re.compile(r'^\S+\s+\[\s*(-?\d+\.\d+)\]|free energy of ensemble\s*=\s*(-?\d+\.\d+)', re.M)
+_vienna_centroid = re.compile(r'^(\S+)\s+\{\s*-?\d+\.\d+\s+d=', re.M)
+_vienna_mea = re.compile(r'^(\S+)\s+\{\s*-?\d+\.\d+\s+MEA=', re.M)
+
+
+def add_vienna_output_(result, stdout, dot_plot=None, T=37):
+    '''register loaders on `result` that parse whatever this RNAfold output contains'''
+    loaders = result._loaders
+
+    m = _vienna_mfe.search(stdout)
+    if m:
+        loaders['mfe'] = lambda: m.group(1)
+        loaders['dG_MFE'] = lambda: float(m.group(2))
+
+    e = _vienna_ensemble.search(stdout)
+    if e:
+        loaders['free_energy'] = lambda: float(e.group(1) or e.group(2))
+        loaders['log_Z'] = lambda: log_Z_(result.free_energy, 'vienna', T=T)
+        loaders['Z'] = lambda: np.exp(-1*result.free_energy/Z_kT_('vienna', T))
+
+    c = _vienna_centroid.search(stdout)
+    if c:
+        loaders['centroid'] = lambda: c.group(1)
+
+    mea = _vienna_mea.search(stdout)
+    if mea:
+        loaders['mea'] = lambda: mea.group(1)
+
+    if dot_plot is not None:
+        loaders['bpps'] = lambda: bpp_matrix_from_pairs(*vienna_dot_plot_pairs_(dot_plot), len(result.seq),
+            sparse=result.sparse, cutoff=result.bpp_cutoff)
+
+
+def add_rnalib_output_(result, values, T=37):
+    '''store the quantities from `ensemble_rnalib_` on `result`'''
+    result._values.update(values)
+    if 'free_energy' in values:
+        result._values['Z'] = np.exp(-1*values['free_energy']/Z_kT_('vienna', T))
@@ -3,13 +3,13 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
+from .cache import cached
 from .pfunc import pfunc
 
 DEBUG=False
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
+@cached('free_energy')
+@in_scratch_dir
 def free_energy(seq, constraint=None, package='vienna_2', T=37, coaxial=True, dna=False, beam_size=100,
 		 pseudo=False, dangles=True, reweight=None, ensemble=True, param_file=None, linear=False,DEBUG=False):
 	''' Compute free energy of RNA sequence. If structure is given, computes free energy of that structure. 
@@ -53,3 +53,22 @@ def free_energy(seq, constraint=None, package='vienna_2', T=37, coaxial=True, dn
 	# 	return -1* np.log(Z_constrained) # .00198 is k in kcal/mol #0.0019899*(273+T) * 
 	# else:
 	# 	raise RuntimeError("%s `free_energy` not implemented yet" % package)
+
+
+def structure_probability(seq, structure, package='vienna_2', T=37, **kwargs):
+	''' Probability of one structure in the ensemble, P = Z(structure)/Z.
+
+		Computed from log Z (see `pfunc(..., return_log_Z=True)`), so it doesn't overflow for long sequences.
+
+		Args:
+		seq (str): nucleic acid sequence
+		structure (str): structure in dot bracket notation
+		package (str), T (float): as in `pfunc`
+		kwargs: other options passed to `pfunc`, e.g. dangles, param_file
+
+	Returns
+		float: probability of the structure
+	'''
+	log_Z = pfunc(seq, package=package, T=T, return_log_Z=True, **kwargs)
+	log_Z_structure = pfunc(seq, package=package, T=T, constraint=structure.replace('.','x'), return_log_Z=True, **kwargs)
+	return np.exp(log_Z_structure - log_Z)
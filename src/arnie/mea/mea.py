@@ -1,23 +1,54 @@
 import numpy as np
+import scipy.sparse
 import argparse, sys
 from arnie.mea.mea_utils import *
 from copy import copy
 
+# number of multiloop options summed at once by fill_dp_
+_BLOCK_SIZE = 2**16
+
 class MEA:
-    def __init__(self, bpps, gamma = 1.0, debug=False, run_probknot_heuristic = False, theta=0, stochastic=False):
+    def __init__(self, bpps, gamma = 1.0, debug=False, run_probknot_heuristic = False, theta=0, stochastic=False, vectorized=True, dp=None, bpp_cutoff=None, max_bp_span=None):
+        '''Maximum expected accuracy structure from a base pair probability matrix.
+
+        Args:
+            bpps (array): NxN base pair probabilities (numpy array or scipy.sparse matrix)
+            gamma (float): weight of paired over unpaired accuracy
+            run_probknot_heuristic (bool): ProbKnot/ThreshKnot structure (with cutoff theta) instead of MEA
+            stochastic (bool): pick DP options at random, weighted by their scores
+            vectorized (bool): fill the DP one diagonal at a time with NumPy (default). False fills it
+                one cell at a time, as older versions did; both give the same structure.
+            dp (tuple): (W, tb) already filled for this gamma, e.g. by `mea_gamma_sweep`
+            bpp_cutoff (float): only consider pairs with probability above this (see `fill_sparse_dp_`).
+                dp_stats reports how much of the DP was pruned.
+            max_bp_span (int): only consider pairs i, j with j - i <= max_bp_span (see `fill_band_dp_`).
+                W and tb then only hold the band, W[i, d] being the weight of i..i+d.
+
+        With bpp_cutoff or max_bp_span, a scipy.sparse bpps matrix stays sparse, and so does MEA_bp_matrix.
+        '''
         self.debug = debug
+        if stochastic and max_bp_span is not None:
+            raise ValueError('max_bp_span is not supported for stochastic MEA')
+        if scipy.sparse.issparse(bpps) and (bpp_cutoff is None and max_bp_span is None
+                or stochastic or run_probknot_heuristic):
+            bpps = bpps.toarray()
         self.bpps = bpps
         self.N=self.bpps.shape[0]
         self.gamma = gamma
         self.theta = theta
-        self.W = np.zeros([self.N,self.N])
+        self.W = None
         self.MEA_bp_list = []
         self.structure = ['.']*self.N
-        self.MEA_bp_matrix = np.zeros([self.N, self.N])
-        self.tb = np.zeros([self.N, self.N])
+        self.MEA_bp_matrix = None
+        self.tb = None
         self.min_hp_length = 3
         self.evaluated = False
         self.stochastic = stochastic
+        self.vectorized = vectorized
+        self.dp = dp
+        self.bpp_cutoff = bpp_cutoff
+        self.max_bp_span = max_bp_span
+        self.dp_stats = None
 
         if run_probknot_heuristic:
             self.run_ProbKnot()
@@ -41,18 +72,46 @@ class MEA:
             np.max([self.W[i,k] + self.W[k+1, j] for k in range(i+1,j)])]
             self.W[i,j] = np.max(options) 
             self.tb[i,j] = np.argmax(options) #0: 5' pass, 1: 3' pass, 2: bp, 3: multiloop
-            
+
     def run_MEA(self):
         # fill weight matrix
-        for length in range(self.min_hp_length, self.N):
-            for i in range(self.N-length):
-                j = i + length
-                self.fill_W(i,j)
-                
-        self.traceback(0,self.N-1)
-        
+        if self.dp is not None:
+            self.W, self.tb = self.dp
+        elif self.bpp_cutoff is not None and not self.stochastic:
+            self.W, self.tb, self.dp_stats = fill_sparse_dp_(self.bpps, self.gamma, bpp_cutoff=self.bpp_cutoff,
+                min_hp_length=self.min_hp_length, max_bp_span=self.max_bp_span)
+        elif self.max_bp_span is not None:
+            W, tb = fill_band_dp_(self.bpps, [self.gamma], self.max_bp_span, min_hp_length=self.min_hp_length)
+            self.W, self.tb = W[0], tb[0]
+        elif self.vectorized and not self.stochastic:
+            W, tb = fill_dp_(self.bpps, [self.gamma], min_hp_length=self.min_hp_length)
+            self.W, self.tb = W[0], tb[0]
+        else:
+            self.W = np.zeros([self.N,self.N])
+            self.tb = np.zeros([self.N, self.N])
+            for length in range(self.min_hp_length, self.N):
+                for i in range(self.N-length):
+                    j = i + length
+                    self.fill_W(i,j)
+
+        if self.dp_stats is not None:
+            for i, j in band_segments_(self.W):
+                self.sparse_traceback(i, j)
+        elif self.max_bp_span is not None:
+            for i, j in band_segments_(self.W):
+                self.band_traceback(i, j)
+        else:
+            self.traceback(0,self.N-1)
+
+        if scipy.sparse.issparse(self.bpps):
+            pairs = np.array(self.MEA_bp_list, dtype=int).reshape(-1, 2)
+            self.MEA_bp_matrix = scipy.sparse.csr_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                shape=(self.N, self.N))
+        else:
+            self.MEA_bp_matrix = np.zeros([self.N, self.N])
         for x in self.MEA_bp_list:
-            self.MEA_bp_matrix[x[0],x[1]]=1
+            if not scipy.sparse.issparse(self.MEA_bp_matrix):
+                self.MEA_bp_matrix[x[0],x[1]]=1
             self.structure[x[0]]='('
             self.structure[x[1]]=')'
         
@@ -87,25 +146,69 @@ class MEA:
         if not self.evaluated: self.evaluated = True
 
     def traceback(self, i, j):
-        if j <= i:
-            return
-        elif self.tb[i,j] == 0: #5' neighbor
-            if self.debug: print(i,j, "5'")
-            self.traceback(i+1,j)
-        elif self.tb[i,j] == 1: #3' neighbor
-            if self.debug: print(i,j, "3'")
-            self.traceback(i,j-1)
-        elif self.tb[i,j] == 2: # base pair
-            if self.debug: print(i,j,'bp')
-            self.MEA_bp_list.append((i,j))
-            self.traceback(i+1,j-1)
-        else: #multiloop
-            for k in range(i+1,j):
-                if self.W[i,j] == self.W[i, k] + self.W[k+1,j]:
-                    if self.debug: print(i,j,"multiloop, k=",k)
-                    self.traceback(i,k)
-                    self.traceback(k+1,j)
-                    break
+        # explicit stack instead of recursion, so long sequences don't hit the recursion limit;
+        # the 5' side of a multiloop split is popped (and fully traced) first, as in a recursive traceback
+        stack = [(i, j)]
+        while stack:
+            i, j = stack.pop()
+            if j <= i:
+                continue
+            elif self.tb[i,j] == 0: #5' neighbor
+                if self.debug: print(i,j, "5'")
+                stack.append((i+1,j))
+            elif self.tb[i,j] == 1: #3' neighbor
+                if self.debug: print(i,j, "3'")
+                stack.append((i,j-1))
+            elif self.tb[i,j] == 2: # base pair
+                if self.debug: print(i,j,'bp')
+                self.MEA_bp_list.append((i,j))
+                stack.append((i+1,j-1))
+            else: #multiloop
+                # first k with W[i,j] == W[i,k] + W[k+1,j]
+                k = i + 1 + np.flatnonzero(self.W[i, i+1:j] + self.W[i+2:j+1, j] == self.W[i,j])[0]
+                if self.debug: print(i,j,"multiloop, k=",k)
+                stack.append((k+1,j))
+                stack.append((i,k))
+
+    def band_traceback(self, i, j):
+        # as traceback, with W and tb stored as a band: W[i, d] is the weight of i..i+d
+        stack = [(i, j)]
+        while stack:
+            i, j = stack.pop()
+            if j <= i:
+                continue
+            d = j - i
+            if self.tb[i,d] == 0: #5' neighbor
+                stack.append((i+1,j))
+            elif self.tb[i,d] == 1: #3' neighbor
+                stack.append((i,j-1))
+            elif self.tb[i,d] == 2: # base pair
+                if self.debug: print(i,j,'bp')
+                self.MEA_bp_list.append((i,j))
+                stack.append((i+1,j-1))
+            else: #multiloop
+                # first k with W[i,j] == W[i,k] + W[k+1,j]
+                rows = np.arange(i+2, j+1)
+                k = i + 1 + np.flatnonzero(self.W[i, 1:d] + self.W[rows, j - rows] == self.W[i,d])[0]
+                if self.debug: print(i,j,"multiloop, k=",k)
+                stack.append((k+1,j))
+                stack.append((i,k))
+
+    def sparse_traceback(self, i, j):
+        # tb[i, j-i] is the partner of i in the best structure on i..j, or -1 if i is unpaired
+        stack = [(i, j)]
+        while stack:
+            i, j = stack.pop()
+            if j <= i:
+                continue
+            k = self.tb[i,j-i]
+            if k < 0:
+                stack.append((i+1,j))
+            else:
+                if self.debug: print(i,k,'bp')
+                self.MEA_bp_list.append((i,k))
+                stack.append((k+1,j))
+                stack.append((i+1,k-1))
 
     def score_expected(self):
         '''Compute expected values of TP, FP, etc from predicted MEA structure.
@@ -119,15 +222,25 @@ class MEA:
             else:
                 self.run_MEA()
 
-        pred_m = self.MEA_bp_matrix[np.triu_indices(self.N)]
-        probs = self.bpps[np.triu_indices(self.N)]
+        if scipy.sparse.issparse(self.bpps):
+            # from the predicted pairs and the stored bpps, without NxN arrays
+            pairs = np.array(self.MEA_bp_list, dtype=int).reshape(-1, 2)
+            pred_probs = np.asarray(self.bpps[pairs[:, 0], pairs[:, 1]]).ravel() if len(pairs) else np.zeros(0)
+            total = scipy.sparse.triu(self.bpps).sum()
 
-        TP = np.sum(np.multiply(pred_m, probs)) + 1e-6
-        TN = 0.5*self.N*self.N-1 - np.sum(pred_m) - np.sum(probs) + TP + 1e-6
-        FP = np.sum(np.multiply(pred_m, 1-probs)) + 1e-6
-        FN = np.sum(np.multiply(1-pred_m, probs)) + 1e-6
+            TP = np.sum(pred_probs) + 1e-6
+            TN = 0.5*self.N*self.N-1 - len(pairs) - total + TP + 1e-6
+            FP = np.sum(1-pred_probs) + 1e-6
+            FN = total - np.sum(pred_probs) + 1e-6
+        else:
+            pred_m = self.MEA_bp_matrix[np.triu_indices(self.N)]
+            probs = self.bpps[np.triu_indices(self.N)]
+
+            TP = np.sum(np.multiply(pred_m, probs)) + 1e-6
+            TN = 0.5*self.N*self.N-1 - np.sum(pred_m) - np.sum(probs) + TP + 1e-6
+            FP = np.sum(np.multiply(pred_m, 1-probs)) + 1e-6
+            FN = np.sum(np.multiply(1-pred_m, probs)) + 1e-6
 
-        a,b = np.triu_indices(self.N)
         cFP = 1e-6
         # for i in range(len(pred_m)):
         #     if np.sum(self.MEA_bp_matrix,axis=0)[a[i]] + np.sum(self.MEA_bp_matrix,axis=0)[b[i]]==0:
@@ -147,5 +260,215 @@ class MEA:
             gt_matrix = ground_truth_struct
 
         if not self.evaluated: self.run_MEA()
-        sen, ppv, mcc, fscore, _ = score_ground_truth(self.MEA_bp_matrix, gt_matrix)
+        pred_matrix = self.MEA_bp_matrix.toarray() if scipy.sparse.issparse(self.MEA_bp_matrix) else self.MEA_bp_matrix
+        sen, ppv, mcc, fscore, _ = score_ground_truth(pred_matrix, gt_matrix)
         return [sen, ppv, mcc, fscore]
+
+
+def fill_dp_(bpps, gammas, min_hp_length=3):
+    '''MEA DP for several gammas at once, one diagonal at a time, as MEA.fill_W does cell by cell
+
+    Returns
+        array, array: GxNxN weights W and traceback choices tb (0: 5' pass, 1: 3' pass, 2: bp, 3: multiloop)
+    '''
+    N = bpps.shape[0]
+    gammas = np.asarray(gammas, dtype=float).reshape(-1, 1)
+    G = len(gammas)
+    W = np.zeros([G, N, N])
+    WT = np.zeros([G, N, N]) # C-contiguous copy of each W.T
+    tb = np.zeros([G, N, N], dtype=np.int8)
+    s_g, s_i = W.strides[0], W.strides[1] + W.strides[2]
+
+    for length in range(min_hp_length, N):
+        i = np.arange(N - length)
+        j = i + length
+
+        # multiloop options W[i,k] + W[k+1,j] for k = i+1..j-1: row i of W from column i+1,
+        # and row j of W.T from column i+2, as strided views with one row per (gamma, i)
+        left = np.lib.stride_tricks.as_strided(W[:, 0, 1:], shape=(G, N - length, length - 1),
+            strides=(s_g, s_i, W.itemsize), writeable=False)
+        right = np.lib.stride_tricks.as_strided(WT[:, length, 2:], shape=(G, N - length, length - 1),
+            strides=(s_g, s_i, W.itemsize), writeable=False)
+
+        # summed a block of rows at a time, so the temporary stays in cache
+        multiloop = np.empty([G, N - length])
+        rows = max(_BLOCK_SIZE // (G*(length - 1)), 1)
+        for a in range(0, N - length, rows):
+            b = min(a + rows, N - length)
+            multiloop[:, a:b] = np.max(left[:, a:b] + right[:, a:b], axis=2)
+
+        options = np.stack([W[:, i+1, j], W[:, i, j-1],
+            (gammas+1)*bpps[i,j] + W[:, i+1, j-1] - 1,
+            multiloop])
+        W[:, i, j] = WT[:, j, i] = np.max(options, axis=0)
+        tb[:, i, j] = np.argmax(options, axis=0)
+
+    return W, tb
+
+
+def fill_band_dp_(bpps, gammas, max_bp_span, min_hp_length=3):
+    '''MEA DP for several gammas with pairs spanning at most max_bp_span, as fill_dp_ but stored as a band.
+
+    W[:, i, d] is the weight of i..i+d for d <= L = max_bp_span, so memory is O(N*L) and time O(N*L^2).
+    Longer intervals are joined by `band_segments_`. bpps can be a scipy.sparse matrix, only the band is read.
+
+    Returns
+        array, array: GxNx(L+1) weights W and traceback choices tb (as in fill_dp_)
+    '''
+    N = bpps.shape[0]
+    L = max(min(max_bp_span, N - 1), 0)
+    P = band_bpps_(bpps, L)
+    gammas = np.asarray(gammas, dtype=float).reshape(-1, 1)
+    G = len(gammas)
+    W = np.zeros([G, N, L + 1])
+    WT = np.zeros([G, N, L + 1]) # WT[:, j, d] = W[:, j-d, d], the band indexed by interval end
+    tb = np.zeros([G, N, L + 1], dtype=np.int8)
+    s_g, s_r = W.strides[0], W.strides[1]
+
+    for d in range(min_hp_length, L + 1):
+        n = N - d
+
+        # multiloop options W[i,i+m] + W[i+m+1,i+d] for m = 1..d-1: row i of W, and row i+d of WT
+        # read backwards from column d-2
+        left = W[:, :n, 1:d]
+        right = np.lib.stride_tricks.as_strided(WT[:, d, d-2:], shape=(G, n, d - 1),
+            strides=(s_g, s_r, -W.itemsize), writeable=False)
+
+        multiloop = np.empty([G, n])
+        rows = max(_BLOCK_SIZE // (G*(d - 1)), 1)
+        for a in range(0, n, rows):
+            b = min(a + rows, n)
+            multiloop[:, a:b] = np.max(left[:, a:b] + right[:, a:b], axis=2)
+
+        options = np.stack([W[:, 1:n+1, d-1], W[:, :n, d-1],
+            (gammas+1)*P[:n, d] + W[:, 1:n+1, d-2] - 1,
+            multiloop])
+        W[:, :n, d] = WT[:, d:, d] = np.max(options, axis=0)
+        tb[:, :n, d] = np.argmax(options, axis=0)
+
+    return W, tb
+
+
+def band_bpps_(bpps, L):
+    '''Nx(L+1) array of bpps[i, i+d] for d <= L'''
+    N = bpps.shape[0]
+    P = np.zeros([N, L + 1])
+    if scipy.sparse.issparse(bpps):
+        upper = scipy.sparse.triu(bpps, format='coo')
+        keep = upper.col - upper.row <= L
+        P[upper.row[keep], upper.col[keep] - upper.row[keep]] = upper.data[keep]
+    else:
+        for d in range(L + 1):
+            P[:N-d, d] = np.diagonal(bpps, d)
+    return P
+
+
+def band_segments_(W):
+    '''intervals (i, j) to trace back in a band W (W[i, d] the weight of i..i+d), best first to last.
+
+    When the band is narrower than the sequence, the structure is a run of intervals of at most L+1
+    nucleotides, chosen by a 1D DP over where each one starts.
+    '''
+    N, L = W.shape[0], W.shape[1] - 1
+    if L >= N - 1:
+        return [(0, N - 1)]
+
+    F = np.zeros(N + 1) # F[j]: best weight of 0..j-1
+    start = np.zeros(N + 1, dtype=int)
+    for j in range(1, N + 1):
+        i = np.arange(max(0, j - 1 - L), j)
+        scores = F[i] + W[i, j - 1 - i]
+        best = np.argmax(scores)
+        F[j], start[j] = scores[best], i[best]
+
+    segments, j = [], N
+    while j > 0:
+        segments.append((start[j], j - 1))
+        j = start[j]
+    return segments[::-1]
+
+
+def fill_sparse_dp_(bpps, gamma, bpp_cutoff=0, min_hp_length=3, max_bp_span=None):
+    '''MEA DP restricted to candidate pairs, one row at a time.
+
+    W[i,j] is the best of leaving i unpaired (W[i+1,j]) and pairing i with a candidate k <= j
+    ((gamma+1)*p_ik - 1 + W[i+1,k-1] + W[k+1,j]). Candidates are pairs with probability above bpp_cutoff
+    and above 1/(gamma+1): weaker pairs score below leaving both bases unpaired, so dropping them doesn't
+    change the optimum. Each row costs one vector operation per candidate instead of one per split point,
+    so the fill is O(N^2) times the number of candidates per position instead of O(N^3).
+
+    W and tb are stored as a band, W[i, d] being the weight of i..i+d. With max_bp_span = L, only
+    candidates with k - i <= L are kept and the band is L+1 wide (see `band_segments_`).
+
+    Returns
+        array, array, dict: Nx(L+1) weights W, Nx(L+1) partner of i in the best structure on i..i+d
+            (-1: i unpaired), and pruning statistics
+    '''
+    N = bpps.shape[0]
+    L = N - 1 if max_bp_span is None else min(max_bp_span, N - 1)
+    L = max(L, 0)
+    floor = max(bpp_cutoff, 1/(gamma+1))
+    if scipy.sparse.issparse(bpps):
+        upper = scipy.sparse.triu(bpps, k=min_hp_length, format='coo')
+        keep = upper.data > floor
+        rows, cols, probs = upper.row[keep], upper.col[keep], upper.data[keep]
+    else:
+        rows, cols = np.nonzero(np.triu(bpps, k=min_hp_length) > floor)
+        probs = bpps[rows, cols]
+    keep = cols - rows <= L
+    rows, cols, probs = rows[keep], cols[keep], probs[keep]
+    order = np.lexsort((cols, rows))
+    rows, cols, probs = rows[order], cols[order], probs[order]
+    starts = np.searchsorted(rows, np.arange(N+1))
+
+    W = np.zeros([N+1, L+1]) # row N is the empty interval after the last position
+    tb = np.full([N, L+1], -1, dtype=np.int32)
+    for i in range(N-1, -1, -1):
+        n = min(L, N-1-i) + 1 # intervals i..i+d that fit in the sequence
+        row, partner = np.zeros(n), tb[i, :n]
+        row[1:] = W[i+1, :n-1]
+        for k, p in zip(cols[starts[i]:starts[i+1]], probs[starts[i]:starts[i+1]]):
+            m = k - i
+            paired = np.full(n - m, (gamma+1)*p - 1 + W[i+1, m-2])
+            paired[1:] += W[k+1, :n-m-1]
+            better = paired > row[m:]
+            row[m:][better] = paired[better]
+            partner[m:][better] = k
+        W[i, :n] = row
+
+    widths = np.minimum(L, N - 1 - np.arange(N)) + 1
+    dense_ops = sum((N - length)*(length + 2) for length in range(min_hp_length, L + 1))
+    sparse_ops = int(np.sum(widths) + np.sum(widths[rows] - (cols - rows)))
+    stats = {'candidate_pairs': len(rows), 'possible_pairs': int(np.sum(np.maximum(widths - min_hp_length, 0))),
+        'operations': sparse_ops, 'dense_operations': dense_ops,
+        'pruned': 1 - sparse_ops/dense_ops if dense_ops else 0.}
+    return W[:N], tb, stats
+
+
+def mea_gamma_sweep(bpps, gammas, debug=False, bpp_cutoff=None, max_bp_span=None):
+    '''MEA structures for several gammas from one DP fill over a stacked GxNxN weight tensor.
+
+    Args:
+        bpps (array): NxN base pair probabilities (numpy array or scipy.sparse matrix)
+        gammas (list): gamma values, e.g. 2**np.arange(-7, 7)
+        bpp_cutoff (float): use the sparse DP (`fill_sparse_dp_`) for each gamma instead; its candidate
+            pairs depend on gamma, so each gamma gets its own (much cheaper) fill
+        max_bp_span (int): only consider pairs spanning at most this, filling a GxNx(max_bp_span+1) band
+            (see `fill_band_dp_`)
+
+    Returns
+        list, array: MEA for each gamma (the same structures as `MEA(bpps, gamma)`),
+            and Gx4 expected sen, ppv, mcc, F-score of each
+    '''
+    if bpp_cutoff is not None:
+        meas = [MEA(bpps, gamma=gamma, debug=debug, bpp_cutoff=bpp_cutoff, max_bp_span=max_bp_span) for gamma in gammas]
+    elif max_bp_span is not None:
+        W, tb = fill_band_dp_(bpps, gammas, max_bp_span)
+        meas = [MEA(bpps, gamma=gamma, debug=debug, dp=(W[k], tb[k]), max_bp_span=max_bp_span)
+            for k, gamma in enumerate(gammas)]
+    else:
+        if scipy.sparse.issparse(bpps):
+            bpps = bpps.toarray()
+        W, tb = fill_dp_(bpps, gammas)
+        meas = [MEA(bpps, gamma=gamma, debug=debug, dp=(W[k], tb[k])) for k, gamma in enumerate(gammas)]
+    return meas, np.array([mea.score_expected() for mea in meas])
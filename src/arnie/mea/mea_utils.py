@@ -1,5 +1,5 @@
 import numpy as np
-import argparse, sys
+import argparse, sys, os
 
 def convert_dotbracket_to_matrix(s):
     m = np.zeros([len(s),len(s)])
@@ -69,38 +69,36 @@ def load_matrix_or_dbn(s):
 
 def score_ground_truth(pred_matrix, true_matrix):
     '''Score a predicted structure against a true structure,
-     input as NxN base pair matrix (takes top triangle).'''
+     input as NxN base pair matrix (takes top triangle).
+
+    False positives between two nucleotides that are both unpaired in the true structure are
+    compatible (cFP) and don't count against ppv and mcc.
+
+    Returns
+        sen, ppv, mcc, fscore, N
+    '''
 
     N = pred_matrix.shape[0]
-    #print('pred',pred_matrix.shape, 'true', true_matrix.shape)
     assert pred_matrix.shape[1] == N
     assert true_matrix.shape[0] == N
     assert true_matrix.shape[1] == N
 
-    true = true_matrix[np.triu_indices(N)]
-    pred = pred_matrix[np.triu_indices(N)]
+    # counts over the upper triangle, as whole-matrix masks
+    upper = np.triu(np.ones([N, N], dtype=bool))
+    true_pair = (true_matrix == 1) & upper
+    true_unpair = (true_matrix == 0) & upper
+    pred_pair = pred_matrix == 1
+    pred_unpair = pred_matrix == 0
 
-    TP, FP, cFP, TN, FN = 0, 0, 0, 0, 0
+    TP = int(np.sum(true_pair & pred_pair))
+    FN = int(np.sum(true_pair & ~pred_pair))
+    TN = int(np.sum(true_unpair & pred_unpair))
+    false_pos = true_unpair & ~pred_unpair
+    FP = int(np.sum(false_pos))
 
-    for i in range(len(true)):
-        if true[i] == 1:
-            if pred[i] == 1:
-                TP += 1
-            else:
-                FN += 1
-        elif true[i] == 0:
-            if pred[i] == 0:
-                TN += 1
-            else:
-                FP += 1
-                #check for compatible false positive
-                a,b = np.triu_indices(N)
-                if np.sum(true_matrix,axis=0)[a[i]]+ np.sum(true_matrix,axis=0)[b[i]]==0:
-                   cFP +=1
-
-    # cFP = 0 #for debugging
-
-    #print('TP', TP, 'TN', TN, 'FP', FP, 'FN', FN, 'cFP', cFP)
+    #check for compatible false positives
+    col_sums = np.sum(true_matrix, axis=0)
+    cFP = int(np.sum(false_pos & (col_sums[:, None] + col_sums[None, :] == 0)))
 
     if TP + FN == 0:
         sen = 1
@@ -128,6 +126,64 @@ def score_ground_truth(pred_matrix, true_matrix):
     return sen, ppv, mcc, fscore, N
 
 
+def score_ground_truth_batch(pred_structs, true_structs, names=None, weight_by_n_bps=False, workers=None):
+    '''Score many predicted structures against their true structures with `score_ground_truth`.
+
+    The constructs are split between `workers` processes (see `arnie.parallel.map`).
+
+    Args:
+        pred_structs (list): predicted structures, as NxN base pair matrices or dot-bracket strings
+        true_structs (list): true structures, in the same order and formats
+        names (list): construct names for the table (default: 0, 1, ...)
+        weight_by_n_bps (bool): weight the aggregate scores by N, as score_pseudoacc_mea.py
+            --weight_by_n_bps. Otherwise every construct has equal weight.
+        workers (int): number of worker processes (default: number of cores, at most one per construct)
+
+    Returns
+        dict, dict: table of numpy arrays with one row per construct (name, sen, ppv, mcc, fscore, N),
+            and the aggregate sen, ppv, mcc, fscore over the constructs
+    '''
+    from arnie import parallel
+
+    pairs = list(zip(pred_structs, true_structs))
+    if len(pairs) != len(pred_structs) or len(pairs) != len(true_structs):
+        raise ValueError('Need one true structure per predicted structure.')
+    if names is None:
+        names = list(range(len(pairs)))
+
+    scores = []
+    if pairs:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(min(workers, len(pairs)), 1)
+        chunks = [[pairs[k] for k in chunk] for chunk in np.array_split(np.arange(len(pairs)), workers) if len(chunk)]
+        results = parallel.map(score_ground_truth_chunk_, chunks, workers=workers, raise_on_error=True)
+        scores = [x for chunk in results for x in chunk]
+
+    scores = np.array(scores, dtype=float).reshape(-1, 5)
+    table = {'name': np.array(names)}
+    for k, metric in enumerate(['sen', 'ppv', 'mcc', 'fscore', 'N']):
+        table[metric] = scores[:, k]
+    table['N'] = table['N'].astype(int)
+
+    weights = table['N'] if weight_by_n_bps else np.ones(len(pairs))
+    aggregate = {metric: np.sum(table[metric]*weights)/np.sum(weights) if len(pairs) else np.nan
+        for metric in ['sen', 'ppv', 'mcc', 'fscore']}
+    return table, aggregate
+
+
+def score_ground_truth_chunk_(pairs):
+    '''score_ground_truth of each (predicted, true) structure pair, for one worker'''
+    scores = []
+    for pred, true in pairs:
+        if isinstance(pred, str):
+            pred = convert_dotbracket_to_matrix(pred)
+        if isinstance(true, str):
+            true = convert_dotbracket_to_matrix(true)
+        scores.append(score_ground_truth(np.asarray(pred), np.asarray(true)))
+    return scores
+
+
 def group_into_non_conflicting_bp_(bp_list):
     ''' given a conflict list from get_list_bp_conflicts_, group basepairs into groups that do not conflict
 
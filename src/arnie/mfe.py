@@ -3,19 +3,21 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
+from .cache import cached
+from .pfunc import eternafold_locations_
+from .rnalib import use_rnalib_, mfe_rnalib_
 
 DEBUG=False
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
+@cached('mfe')
+@in_scratch_dir
 def mfe(seq, package='vienna_2', T=37,
     constraint=None, motif=None,
     linear=False, return_dG_MFE = False,
     dangles=True, noncanonical=False, beam_size=100,
     bpps=False, param_file=None, coaxial=True, reweight=None,viterbi = False,
     probing_signal=None,probing_kws=None, pseudo=False,
-    shape_signal=None, dms_signal=None, shape_file=None, dms_file=None, **kwargs):
+    shape_signal=None, dms_signal=None, shape_file=None, dms_file=None, threads=None, **kwargs):
 
     ''' Compute MFE structure (within package) for RNA sequence.
     Note: this is distinct from the arnie MEA codebase, which takes any base pair probability matrix and computes the maximum expected accuracy structure.
@@ -28,16 +30,19 @@ def mfe(seq, package='vienna_2', T=37,
         constraint (str): structure constraints
         linear (bool): call LinearFold to estimate MFE in Vienna or Contrafold
         motif (str): argument to vienna motif 
-        return_dG_MFE (bool): also return dG(MFE) (specific to linearfold)
+        return_dG_MFE (bool): also return dG(MFE) (linearfold, and vienna_2 when it runs through the Python bindings)
         dangles (bool): dangles or not, specifiable for vienna, nupack
         coaxial (bool): coaxial stacking or not, specifiable for rnastructure, vfold
         noncanonical(bool): include noncanonical pairs or not (for contrafold, RNAstructure (Cyclefold))
         shape_signal(list): list of normalized SHAPE reactivities, with negative values indicating no signal
         dms_signal(list): list of normalized DMS reactivities, with negative values indicating no signal
         pseudo: if True, will predict pseudoknots
+        threads (int): rnastructure only, run Fold-smp with this many threads if it is installed ('auto': share of the cores)
 
         Possible packages: 
         'vienna_2', 'vienna_1','contrafold_1','contrafold_2', 'rnastructure'
+        vienna_2 runs in-process through the ViennaRNA Python bindings when they are installed
+        (see `rnalib.set_vienna_engine`), otherwise through RNAfold.
         
     Returns
         string: MFE structure
@@ -75,6 +80,13 @@ def mfe(seq, package='vienna_2', T=37,
                 struct, dG_MFE = mfe_linearfold_(seq, package='vienna', return_dG_MFE=return_dG_MFE, beam_size=beam_size)
             else:
                 struct = mfe_linearfold_(seq, package='vienna', return_dG_MFE=return_dG_MFE)
+        elif use_rnalib_(version=version, motif=motif, param_file=param_file, probing_signal=probing_signal, **kwargs):
+            if return_dG_MFE:
+                struct, dG_MFE = mfe_rnalib_(seq, T=T, dangles=dangles, constraint=constraint,
+                    reweight=reweight, probing_signal=probing_signal, probing_kws=probing_kws, return_dG_MFE=True)
+            else:
+                struct = mfe_rnalib_(seq, T=T, dangles=dangles, constraint=constraint,
+                    reweight=reweight, probing_signal=probing_signal, probing_kws=probing_kws)
         else:
             struct = mfe_vienna_(seq, version=version, T=T, dangles=dangles, constraint=constraint, motif=motif, param_file=param_file,
                 reweight=reweight, probing_signal=probing_signal, **kwargs)
@@ -118,7 +130,7 @@ def mfe(seq, package='vienna_2', T=37,
             struct = mfe_rnastructure_(seq, version=version, T=T, constraint=constraint, 
                 probing_signal=probing_signal,
                 param_file=param_file, shape_signal=shape_signal, dms_signal=dms_signal, 
-                shape_file=shape_file, dms_file=dms_file, pseudo = pseudo)
+                shape_file=shape_file, dms_file=dms_file, pseudo = pseudo, threads=threads)
     else:
         raise ValueError('package %s not understood.' % package)
 
@@ -127,6 +139,61 @@ def mfe(seq, package='vienna_2', T=37,
     else:
         return struct
 
+@in_scratch_dir
+def mfe_batch(seqs, package='contrafold_2', T=37, constraint=None, param_file=None, viterbi=False,
+    linear=False, return_dG_MFE=False, beam_size=100, batch_size=1000, DEBUG=False, **kwargs):
+    ''' Compute MFE (or contrafold MEA) structures for many RNA sequences, sharing package invocations.
+
+        For contrafold and eternafold, one input file per sequence is given to a single
+        `contrafold predict` call per batch, so the parameter file is only loaded once.
+        With linear=True, all sequences are streamed through the stdin of one LinearFold process.
+        Other packages and options fall back to one `mfe` call per sequence.
+
+        Args:
+        seqs (list): nucleic acid sequences
+        constraint (list): structure constraints, one per sequence (or None)
+        batch_size (int): max number of sequences per contrafold call
+        other arguments as in `mfe`
+
+    Returns
+        list of strings: MFE structure for each sequence, in input order
+        (list of (structure, dG(MFE)) tuples if return_dG_MFE)
+    '''
+
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    if constraint is not None and len(constraint) != len(seqs):
+        raise ValueError('Need one constraint per sequence for batch mode.')
+
+    if linear and pkg in ['vienna', 'contrafold', 'eternafold'] and constraint is None:
+        struct_list = []
+        for start in range(0, len(seqs), batch_size):
+            struct_list.extend(mfe_linearfold_batch_(seqs[start:start+batch_size], package=pkg,
+                beam_size=beam_size, return_dG_MFE=return_dG_MFE, DEBUG=DEBUG))
+        return struct_list
+
+    if pkg not in ['contrafold', 'eternafold'] or linear or return_dG_MFE \
+        or kwargs.get('probing_signal') is not None:
+        return [mfe(seq, package=package, T=T, constraint=None if constraint is None else constraint[i],
+            param_file=param_file, viterbi=viterbi, linear=linear, return_dG_MFE=return_dG_MFE,
+            beam_size=beam_size, **kwargs) for i, seq in enumerate(seqs)]
+
+    if pkg == 'contrafold':
+        DIRLOC = kwargs.get('DIRLOC')
+    else:
+        DIRLOC, param_file = eternafold_locations_(param_file=param_file, DIRLOC=kwargs.get('DIRLOC'))
+
+    struct_list = []
+    for start in range(0, len(seqs), batch_size):
+        chunk_constraints = None if constraint is None else constraint[start:start+batch_size]
+        struct_list.extend(mfe_contrafold_batch_(seqs[start:start+batch_size], version=version,
+            constraints=chunk_constraints, param_file=param_file, DIRLOC=DIRLOC, viterbi=viterbi, DEBUG=DEBUG))
+
+    return struct_list
+
 def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=None, dangles=True, reweight=None,
     probing_signal=None, shapeMethod='W', probing_kws=None, **kwargs):
     """get minimum free energy structure with Vienna
@@ -152,6 +219,8 @@ def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=
     else:
         raise RuntimeError('Error, vienna version %s not present' % version)
 
+    command = ['%s/RNAfold' % LOC, '-T', str(T), '-p0'] #p0 doesn't predict bpps, saves time
+
     if constraint is not None:
         fname = write([seq, constraint])
         command.append('-C')
@@ -159,7 +228,6 @@ def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=
     else:
         fname = write([seq])
 
-    command = ['%s/RNAfold' % LOC, '-T', str(T), '-p0'] #p0 doesn't predict bpps, saves time
     if motif is not None:
         command.append('--motif=%s' % motif)
 
@@ -189,7 +257,7 @@ def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=
     with open(fname) as f:
         if DEBUG: print(fname)
         if DEBUG: print(' '.join(command))
-        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE)
+        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
     stdout, stderr = p.communicate()
 
     if DEBUG:
@@ -202,7 +270,7 @@ def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=
         raise Exception('RNAfold failed: on %s\n%s' % (seq, stderr))
     os.remove(fname)
     try:
-        os.remove('rna.ps')
+        os.remove(scratch_path('rna.ps'))
     except OSError:
         pass
 
@@ -212,7 +280,7 @@ def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=
         return stdout.decode('utf-8').split('\n')[1].split(' ')[0]
 
 def mfe_rnastructure_(seq, T=24, version=None, constraint=None, param_file=None, probing_signal=None,probing_kws=None,
-    shape_signal=None, dms_signal=None, shape_file=None, dms_file=None, pseudo=False):
+    shape_signal=None, dms_signal=None, shape_file=None, dms_file=None, pseudo=False, threads=None):
     """get minimum free energy structure
         with SHAPE or DMS data, uses the default slope and intercept in RNAStructure
 
@@ -240,9 +308,10 @@ def mfe_rnastructure_(seq, T=24, version=None, constraint=None, param_file=None,
     seq_file = write(['>sequence', seq])
     ct_fname = '%s.ct' % filename()
 
-    command = []
+    command, env = [], None
     if not pseudo:
-        command = command + ['%s/Fold' % LOC, seq_file, ct_fname, '-T', str(T + 273.15)]
+        program, env = rnastructure_program_('Fold', threads)
+        command = command + [program, seq_file, ct_fname, '-T', str(T + 273.15)]
     else:
         command = command + ['%s/ShapeKnots' % LOC, seq_file, ct_fname]
         # if dms_signal is not None:
@@ -279,7 +348,7 @@ def mfe_rnastructure_(seq, T=24, version=None, constraint=None, param_file=None,
 
     if DEBUG: print(' '.join(command))
 
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir(), env=env)
 
     stdout, stderr = p.communicate()
 
@@ -305,7 +374,7 @@ def mfe_rnastructure_(seq, T=24, version=None, constraint=None, param_file=None,
 
     if DEBUG: print(' '.join(command))
 
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
@@ -379,7 +448,7 @@ def mfe_contrafold_(seq, T=37, version='2', constraint=None, param_file=None,DIR
 
     if DEBUG: print(' '.join(command))
 
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
@@ -395,6 +464,46 @@ def mfe_contrafold_(seq, T=37, version='2', constraint=None, param_file=None,DIR
     
     return stdout.decode('utf-8').split('\n')[-2]
 
+def mfe_contrafold_batch_(seqs, version='2', constraints=None, param_file=None, DIRLOC=None,
+    viterbi=False, DEBUG=False):
+    """get MFE (or MEA) structures for many sequences from a single `contrafold predict` run
+
+    Args:
+        seqs (list): nucleic acid sequences
+        constraints (list): structure constraints, one per sequence (or None)
+    Returns
+        list of secondary structure dot-bracket strings, in input order
+    """
+    if not version: version='2'
+
+    if DIRLOC is not None:
+        LOC=DIRLOC
+    elif version.startswith('2'):
+        LOC=package_locs['contrafold_2']
+    elif version.startswith('1'):
+        LOC=package_locs['contrafold_1']
+    else:
+        raise RuntimeError('Error, Contrafold version %s not present' % version)
+
+    options = []
+    if param_file is not None:
+        options = options + ['--params', param_file]
+
+    if viterbi:
+        options.append('--viterbi')
+
+    _, _, parens_fnames = run_contrafold_batch(LOC, seqs, constraints=constraints, options=options,
+        output=['--parens'], DEBUG=DEBUG)
+
+    struct_list = []
+    for fname in parens_fnames:
+        with open(fname) as f:
+            # >name, sequence, structure
+            struct_list.append([line.strip() for line in f.readlines() if line.strip()][-1])
+        os.remove(fname)
+
+    return struct_list
+
 def mfe_linearfold_(seq, bpps=False, package='contrafold', beam_size=100, return_dG_MFE=False):
     
     seqfile = write([seq])
@@ -411,7 +520,7 @@ def mfe_linearfold_(seq, bpps=False, package='contrafold', beam_size=100, return
     #Todo: implement constraint input
     command=['echo %s | %s/linearfold_%s' % (seq, LOC, package[0]), str(beam_size), '0', '0', '0']
     if DEBUG: print(' '.join(command))
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, shell=True, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
@@ -443,3 +552,46 @@ def mfe_linearfold_(seq, bpps=False, package='contrafold', beam_size=100, return
         return struct
 
 
+
+def mfe_linearfold_batch_(seqs, package='contrafold', beam_size=100, return_dG_MFE=False, DEBUG=False):
+    """get MFE structures for many sequences from a single LinearFold process, one sequence per stdin line
+
+    Returns
+        list of secondary structure strings (or (structure, dG(MFE)) tuples if return_dG_MFE), in input order
+    """
+    LOC = package_locs['linearfold']
+
+    # args:  beamsize, is_sharpturn, is_verbose, is_eval, is_constraints]
+    command=['%s/linearfold_%s' % (LOC, package[0]), str(beam_size), '0', '0', '0']
+    if DEBUG: print(' '.join(command))
+    p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
+
+    stdout, stderr = p.communicate(input=str.encode('\n'.join(seqs) + '\n'))
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    if p.returncode:
+        raise Exception('LinearFold failed: on batch of %d sequences\n%s' % (len(seqs), stderr))
+
+    # each sequence is echoed, followed by a "structure (dG)" line
+    lines = [line for line in stdout.decode('utf-8').split('\n') if line.strip()]
+    if len(lines) != 2*len(seqs):
+        raise Exception('LinearFold failed: expected %d outputs, got\n%s' % (len(seqs), stdout))
+
+    struct_list = []
+    for line in lines[1::2]:
+        struct = line.split(' ')[0]
+
+        if return_dG_MFE:
+            dG_mfe = float(line.split(' ')[1][1:-1])
+            if package.lower() != 'vienna':
+                dG_mfe *= -1
+            struct_list.append((struct, dG_mfe))
+        else:
+            struct_list.append(struct)
+
+    return struct_list
@@ -3,12 +3,8 @@ import numpy as np
 from .mfe import mfe
 from .utils import get_bpp_from_dbn
 from .utils import filename
-from .utils import load_package_locations
 from os import remove
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
 def get_bootstrap_reac_file(reactivity):
     reac_file = '%s.SHAPE' % filename()
     range_arr = np.arange(1, len(reactivity) + 1)
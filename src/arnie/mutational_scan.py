@@ -0,0 +1,180 @@
+import os
+import numpy as np
+from .utils import *
+from . import parallel
+from .pfunc import kT_
+from .ensemble import fold_ensemble_batch
+
+SCAN_OUTPUTS = ('log_Z', 'dG_MFE', 'punp')
+
+
+class MutationalScan:
+    '''Effect of every single-nucleotide substitution on one sequence, as returned by `mutational_scan`.
+
+    Row i, column a of each array is the change (mutant - wild type) on mutating position i to
+    alphabet[a]. Substitutions to the wild-type base give 0, and positions that weren't scanned give nan.
+    In windowed mode, mutant and wild type are both folded as the window around position i.
+
+    Attributes:
+        alphabet (str): substituted bases, the columns of each array
+        positions (list): scanned positions (0-indexed)
+        dlog_Z (array): NxA change in log of the partition function (None if not computed)
+        ddG_MFE (array): NxA change in MFE energy, kcal/mol (None if not computed)
+        dpunp (array): NxAxN change in the probability of each nucleotide being unpaired (None if not computed)
+        log_Z, dG_MFE, punp: wild-type values (None in windowed mode)
+    '''
+
+    def __init__(self, seq, package, positions, alphabet, dlog_Z=None, ddG_MFE=None, dpunp=None,
+            log_Z=None, dG_MFE=None, punp=None, window=None, T=37):
+        self.seq = seq
+        self.package = package
+        self.positions = positions
+        self.alphabet = alphabet
+        self.dlog_Z = dlog_Z
+        self.ddG_MFE = ddG_MFE
+        self.dpunp = dpunp
+        self.log_Z = log_Z
+        self.dG_MFE = dG_MFE
+        self.punp = punp
+        self.window = window
+        self.T = T
+
+    @property
+    def ddG_ensemble(self):
+        '''NxA change in ensemble free energy (kcal/mol)'''
+        if self.dlog_Z is None:
+            raise ValueError("ensemble free energies need outputs=('log_Z', ...)")
+        return -1*kT_(self.package, self.T)*self.dlog_Z
+
+    @property
+    def dpunp_site(self):
+        '''NxA change in the unpaired probability of the mutated nucleotide itself'''
+        if self.dpunp is None:
+            raise ValueError("unpaired probabilities need outputs=('punp', ...)")
+        N = len(self.seq)
+        return self.dpunp[np.arange(N), :, np.arange(N)]
+
+    def __repr__(self):
+        return '<MutationalScan %s, %d nt, %d positions x %s%s>' % (self.package, len(self.seq),
+            len(self.positions), self.alphabet, '' if self.window is None else ', window %d' % self.window)
+
+
+def scan_variants_(seq, positions, alphabet, window=None):
+    '''unique sequences to fold for a scan
+
+    Returns
+        list, dict: unique sequences, and {(i, a): (mutant index, wild type index, window start)}
+            for each substitution to a base other than the wild type
+    '''
+    unique, index = [], {}
+
+    def add(s):
+        if s not in index:
+            index[s] = len(unique)
+            unique.append(s)
+        return index[s]
+
+    jobs = {}
+    for i in positions:
+        lo, hi = (0, len(seq)) if window is None else (max(0, i - window), min(len(seq), i + window + 1))
+        wild_type = seq[lo:hi]
+        for a, base in enumerate(alphabet):
+            if base == seq[i]:
+                continue
+            mutant = wild_type[:i-lo] + base + wild_type[i-lo+1:]
+            jobs[(i, a)] = (add(mutant), add(wild_type), lo)
+    return unique, jobs
+
+
+def mutational_scan(seq, package='vienna_2', positions=None, alphabet='ACGU', outputs=SCAN_OUTPUTS, window=None,
+        workers=None, T=37, **kwargs):
+    ''' Saturation mutagenesis: fold every single-nucleotide substitution of a sequence.
+
+    Identical variant sequences are folded once. The unique sequences are split between `workers`
+    processes (see `arnie.parallel.map`), and each worker folds its share with one `fold_ensemble_batch`
+    call, e.g. a single RNAfold run for vienna_2. For long sequences, `window` refolds only the
+    nucleotides within `window` of each mutation, for both the mutant and the wild type.
+
+        Args:
+        seq (str): nucleic acid sequence
+        package (str): as in `fold_ensemble`
+        positions (list): positions to mutate, 0-indexed (default: all)
+        alphabet (str): bases to substitute at each position
+        outputs (iterable): changes to compute, from 'log_Z', 'dG_MFE', 'punp'
+        window (int): fold only positions i-window..i+window around each mutation at i (default: whole sequence)
+        workers (int): number of worker processes (default: number of cores, at most one per sequence)
+        kwargs: other options as in `fold_ensemble_batch` (e.g. dangles, param_file, bpp_cutoff); a
+            constraint (str) applies to every variant, and its pairs must survive each substitution
+
+    Returns
+        MutationalScan: NxA arrays dlog_Z and ddG_MFE, and NxAxN dpunp
+    '''
+    outputs = set(outputs)
+    unknown = outputs - set(SCAN_OUTPUTS)
+    if unknown:
+        raise ValueError('Unknown scan outputs %s, choose from %s' % (sorted(unknown), SCAN_OUTPUTS))
+
+    if window is not None and kwargs.get('constraint') is not None:
+        raise ValueError('constraints are for the whole sequence, use window=None')
+
+    N = len(seq)
+    positions = list(range(N)) if positions is None else sorted(set(positions))
+    unique, jobs = scan_variants_(seq, positions, alphabet, window=window)
+    if window is None and seq not in unique:
+        unique.append(seq)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(min(workers, len(unique)), 1)
+
+    # one chunk of sequences per worker, so each worker launches the package once
+    chunks = [list(chunk) for chunk in np.array_split(np.array(unique, dtype=object), workers) if len(chunk)]
+    results = parallel.map(fold_variants_, chunks, workers=workers, raise_on_error=True,
+        package=package, outputs=outputs, T=T, **kwargs)
+    results = [x for chunk in results for x in chunk]
+
+    scan = MutationalScan(seq, package, positions, alphabet, window=window, T=T)
+    if window is None:
+        scan.log_Z, scan.dG_MFE, scan.punp = results[unique.index(seq)]
+
+    A = len(alphabet)
+    dlog_Z, ddG_MFE, dpunp = np.full((N, A), np.nan), np.full((N, A), np.nan), np.full((N, A, N), np.nan)
+    for i in positions:
+        for a, base in enumerate(alphabet):
+            if base == seq[i]:
+                dlog_Z[i, a], ddG_MFE[i, a], dpunp[i, a] = 0, 0, 0
+                continue
+
+            mutant, wild_type, lo = jobs[(i, a)]
+            if 'log_Z' in outputs:
+                dlog_Z[i, a] = results[mutant][0] - results[wild_type][0]
+            if 'dG_MFE' in outputs:
+                ddG_MFE[i, a] = results[mutant][1] - results[wild_type][1]
+            if 'punp' in outputs:
+                delta = results[mutant][2] - results[wild_type][2]
+                dpunp[i, a] = 0
+                dpunp[i, a, lo:lo+len(delta)] = delta
+
+    if 'log_Z' in outputs:
+        scan.dlog_Z = dlog_Z
+    if 'dG_MFE' in outputs:
+        scan.ddG_MFE = ddG_MFE
+    if 'punp' in outputs:
+        scan.dpunp = dpunp
+    return scan
+
+
+def fold_variants_(seqs, package='vienna_2', outputs=SCAN_OUTPUTS, constraint=None, **kwargs):
+    '''log Z, MFE energy and unpaired probabilities (None where not in `outputs`) of each of `seqs`, for one worker'''
+    want = set()
+    if 'log_Z' in outputs:
+        want.add('Z')
+    if 'dG_MFE' in outputs:
+        want.add('mfe')
+    if 'punp' in outputs:
+        want.add('punp')
+
+    results = fold_ensemble_batch(seqs, package=package, want=want, sparse=True,
+        constraint=None if constraint is None else [constraint]*len(seqs), **kwargs)
+    return [(res.log_Z if 'log_Z' in outputs else None, res.dG_MFE if 'dG_MFE' in outputs else None,
+        res.punp if 'punp' in outputs else None) for res in results]
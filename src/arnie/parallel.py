@@ -0,0 +1,121 @@
+import os, sys, random, traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+class ItemFailure:
+    '''Placeholder returned by `map` for an item whose call raised an exception.
+
+    Attributes:
+        index (int): position of the item in the input
+        item: the input item
+        error (str): the exception, as a string
+        traceback (str): formatted traceback from the worker
+    '''
+    def __init__(self, index, item, error, traceback):
+        self.index = index
+        self.item = item
+        self.error = error
+        self.traceback = traceback
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'ItemFailure(index=%d, error=%r)' % (self.index, self.error)
+
+
+def _init_worker(threads):
+    # forked workers inherit the parent's random state, which would make them
+    # all draw the same temporary file names from utils.filename()
+    random.seed()
+
+    # multithreaded package calls (e.g. threads='auto') share the cores between workers
+    os.environ['ARNIE_THREADS'] = str(threads)
+
+
+def _run_chunk(func, start, chunk, kwargs):
+    results = []
+    for offset, item in enumerate(chunk):
+        try:
+            results.append(func(item, **kwargs))
+        except Exception as e:
+            results.append(ItemFailure(start + offset, item, '%s: %s' % (type(e).__name__, e), traceback.format_exc()))
+    return results
+
+
+def _report_progress(progress, n_done, n_total):
+    if callable(progress):
+        progress(n_done, n_total)
+    elif progress:
+        sys.stderr.write('\r%d/%d' % (n_done, n_total))
+        if n_done == n_total:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+
+
+def map(func, items, workers=None, chunksize=1, progress=False, raise_on_error=False, **kwargs):
+    '''Call an arnie function on many inputs across a pool of processes.
+
+    Example: `map(bpps, seqs, workers=16, package='eternafold')`
+
+    Args:
+        func (callable): module-level function to call as func(item, **kwargs),
+            e.g. `pfunc`, `bpps`, `mfe`, `sample_structures`, `pk_predict`
+        items (list): first argument for each call, usually sequences
+        workers (int): number of worker processes (default: number of cores).
+            workers=1 runs everything in the current process. Each worker gets an equal share
+            of the cores for calls with threads='auto' (see `utils.thread_budget`).
+        chunksize (int): number of items sent to a worker at a time
+        progress (bool or callable): print a running count to stderr, or call progress(n_done, n_total)
+        raise_on_error (bool): re-raise the first failure instead of returning `ItemFailure` placeholders
+        kwargs: passed on to every call
+
+    Returns:
+        list: results in input order. Items whose call raised are returned as `ItemFailure`
+        (falsy, holds the error message and traceback), so one bad sequence doesn't lose the batch.
+    '''
+    items = list(items)
+    n_total = len(items)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunksize = max(int(chunksize), 1)
+
+    chunks = [(start, items[start:start+chunksize]) for start in range(0, n_total, chunksize)]
+    results = [None]*n_total
+    n_done = 0
+
+    if workers == 1 or n_total <= 1:
+        for start, chunk in chunks:
+            results[start:start+len(chunk)] = _run_chunk(func, start, chunk, kwargs)
+            n_done += len(chunk)
+            _report_progress(progress, n_done, n_total)
+
+    else:
+        n_workers = min(workers, len(chunks))
+        threads = max((os.cpu_count() or 1) // n_workers, 1)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(threads,)) as executor:
+            futures = {executor.submit(_run_chunk, func, start, chunk, kwargs): (start, chunk) for start, chunk in chunks}
+            try:
+                for future in as_completed(futures):
+                    start, chunk = futures[future]
+                    try:
+                        results[start:start+len(chunk)] = future.result()
+                    except Exception as e:
+                        # the worker itself died, or the result couldn't be sent back
+                        results[start:start+len(chunk)] = [ItemFailure(start + offset, item, '%s: %s' % (type(e).__name__, e),
+                            traceback.format_exc()) for offset, item in enumerate(chunk)]
+                    n_done += len(chunk)
+                    _report_progress(progress, n_done, n_total)
+            except KeyboardInterrupt:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    if raise_on_error:
+        for result in results:
+            if isinstance(result, ItemFailure):
+                raise RuntimeError('%s failed on item %d (%s):\n%s' % (getattr(func, '__name__', func),
+                    result.index, result.item, result.traceback))
+
+    return results
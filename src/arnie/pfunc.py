@@ -3,17 +3,59 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
-
-
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
+from .cache import cached, cached_batch
+from .rnalib import use_rnalib_, pfunc_rnalib_
+
+def cutoff_arg_(bpp_cutoff, default='0.0000000001'):
+    '''bpp cutoff as passed on package command lines (without an exponent, which not every package parses)'''
+    if bpp_cutoff is None:
+        return default
+    if not 0 <= bpp_cutoff < 1:
+        raise ValueError('bpp_cutoff must be in [0, 1), got %s' % bpp_cutoff)
+    return np.format_float_positional(bpp_cutoff, trim='-')
+
+def kT_(package, T=37):
+    '''kT (kcal/mol) of `package` itself, which log Z and free energies derived from it use.
+    ViennaRNA and NUPACK use R = 0.0019872 kcal/mol/K at T + 273.15 K.'''
+    if package.lower().startswith('rnastructure'):
+        return .0019*(273+T)
+    return .0019872*(273.15+T)
+
+def Z_kT_(package, T=37):
+    '''kT (kcal/mol) that arnie has always used to turn free energies into Z. It is a little off
+    the packages' own kT (see `kT_`), but is kept so that `pfunc` returns the same Z as before.'''
+    if package.lower().startswith('rnastructure'):
+        return .0019*(273+T)
+    return .0019899*(273+T)
+
+def log_Z_(free_energy, package, T=37, linear=False):
+    '''natural log of Z from the free energy `pfunc(..., return_free_energy=True)` gives for `package`'''
+    pkg = package.lower().split('_')[0]
+    if pkg in ['contrafold', 'eternafold', 'rnasoft']:
+        # these report -log Z as the free energy
+        return -1*free_energy
+    if linear:
+        # LinearPartition-V always folds at 37 C
+        T = 37
+    return -1*free_energy/kT_(pkg, T)
+
+def Z_from_log_Z_(log_Z, package, T=37, linear=False):
+    '''Z as `pfunc` returns it, from the log Z of `log_Z_`'''
+    pkg = package.lower().split('_')[0]
+    if pkg in ['contrafold', 'eternafold', 'rnasoft', 'vfold']:
+        return np.exp(log_Z)
+    if linear:
+        T = 37
+    return np.exp(log_Z*kT_(pkg, T)/Z_kT_(pkg, T))
+
+@cached('pfunc', skip=['bpps'])
+@in_scratch_dir
 def pfunc(seq, package='vienna_2', T=37,
     constraint=None, motif=None, linear=False,
     dangles=True, noncanonical=False, pseudo=False, dna=False, DIRLOC=None,
     bpps=False, param_file=None, coaxial=True, reweight=None,
     return_free_energy = False, beam_size=100, DEBUG=False, threshknot=False,
-    probing_signal=None, probing_kws = None):
+    probing_signal=None, probing_kws = None, bpp_cutoff=None, threads=None, return_log_Z=False):
     ''' Compute partition function for RNA sequence.
 
         Args:
@@ -29,16 +71,31 @@ def pfunc(seq, package='vienna_2', T=37,
         noncanonical(bool): include noncanonical pairs or not (for contrafold, RNAstructure (Cyclefold))
         beam_size (int): beam size option for LinearPartition.
         threshknot (bool): call threshknot to predict pseudoknots (for contrafold, using LinearPartition)
+        bpp_cutoff (float): with bpps=True, smallest pair probability the package writes out
+            (default: 1e-10, or 1e-6 for LinearPartition)
+        threads (int): rnastructure only, run the SMP build (partition-smp) with this many threads if it is
+            installed. 'auto' uses this process's share of the cores (see `utils.thread_budget`).
+        return_log_Z (bool): return the natural log of Z, which doesn't overflow for long sequences.
+            Converted from the free energy with the package's own kT (`kT_`, or the fold compound's kT in-process),
+            while Z keeps arnie's older constant (`Z_kT_`). contrafold, eternafold and rnasoft report log Z directly.
 
         Possible packages:
         'vienna_2', 'vienna_1','contrafold_1','contrafold_2','nupack_95','nupack_99','rnasoft_2007','rnasoft_1999','rnastructure','vfold_0','vfold_1'
+        vienna_2 runs in-process through the ViennaRNA Python bindings when they are installed
+        (see `rnalib.set_vienna_engine`), otherwise through RNAfold.
 
     Returns
-        float: free energy
+        float: Z (free energy if return_free_energy, log Z if return_log_Z)
     '''
 
     if DEBUG: load_package_locations(DEBUG=True)
 
+    # log Z is converted from the free energy, Z itself can overflow
+    requested_free_energy = return_free_energy
+    if return_log_Z:
+        return_free_energy = True
+    log_Z = None
+
     try:
         pkg, version = package.lower().split('_')
     except:
@@ -68,25 +125,32 @@ def pfunc(seq, package='vienna_2', T=37,
     if pkg=='vienna':
         if linear:
             Z, tmp_file = pfunc_linearpartition_(seq, package='vienna',bpps=bpps, beam_size=beam_size,
-                return_free_energy=return_free_energy, DEBUG=DEBUG)
+                return_free_energy=return_free_energy, DEBUG=DEBUG, bpp_cutoff=bpp_cutoff)
+
+        elif not bpps and use_rnalib_(version=version, motif=motif, param_file=param_file, probing_signal=probing_signal):
+            free_energy, log_Z = pfunc_rnalib_(seq, T=T, dangles=dangles, constraint=constraint,
+                reweight=reweight, probing_signal=probing_signal, probing_kws=probing_kws, DEBUG=DEBUG, return_log_Z=True)
+            Z = free_energy if return_free_energy else np.exp(-1*free_energy/Z_kT_(pkg, T))
+            tmp_file = None
 
         else:
             Z, tmp_file = pfunc_vienna_(seq, version=version, T=T, dangles=dangles,
              constraint=constraint, motif=motif, bpps=bpps, param_file=param_file,
-             reweight=reweight, return_free_energy=return_free_energy, DEBUG=DEBUG, probing_signal=probing_signal, probing_kws = probing_kws,)
+             reweight=reweight, return_free_energy=return_free_energy, DEBUG=DEBUG, probing_signal=probing_signal, probing_kws = probing_kws,
+             bpp_cutoff=bpp_cutoff)
 
     elif pkg=='contrafold':
         if linear:
             Z, tmp_file = pfunc_linearpartition_(seq, package='contrafold', bpps=bpps, beam_size=beam_size,
-                return_free_energy=return_free_energy, DEBUG=DEBUG, threshknot=threshknot)
+                return_free_energy=return_free_energy, DEBUG=DEBUG, threshknot=threshknot, bpp_cutoff=bpp_cutoff)
         else:
             Z, tmp_file = pfunc_contrafold_(seq, version=version, T=T,
                 constraint=constraint, bpps=bpps, param_file=param_file, DIRLOC=DIRLOC,
-                return_free_energy=return_free_energy, DEBUG=DEBUG)
+                return_free_energy=return_free_energy, DEBUG=DEBUG, bpp_cutoff=bpp_cutoff)
 
     elif pkg=='rnastructure':
         Z, tmp_file = pfunc_rnastructure_(seq, version=version, T=T, coaxial=coaxial,
-            constraint=constraint, bpps=bpps, return_free_energy=return_free_energy, DEBUG=DEBUG)
+            constraint=constraint, bpps=bpps, return_free_energy=return_free_energy, DEBUG=DEBUG, threads=threads)
 
     elif pkg=='rnasoft':
         if constraint is not None:
@@ -107,12 +171,13 @@ def pfunc(seq, package='vienna_2', T=37,
     elif pkg=='eternafold':
         if linear:
             Z, tmp_file = pfunc_linearpartition_(seq, package='eternafold', bpps=bpps, beam_size=beam_size,
-                return_free_energy=return_free_energy, DEBUG=DEBUG)
+                return_free_energy=return_free_energy, DEBUG=DEBUG, bpp_cutoff=bpp_cutoff)
         else:
             # Using contrafold code and eternafold params
             if 'eternafoldparams' in package_locs.keys() and 'eternafold' not in package_locs.keys():
                 Z, tmp_file = pfunc_contrafold_(seq, T=T, constraint=constraint, 
-                    bpps=bpps, param_file=package_locs['eternafoldparams'], DIRLOC=DIRLOC, return_free_energy=return_free_energy, DEBUG=DEBUG)
+                    bpps=bpps, param_file=package_locs['eternafoldparams'], DIRLOC=DIRLOC, return_free_energy=return_free_energy, DEBUG=DEBUG,
+                    bpp_cutoff=bpp_cutoff)
 
             elif 'eternafold' in package_locs.keys() and param_file is None:
                 #Using eternafold code and params in eternafold codebase
@@ -121,15 +186,27 @@ def pfunc(seq, package='vienna_2', T=37,
                    raise RuntimeError('Error: Parameters not found at %s' % efold_param_file)
                 else:
                     Z, tmp_file = pfunc_contrafold_(seq, T=T, constraint=constraint, 
-                        bpps=bpps, param_file=efold_param_file, DIRLOC= package_locs['eternafold'], return_free_energy=return_free_energy, DEBUG=DEBUG)
+                        bpps=bpps, param_file=efold_param_file, DIRLOC= package_locs['eternafold'], return_free_energy=return_free_energy, DEBUG=DEBUG,
+                        bpp_cutoff=bpp_cutoff)
             elif 'eternafold' in package_locs.keys() and param_file is not None:
                     Z, tmp_file = pfunc_contrafold_(seq, T=T, constraint=constraint, 
                         bpps=bpps, param_file=param_file, DIRLOC= package_locs['eternafold'], 
-                        probing_kws=probing_kws, probing_signal = probing_signal, return_free_energy=return_free_energy, DEBUG=DEBUG)                
+                        probing_kws=probing_kws, probing_signal = probing_signal, return_free_energy=return_free_energy, DEBUG=DEBUG,
+                        bpp_cutoff=bpp_cutoff)                
 
     else:
         raise ValueError('package %s not understood.' % package)
 
+    if return_log_Z:
+        if log_Z is not None:
+            # from the fold compound's own kT
+            Z = log_Z
+        else:
+            # vfold only reports Z
+            Z = np.log(Z) if pkg == 'vfold' else log_Z_(Z, pkg, T=T, linear=linear)
+    elif not requested_free_energy and np.isinf(Z):
+        print('Warning: Z overflows for this %d nt sequence, use return_log_Z=True' % len(seq))
+
     if bpps:
         return Z, tmp_file
 
@@ -141,8 +218,89 @@ def pfunc(seq, package='vienna_2', T=37,
                 pass
         return Z
 
+@cached_batch('pfunc', pfunc)
+@in_scratch_dir
+def pfunc_batch(seqs, package='vienna_2', T=37, constraint=None, motif=None, linear=False,
+    dangles=True, param_file=None, reweight=None, return_free_energy=False, return_log_Z=False, jobs=None, batch_size=None,
+    DEBUG=False, **kwargs):
+    ''' Compute partition functions for many RNA sequences, sharing package invocations.
+
+        For vienna, all sequences are sent as one FASTA batch through a single RNAfold run
+        (multithreaded with --jobs if the RNAfold binary supports it), or folded one by one in-process
+        with the rnalib engine (see `rnalib.set_vienna_engine`). For contrafold and eternafold,
+        one input file per sequence is given to a single `contrafold predict` call, so the parameter
+        file is only loaded once. With linear=True, all sequences are streamed through the stdin of
+        one LinearPartition process. Other packages and options that can't be batched fall back to one
+        `pfunc` call per sequence.
+
+        Args:
+        seqs (list): nucleic acid sequences
+        package (str): as in `pfunc`
+        constraint (list): structure constraints, one per sequence (or None)
+        jobs (int): number of RNAfold threads. Default (None) uses all available cores (within arnie.parallel.map, the worker's share).
+        batch_size (int): max number of sequences per package invocation (default: all at once)
+        other arguments as in `pfunc`
+
+    Returns
+        list of floats: Z (or free energy, or log Z) for each sequence, in input order
+    '''
+
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    if constraint is not None and len(constraint) != len(seqs):
+        raise ValueError('Need one constraint per sequence for batch mode.')
+
+    if pkg not in ['vienna', 'contrafold', 'eternafold'] or motif is not None \
+        or kwargs.get('probing_signal') is not None or kwargs.get('threshknot') \
+        or (pkg == 'vienna' and not linear and use_rnalib_(version=version, param_file=param_file)):
+        return [pfunc(seq, package=package, T=T, motif=motif, linear=linear, dangles=dangles,
+            param_file=param_file, reweight=reweight, constraint=None if constraint is None else constraint[i],
+            return_free_energy=return_free_energy, return_log_Z=return_log_Z, DEBUG=DEBUG, **kwargs) for i, seq in enumerate(seqs)]
+
+    if batch_size is None:
+        batch_size = max(len(seqs), 1)
+
+    # log Z is converted from the free energy, Z itself can overflow
+    if return_log_Z:
+        return_free_energy = True
+
+    Z_list = []
+    for start in range(0, len(seqs), batch_size):
+        chunk_constraints = None if constraint is None else constraint[start:start+batch_size]
+
+        if linear:
+            Zs, _ = pfunc_linearpartition_batch_(seqs[start:start+batch_size], package=pkg,
+                beam_size=kwargs.get('beam_size', 100), return_free_energy=return_free_energy, DEBUG=DEBUG)
+            results = [(Z, None) for Z in Zs]
+        elif pkg == 'vienna':
+            results = pfunc_vienna_batch_(seqs[start:start+batch_size], version=version, T=T, dangles=dangles,
+                constraints=chunk_constraints, param_file=param_file, reweight=reweight,
+                return_free_energy=return_free_energy, jobs=jobs, DEBUG=DEBUG)
+        elif pkg == 'contrafold':
+            results = pfunc_contrafold_batch_(seqs[start:start+batch_size], version=version,
+                constraints=chunk_constraints, param_file=param_file, DIRLOC=kwargs.get('DIRLOC'),
+                return_free_energy=return_free_energy, DEBUG=DEBUG)
+        else:
+            DIRLOC, efold_param_file = eternafold_locations_(param_file=param_file, DIRLOC=kwargs.get('DIRLOC'))
+            results = pfunc_contrafold_batch_(seqs[start:start+batch_size], constraints=chunk_constraints,
+                param_file=efold_param_file, DIRLOC=DIRLOC, return_free_energy=return_free_energy, DEBUG=DEBUG)
+
+        for Z, tmp_file in results:
+            if tmp_file:
+                try:
+                    os.remove(tmp_file)
+                except:
+                    pass
+            Z_list.append(log_Z_(Z, pkg, T=T, linear=linear) if return_log_Z else Z)
+
+    return Z_list
+
 def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=None,
-                dangles=True, bpps=False, reweight=None, return_free_energy=False, DEBUG=False, probing_signal=None, shapeMethod='W', probing_kws=None):
+                dangles=True, bpps=False, reweight=None, return_free_energy=False, DEBUG=False, probing_signal=None, shapeMethod='W', probing_kws=None,
+                bpp_cutoff=None):
     """get partition function structure representation and Z
 
     Args:
@@ -177,12 +335,12 @@ def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_fil
 
     if version.startswith('2'):
 
-        command.append('--bppmThreshold=0.0000000001')
+        command.append('--bppmThreshold=%s' % cutoff_arg_(bpp_cutoff))
         output_id = local_rand_filename()
-        output_dot_ps_file = "%s_0001_dp.ps" % output_id
+        output_dot_ps_file = scratch_path("%s_0001_dp.ps" % output_id)
         command.append('--id-prefix=%s' % output_id)
     else:
-        output_dot_ps_file = 'dot.ps'
+        output_dot_ps_file = scratch_path('dot.ps')
 
     if motif is not None:
         command.append("--motif=%s" % motif)
@@ -207,7 +365,7 @@ def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_fil
     with open(fname) as f:
         if DEBUG: print(fname)
         if DEBUG: print(' '.join(command))
-        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE)
+        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
     stdout, stderr = p.communicate()
 
     if DEBUG:
@@ -224,7 +382,7 @@ def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_fil
     os.remove(fname)
 
     if version.startswith('2'):
-        os.remove("%s_0001_ss.ps" % output_id)
+        os.remove(scratch_path("%s_0001_ss.ps" % output_id))
 
     if 'omitting constraint' in stderr.decode('utf-8'):
         free_energy = np.inf # Impossible structure
@@ -239,8 +397,139 @@ def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_fil
     else: # return Z
         return np.exp(-1*free_energy/(.0019899*(273+T))), output_dot_ps_file
 
+# cache of RNAfold binary -> whether it understands --jobs
+_rnafold_has_jobs = {}
+
+def rnafold_supports_jobs_(LOC):
+    if LOC not in _rnafold_has_jobs:
+        try:
+            p = sp.Popen(['%s/RNAfold' % LOC, '--help'], stdout=sp.PIPE, stderr=sp.PIPE)
+            stdout, stderr = p.communicate()
+            _rnafold_has_jobs[LOC] = '--jobs' in stdout.decode('utf-8')
+        except OSError:
+            _rnafold_has_jobs[LOC] = False
+    return _rnafold_has_jobs[LOC]
+
+def pfunc_vienna_batch_(seqs, T=37, version='2', constraints=None, param_file=None, dangles=True,
+                reweight=None, return_free_energy=False, jobs=None, DEBUG=False, bpp_cutoff=None):
+    """get Z for many sequences from a single RNAfold run
+
+    Args:
+        seqs (list): nucleic acid sequences
+        T (float): temperature
+        constraints (list): structure constraints, one per sequence (or None)
+        jobs (int): number of RNAfold threads (None: `thread_budget()`, if --jobs is supported)
+    Returns
+        list of (float, str): Z (or free energy) and dot plot file for each sequence, in input order
+    """
+
+    if not version:
+        version='2'
+
+    if version.startswith('2'):
+        LOC=package_locs['vienna_2']
+    elif version.startswith('1'):
+        LOC=package_locs['vienna_1']
+    else:
+        raise RuntimeError('Error, vienna version %s not present' % version)
+
+    command = ['%s/RNAfold' % LOC, '-p', '-T', str(T)]
+
+    if version.startswith('2'):
+        command.append('--bppmThreshold=%s' % cutoff_arg_(bpp_cutoff))
+
+        if jobs != 1 and rnafold_supports_jobs_(LOC):
+            command.append('--jobs=%d' % (thread_budget() if jobs is None else jobs))
+
+    # each record gets a FASTA header, so that RNAfold names its dot plot <id>_dp.ps
+    batch_id = local_rand_filename()
+    record_ids = ['%s_%04d' % (batch_id, i+1) for i in range(len(seqs))]
+
+    lines = []
+    for i, (record_id, seq) in enumerate(zip(record_ids, seqs)):
+        lines.extend(['>%s' % record_id, seq])
+        if constraints is not None:
+            lines.append(constraints[i])
+
+    if constraints is not None:
+        command.append('-C')
+        if version.startswith('2'):
+            command.append('--enforceConstraint')
+
+    fname = write(lines)
+
+    if not dangles:
+        command.append('--dangles=0')
+
+    if reweight is not None:
+        command.append('--commands=%s' % reweight)
+
+    if param_file:
+        command.append('--paramFile=%s' % param_file)
+
+    with open(fname) as f:
+        if DEBUG: print(fname)
+        if DEBUG: print(' '.join(command))
+        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
+    stdout, stderr = p.communicate()
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    if stderr.decode('utf-8').startswith('WARNING: '):
+        print(stderr)
+
+    if p.returncode:
+        raise Exception('RNAfold failed: on batch of %d sequences\n%s' % (len(seqs), stderr))
+    os.remove(fname)
+
+    for record_id in record_ids:
+        try:
+            os.remove(scratch_path('%s_ss.ps' % record_id))
+        except OSError:
+            pass
+
+    if 'omitting constraint' in stderr.decode('utf-8'):
+        # RNAfold doesn't say which record had the impossible constraint, redo them one by one
+        for record_id in record_ids:
+            try:
+                os.remove(scratch_path('%s_dp.ps' % record_id))
+            except OSError:
+                pass
+        return [pfunc_vienna_(seq, T=T, version=version, constraint=constraints[i], param_file=param_file,
+            dangles=dangles, reweight=reweight, return_free_energy=return_free_energy, DEBUG=DEBUG, bpp_cutoff=bpp_cutoff)
+            for i, seq in enumerate(seqs)]
+
+    # split output on FASTA headers, records come back in input order
+    records = {}
+    for chunk in stdout.decode('utf-8').split('>')[1:]:
+        header, _, body = chunk.partition('\n')
+        records[header.split()[0]] = body
+
+    results = []
+    for record_id, seq in zip(record_ids, seqs):
+        if record_id not in records:
+            raise Exception('RNAfold failed: no output for %s' % seq)
+
+        m = re.search(r'([,|\(\.\)\]\[\{\}]+)\s+\[\s*(-*[0-9]+\.[0-9]+)', records[record_id])
+        free_energy = float(m.group(2))
+        if DEBUG: print('free_energy: ', free_energy)
+
+        output_dot_ps_file = scratch_path('%s_dp.ps' % record_id)
+
+        if return_free_energy:
+            results.append((free_energy, output_dot_ps_file))
+        else:
+            results.append((np.exp(-1*free_energy/(.0019899*(273+T))), output_dot_ps_file))
+
+    return results
+
 def pfunc_contrafold_(seq, T=37, version='2', constraint=None, bpps=False,
-         param_file=None, return_free_energy=False, DIRLOC=None, DEBUG=False, probing_signal=None, probing_kws=None):
+         param_file=None, return_free_energy=False, DIRLOC=None, DEBUG=False, probing_signal=None, probing_kws=None,
+         bpp_cutoff=None):
 
     """get partition function structure representation and free energy
 
@@ -287,7 +576,7 @@ def pfunc_contrafold_(seq, T=37, version='2', constraint=None, bpps=False,
 
     if bpps:
         posterior_fname = '%s.posteriors' % filename()
-        command = command + ['--posteriors', '0.0000000001', posterior_fname]
+        command = command + ['--posteriors', cutoff_arg_(bpp_cutoff), posterior_fname]
 
     else:
         command.append('--partition')
@@ -301,7 +590,7 @@ def pfunc_contrafold_(seq, T=37, version='2', constraint=None, bpps=False,
             convert_dbn_to_contrafold_input(seq, ''.join(['.' for x in range(len(seq))]), fname)
 
     if DEBUG: print(' '.join(command))
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
@@ -325,6 +614,77 @@ def pfunc_contrafold_(seq, T=37, version='2', constraint=None, bpps=False,
     else:
         return 0, posterior_fname
 
+def eternafold_locations_(param_file=None, DIRLOC=None):
+    """get contrafold binary location and parameter file to use for the eternafold hotkey
+
+    Returns
+        str, str: DIRLOC to pass to contrafold wrappers, parameter file
+    """
+    if 'eternafoldparams' in package_locs.keys() and 'eternafold' not in package_locs.keys():
+        # Using contrafold code and eternafold params
+        return DIRLOC, package_locs['eternafoldparams']
+
+    elif 'eternafold' in package_locs.keys():
+        if param_file is None:
+            #Using eternafold code and params in eternafold codebase
+            param_file = os.environ['ETERNAFOLD_PARAMETERS'] if os.environ.get('ETERNAFOLD_PARAMETERS') else package_locs['eternafold']+'/../parameters/EternaFoldParams.v1'
+            if not os.path.exists(param_file):
+                raise RuntimeError('Error: Parameters not found at %s' % param_file)
+        return package_locs['eternafold'], param_file
+
+    else:
+        raise RuntimeError('Error: need to set path to EternaFold or EternaFold params to use eternafold hotkey.')
+
+def pfunc_contrafold_batch_(seqs, version='2', constraints=None, bpps=False, param_file=None,
+        return_free_energy=False, DIRLOC=None, DEBUG=False, bpp_cutoff=None):
+    """get log Z or posteriors for many sequences from a single `contrafold predict` run
+
+    Args:
+        seqs (list): nucleic acid sequences
+        constraints (list): structure constraints, one per sequence (or None)
+
+        DIRLOC: sets location of contrafold specifically (Useful if there's several EternaFold builds to compare.)
+    Returns
+        list of (float, str): Z (or free energy) and posteriors file for each sequence, in input order
+    """
+    if not version: version='2'
+
+    if DIRLOC is not None:
+        LOC=DIRLOC
+    elif version.startswith('2'):
+        LOC=package_locs['contrafold_2']
+    elif version.startswith('1'):
+        LOC=package_locs['contrafold_1']
+    else:
+        raise RuntimeError('Error, Contrafold version %s not present' % version)
+
+    options = []
+    if param_file is not None:
+        options = options + ['--params', param_file]
+
+    if bpps:
+        stdout, _, posterior_fnames = run_contrafold_batch(LOC, seqs, constraints=constraints, options=options,
+            output=['--posteriors', cutoff_arg_(bpp_cutoff)], DEBUG=DEBUG)
+        return [(0, fname) for fname in posterior_fnames]
+
+    options.append('--partition')
+    stdout, in_fnames, _ = run_contrafold_batch(LOC, seqs, constraints=constraints, options=options, DEBUG=DEBUG)
+
+    # one 'Log partition coefficient for "<input file>": <value>' line per input
+    reported = dict(re.findall(r'"(.+)"\s*:\s*(\S+)', stdout))
+    if all(fname in reported for fname in in_fnames):
+        logZ_list = [float(reported[fname]) for fname in in_fnames]
+    else:
+        lines = [line for line in stdout.split('\n') if line.strip()]
+        if len(lines) != len(seqs):
+            raise Exception('Contrafold failed: could not match partition output to inputs\n%s' % stdout)
+        logZ_list = [float(line.rstrip().split()[-1]) for line in lines]
+
+    if return_free_energy:
+        return [(-1*logZ, None) for logZ in logZ_list]
+    else:
+        return [(np.exp(logZ), None) for logZ in logZ_list]
+
 def pfunc_rnasoft_(seq, version='99', T=37, constraint=None, bpps=False, return_free_energy=False, DEBUG=False):
     DIR = package_locs['rnasoft']
 
@@ -344,7 +704,7 @@ def pfunc_rnasoft_(seq, version='99', T=37, constraint=None, bpps=False, return_
     command = ['%s/simfold_pf' % DIR, '-s', seq, '-p', param_locs[version]]
 
     if DEBUG: print(' '.join(command))
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
@@ -400,7 +760,7 @@ def pfunc_nupack_(seq, version='95', T=37, dangles=True, constraint=None, return
     if pseudo:
         command.append('--pseudo')
     if DEBUG: print(' '.join(command))
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
@@ -429,7 +789,7 @@ def pfunc_nupack_(seq, version='95', T=37, dangles=True, constraint=None, return
         return Z, None
 
 def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,
-                            bpps=False, return_free_energy=False, DEBUG=False):
+                            bpps=False, return_free_energy=False, DEBUG=False, threads=None):
     """get partition function structure representation and free energy
 
     Args:
@@ -438,6 +798,7 @@ def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,
         constraint (str): structure constraints
         motif (str): argument to vienna motif
         coaxial (bool): Coaxial stacking or not (default True)
+        threads (int): threads for partition-smp, see `rnastructure_program_`
     Returns
         float: partition function
     """
@@ -445,7 +806,8 @@ def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,
     seqfile = write([seq])
     pfsfile = '%s.pfs' % filename()
     DIR = package_locs['rnastructure']
-    command = ['%s/partition' % DIR, seqfile, pfsfile, '-T', str(T+273)]
+    program, env = rnastructure_program_('partition', threads)
+    command = [program, seqfile, pfsfile, '-T', str(T+273)]
 
     if not coaxial:
         command.extend(['--disablecoax'])
@@ -457,7 +819,7 @@ def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,
         command.extend(['--constraint', fname])
 
     if DEBUG: print(' '.join(command))
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir(), env=env)
 
     stdout, stderr = p.communicate()
 
@@ -478,7 +840,7 @@ def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,
         command = ['%s/EnsembleEnergy' % DIR, pfsfile]
 
         if DEBUG: print(' '.join(command))
-        p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+        p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
         stdout, stderr = p.communicate()
 
@@ -509,12 +871,8 @@ def pfunc_vfold_(seq, version='0', T=37, coaxial=True, bpps=False, DEBUG=False):
 
     DIR = package_locs["vfold"]
 
-    cwd = os.getcwd()
-    os.chdir(DIR) #vfold precompiled binaries don't work being called from elsewhere
-
-    if DEBUG: print(os.getcwd())
-
-    seqfile = write([seq])
+    seqfile = os.path.abspath(write([seq]))
+    outfile = os.path.abspath(filename())
 
     if sys.platform=="linux":
         platform='linux'
@@ -526,14 +884,14 @@ def pfunc_vfold_(seq, version='0', T=37, coaxial=True, bpps=False, DEBUG=False):
         raise RuntimeError('Vfold has binaries for linux, macOS, and win')
 
 
-    command = ['./VfoldThermal_npk_%s.o %d %d %d %s tmp %d; cat tmp; rm tmp' % (platform, int(coaxial), T, T, seqfile, int(version))]
+    command = ['./VfoldThermal_npk_%s.o' % platform, str(int(coaxial)), str(T), str(T), seqfile, outfile, str(int(version))]
 
     if DEBUG: print(' '.join(command))
 
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
+    #vfold precompiled binaries don't work being called from elsewhere
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=DIR)
 
     stdout, stderr = p.communicate()
-    os.chdir(cwd)
 
     if DEBUG:
         print('stdout')
@@ -543,14 +901,17 @@ def pfunc_vfold_(seq, version='0', T=37, coaxial=True, bpps=False, DEBUG=False):
     if p.returncode:
         raise Exception('VfoldThermal_npk failed: on %s\n%s' % (seq, stderr))
 
-    Z=float(stdout.decode('utf-8').split('\n')[-2].split()[1])
+    with open(outfile) as f:
+        Z=float(f.read().split('\n')[-2].split()[1])
 
     os.remove(seqfile)
+    os.remove(outfile)
     return Z, None
     #output: take second field of last line for Z
 
 
-def pfunc_linearpartition_(seq, bpps=False, package='contrafold', beam_size=100, return_free_energy=False, DEBUG=False, threshknot=False):
+def pfunc_linearpartition_(seq, bpps=False, package='contrafold', beam_size=100, return_free_energy=False, DEBUG=False, threshknot=False,
+                           bpp_cutoff=None):
     LOC = package_locs['linearpartition']
     tmp_file = filename()
     tmp_command = filename()
@@ -574,7 +935,7 @@ def pfunc_linearpartition_(seq, bpps=False, package='contrafold', beam_size=100,
     #threshknot threshold set to default 0.3
 
     command=['echo %s | %s/linearpartition_%s' % (seq, LOC, package[0].lower()), str(beam_size),
-     '0', '0', tmp_file, "''", str(pf_only), '0.000001', "''", "''", "''",'%s' % (TK), "''", "''", "''", "''", "''"]
+     '0', '0', tmp_file, "''", str(pf_only), cutoff_arg_(bpp_cutoff, default='0.000001'), "''", "''", "''",'%s' % (TK), "''", "''", "''", "''", "''"]
 
     with open('%s.sh' % tmp_command,'w') as f:
         f.write(' '.join(command))
@@ -582,7 +943,7 @@ def pfunc_linearpartition_(seq, bpps=False, package='contrafold', beam_size=100,
     if DEBUG: print(' '.join(command))
 
     meta_command = ['chmod +x %s.sh; %s.sh' % (tmp_command, tmp_command)]
-    p = sp.Popen(meta_command, stdout=sp.PIPE, stderr=sp.PIPE,shell=True)
+    p = sp.Popen(meta_command, stdout=sp.PIPE, stderr=sp.PIPE, shell=True, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate(input=str.encode(seq))
 
@@ -621,3 +982,68 @@ def pfunc_linearpartition_(seq, bpps=False, package='contrafold', beam_size=100,
                 return free_energy, None
             else:
                 return np.exp(-1*free_energy/(.0019899*(273+T))), None
+
+def pfunc_linearpartition_batch_(seqs, bpps=False, package='contrafold', beam_size=100, return_free_energy=False, DEBUG=False,
+                                 bpp_cutoff=None):
+    """get Z for many sequences from a single LinearPartition process, one sequence per stdin line
+
+    Returns
+        list of floats: Z (or free energy) for each sequence, in input order (zeros if bpps)
+        str: bpp file holding one blank-line-terminated block per sequence (None if not bpps)
+    """
+    LOC = package_locs['linearpartition']
+
+    if bpps:
+        pf_only = 0
+        tmp_file = filename()
+    else:
+        pf_only = 1
+        tmp_file = ''
+
+    # args: beamsize, is_sharpturn, is_verbose, bpp_file, bpp_prefix, pf_only, bpp_cutoff,
+    #forest_file, mea, gamma, TK, threshold, ThreshKnot_prefix, MEA_prefix, MEA_bpseq, shape_file_path
+
+    command=['%s/linearpartition_%s' % (LOC, package[0].lower()), str(beam_size),
+     '0', '0', tmp_file, '', str(pf_only), cutoff_arg_(bpp_cutoff, default='0.000001'), '', '', '', '_', '', '', '', '', '']
+
+    if DEBUG: print(' '.join(command))
+
+    p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
+
+    stdout, stderr = p.communicate(input=str.encode('\n'.join(seqs) + '\n'))
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    if p.returncode:
+        raise Exception('LinearPartition failed: on batch of %d sequences\n%s' % (len(seqs), stderr))
+
+    if bpps:
+        return [0]*len(seqs), tmp_file
+
+    # one line per sequence on stderr: log Z for contrafold/eternafold, ensemble free energy for vienna
+    lines = [line for line in stderr.decode('utf-8').split('\n') if line.strip()]
+    if len(lines) != len(seqs):
+        raise Exception('LinearPartition failed: expected %d outputs, got\n%s' % (len(seqs), stderr))
+
+    Z_list = []
+    for line in lines:
+        if package in ['contrafold','eternafold']:
+            logZ = float(line.split(' ')[-1])
+            if return_free_energy:
+                Z_list.append(-1*logZ)
+            else:
+                Z_list.append(np.exp(logZ))
+
+        elif package=='vienna':
+            free_energy = float(line.split(' ')[-2])
+            T=37
+            if return_free_energy:
+                Z_list.append(free_energy)
+            else:
+                Z_list.append(np.exp(-1*free_energy/(.0019899*(273+T))))
+
+    return Z_list, None
@@ -3,15 +3,15 @@ from arnie.utils import *
 import glob
 from os import getcwd, chdir, remove, mkdir, rmdir, path
 from scipy.optimize import linear_sum_assignment
+import scipy.sparse
 
 
 # TODO script all previous investigations
 # TODO Debug modes to print output and err to help with install issues
 # TODO pk_predict options +
 
-package_locs = load_package_locations()
-
 
+@in_scratch_dir
 def pk_predict(seq, predictor,
                model="default", param="parameters_DP03.txt",
                refinement=1, t1="auto", t2='auto',
@@ -109,6 +109,11 @@ def _hungarian(bpp, exp=1, sigmoid_slope_factor=None, prob_to_0_threshold_prior=
                prob_to_1_threshold_prior=1, theta=0, ln=False, add_p_unpaired=True,
                allowed_buldge_len=0, min_len_helix=2):
 
+    if scipy.sparse.issparse(bpp):
+        bpp = bpp.toarray()
+    else:
+        # copy, the diagonal is overwritten below
+        bpp = np.array(bpp)
     bpp_orig = bpp.copy()
 
     if add_p_unpaired:
@@ -233,21 +238,26 @@ def _threshknot(bpp, theta=0.3, max_iter=1, allowed_buldge_len=0, min_len_helix=
     length = bpp.shape[0]
     bp_list = []
     new_bp = 1
+    if scipy.sparse.issparse(bpp):
+        bpp = bpp.tocoo()
     while new_bp != 0 and iteration <= max_iter:
         current_bp_list = []
         bp_list_flat = np.array(bp_list).flatten()
-        if np.any(bp_list_flat):
-            bpp_update = np.delete(bpp, bp_list_flat, axis=1)
-            if np.any(bpp_update):
-                Pmax = np.amax(bpp_update, axis=1)
+        if scipy.sparse.issparse(bpp):
+            current_bp_list, Pmax = _threshknot_sparse_step(bpp, bp_list_flat, theta, Pmax if iteration else None)
         else:
-            Pmax = np.amax(bpp, axis=1)
-        for i in range(length):
-            for j in range(i + 1, length):
-                if i not in bp_list_flat and j not in bp_list_flat:
-                    prob = bpp[i, j]
-                    if prob == Pmax[i] and prob == Pmax[j] and prob > theta:
-                        current_bp_list.append([i, j])
+            if np.any(bp_list_flat):
+                bpp_update = np.delete(bpp, bp_list_flat, axis=1)
+                if np.any(bpp_update):
+                    Pmax = np.amax(bpp_update, axis=1)
+            else:
+                Pmax = np.amax(bpp, axis=1)
+            for i in range(length):
+                for j in range(i + 1, length):
+                    if i not in bp_list_flat and j not in bp_list_flat:
+                        prob = bpp[i, j]
+                        if prob == Pmax[i] and prob == Pmax[j] and prob > theta:
+                            current_bp_list.append([i, j])
         new_bp = len(current_bp_list)
         iteration += 1
         if new_bp != 0 and iteration > max_iter:
@@ -262,6 +272,23 @@ def _threshknot(bpp, theta=0.3, max_iter=1, allowed_buldge_len=0, min_len_helix=
     return structure, bp_list
 
 
+def _threshknot_sparse_step(bpp, bp_list_flat, theta, Pmax):
+    '''one ThreshKnot round on a symmetric scipy.sparse COO matrix, same result as the dense loop'''
+    paired = np.zeros(bpp.shape[0], dtype=bool)
+    paired[bp_list_flat.astype(int)] = True
+
+    # row maxima over the columns of unpaired bases (bpps are >= 0, so empty rows give 0)
+    cols_left = ~paired[bpp.col]
+    if Pmax is None or np.any(bpp.data[cols_left]):
+        Pmax = np.zeros(bpp.shape[0])
+        np.maximum.at(Pmax, bpp.row[cols_left], bpp.data[cols_left])
+
+    i, j, prob = bpp.row, bpp.col, bpp.data
+    keep = (i < j) & ~paired[i] & ~paired[j] & (prob == Pmax[i]) & (prob == Pmax[j]) & (prob > theta)
+    order = np.lexsort((j[keep], i[keep]))
+    return [[int(a), int(b)] for a, b in zip(i[keep][order], j[keep][order])], Pmax
+
+
 def _check_bp_list(bp_list):
     for bp in bp_list:
         bp.sort()
@@ -293,11 +320,15 @@ def _check_bp_list(bp_list):
 
 def _run_hotknots(seq, model="DP", param="parameters_DP03.txt"):
     hotknot_location = package_locs["hotknots"]
-    cur_dir = getcwd()
-    chdir(hotknot_location)
     command = [f"{hotknot_location}/HotKnots", "-noPS", "-s", seq, "-m", model, "-p", f"{hotknot_location}/params/{param}"]
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
-    out, err = p.communicate()
+    # HotKnots reads its data files relative to its working directory, so link the
+    # install folder into the scratch directory rather than running in the install folder
+    with scratch_dir() as workdir:
+        for name in os.listdir(hotknot_location):
+            if not os.path.lexists(os.path.join(workdir, name)):
+                os.symlink(os.path.join(hotknot_location, name), os.path.join(workdir, name))
+        p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=workdir)
+        out, err = p.communicate()
     if p.returncode:
         print('ERROR: hotknots failed: on %s\n%s\n%s' % (seq, out.decode(), err.decode()))
         return ["x"*len(seq)]
@@ -307,7 +338,6 @@ def _run_hotknots(seq, model="DP", param="parameters_DP03.txt"):
         x = struct.split('\t')
         x2 = [x[0].split(" ")[-1], x[1]]
         structs.append(x2)
-    chdir(cur_dir)
     return structs
 
 
@@ -333,7 +363,7 @@ def _ipknot_mfe(seq, model="LinearPartition-C", refinement=1, t1="auto", t2="aut
     f.write(seq)
     f.close()
     command = [f"{ipknot_location}/ipknot", fasta_file, "--model", model, "-r", str(refinement), "-t", str(t1), "-t", str(t2)]
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
     out, err = p.communicate()
     if p.returncode:
         print('ERROR: ipknot failed: on %s\n%s\n%s' % (seq, out.decode(), err.decode()))
@@ -349,7 +379,7 @@ def _ipknot_mfe(seq, model="LinearPartition-C", refinement=1, t1="auto", t2="aut
 def _knotty_mfe(seq):
     knotty_location = package_locs["knotty"]
     command = [f"{knotty_location}/knotty", seq]
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE,universal_newlines=True)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE,universal_newlines=True, cwd=current_scratch_dir())
     try:
         out, err = p.communicate()
     except:
@@ -382,7 +412,7 @@ def _run_spotrna(seq, cpu=32):
     command = [f"{spotrna_conda_env}/python3", f"{spotrna_location}/SPOT-RNA.py", "--inputs", fasta_file, "--outputs", out_folder, "--cpu", str(cpu)]
     # keep running until output file exists
     while not path.exists(out_folder + "/seq.bpseq"):
-        p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+        p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
         out, err = p.communicate()
         # print(seq, out.decode(),err.decode())
         if p.returncode:
@@ -409,7 +439,7 @@ def _run_spotrna2(seq):
     f.write(seq)
     f.close()
     command = [f"{spotrna2_location}/run_spotrna2.sh", fasta_file]
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
     out, err = p.communicate()
     if p.returncode:
         print('ERROR: spotrna2 failed: on %s\n%s\n%s' % (seq, out.decode(), err.decode()))
@@ -474,7 +504,7 @@ def _e2efold(seq):
     f.close()
     # keep running until output file exists
     while not path.exists(f"{out_folder}/short_cts/temp.seq.ct"):
-        out, err = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE).communicate()
+        out, err = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir()).communicate()
     bp_list = ct_to_bp_list(f"{out_folder}/short_cts/temp.seq.ct", 1)
     struct = convert_bp_list_to_dotbracket(bp_list, len(seq))
     remove(fasta_file)
@@ -502,7 +532,7 @@ def _pknots(seq):
     f.close()
     outfile = f"{out_folder}/out.out"
     command = [pknots_location + "/pknots", "-k", "-g", fasta_file, outfile]
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
     out, err = p.communicate()
     remove(fasta_file)
     if p.returncode:
@@ -526,7 +556,7 @@ def _nupack_mfe_pk(seq):
     f.close()
     struct = None
     command = [nupack_location+'/mfe', "-pseudo", fasta_file]
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
     out,err = p.communicate()
     if p.returncode:
         print(f'ERROR: nupack mfe pk failed on {seq} {fasta_file} {out.decode} {err.decode}')
@@ -0,0 +1,158 @@
+import os
+import numpy as np
+from .utils import *
+from . import parallel
+from .pfunc import pfunc_batch
+
+# 5' and 3' halves of ligand aptamers, as (sequence, constraint) for `write_constraints`
+LIGAND_APTAMERS = {
+    'FMN': (('nAGGAUAU', '(xxxxxx('), ('AGAAGGn', ')xxxxx)')),
+}
+
+# ensemble states needed for the activation ratio, in table order
+SWITCH_STATES = ('free', 'ligand', 'ms2', 'ms2_ligand')
+
+
+def switch_constraints_(seq, ligand=None, ms2=True):
+    '''{state: constraint} for the states of `SWITCH_STATES` that apply (None for the unconstrained state)'''
+    constraints = {'free': None}
+    if ligand is not None:
+        lig1, lig2 = ligand
+        constraints['ligand'] = write_constraints(seq, LIG=True, lig1=lig1, lig2=lig2)
+    if ms2:
+        constraints['ms2'] = write_constraints(seq, MS2=True)
+    if ligand is not None and ms2:
+        constraints['ms2_ligand'] = write_constraints(seq, MS2=True, LIG=True, lig1=lig1, lig2=lig2)
+    return constraints
+
+
+def activation_ratio_batch(designs, ligand='FMN', ms2=True, package='vienna_2', switch='ON', ligand_conc=200.,
+        Kd_ligand=1., Kd_MS2=1., workers=None, **kwargs):
+    ''' Predicted MS2 binding and activation ratios of riboswitch designs, as in the Eterna Cloud Lab / Ribologic analysis.
+
+    Each design needs Z unconstrained, with the ligand aptamer formed, with the MS2 hairpin formed and with both.
+    All constraints are written up front, identical (sequence, constraint) pairs are folded once, and the folds
+    are split between `workers` processes, each running one `pfunc_batch` for its unconstrained and one for its
+    constrained sequences. `pfunc_batch` shares the result cache with `pfunc` (see `arnie.cache`), so
+    repeated designs are not refolded. Everything is combined as log Z, so long designs don't overflow:
+
+        Kd(no ligand) = Kd_MS2 * Z / Z_ms2
+        Kd(ligand) = Kd_MS2 * (Z + Z_ligand*c/Kd_ligand) / (Z_ms2 + Z_ms2_ligand*c/Kd_ligand)
+
+    with c the ligand concentration. For ON switches, Kd_ON is Kd(ligand) and Kd_OFF is Kd(no ligand),
+    the other way around for OFF switches, and AR = Kd_OFF/Kd_ON.
+
+        Args:
+        designs (list): sequences
+        ligand (str or tuple): name from `LIGAND_APTAMERS`, or (lig1, lig2) as in `write_constraints`
+        ms2 (bool): designs carry the MS2 hairpin readout. Without it, only the log Z columns are returned
+        package (str): as in `pfunc`
+        switch (str or list): 'ON' or 'OFF', for all designs or one per design
+        ligand_conc (float): ligand concentration (uM)
+        Kd_ligand (float): dissociation constant of the ligand from the formed aptamer (uM)
+        Kd_MS2 (float): dissociation constant of MS2 coat protein from the formed hairpin; the predicted
+            Kd_ON and Kd_OFF are in its units (default: 1, i.e. relative to it)
+        workers (int): number of worker processes (default: number of cores)
+        kwargs: other options as in `pfunc_batch` (e.g. T, dangles, param_file)
+
+    Returns
+        dict: table of numpy arrays, one row per design (`pandas.DataFrame(table)` makes it a data frame):
+            sequence, switch, log_Z, log_Z_ligand, log_Z_ms2, log_Z_ms2_ligand, log_Kd_ON, log_Kd_OFF,
+            Kd_ON, Kd_OFF, log_AR, AR. Designs whose aptamers aren't found get nan.
+    '''
+    if isinstance(ligand, str):
+        if ligand not in LIGAND_APTAMERS:
+            raise ValueError('Unknown ligand %s, give one of %s or a (lig1, lig2) tuple' % (ligand, sorted(LIGAND_APTAMERS)))
+        ligand = LIGAND_APTAMERS[ligand]
+
+    designs = list(designs)
+    switch = [switch]*len(designs) if isinstance(switch, str) else list(switch)
+    if len(switch) != len(designs):
+        raise ValueError('Need one switch type per design.')
+    if set(s.upper() for s in switch) - {'ON', 'OFF'}:
+        raise ValueError("switch must be 'ON' or 'OFF'")
+
+    states = [state for state in SWITCH_STATES if (state in ['free', 'ms2'] or ligand is not None)
+        and (state in ['free', 'ligand'] or ms2)]
+
+    # every (sequence, constraint) to fold, once
+    unique, index = [], {}
+    rows, failed = [], []
+    for i, seq in enumerate(designs):
+        try:
+            constraints = switch_constraints_(seq, ligand=ligand, ms2=ms2)
+        except RuntimeError:
+            failed.append(i)
+            rows.append(None)
+            continue
+        row = {}
+        for state in states:
+            job = (seq, constraints[state])
+            if job not in index:
+                index[job] = len(unique)
+                unique.append(job)
+            row[state] = index[job]
+        rows.append(row)
+
+    if failed:
+        print('Warning: aptamer not found in %d of %d designs, e.g. %s' % (len(failed), len(designs), designs[failed[0]]))
+
+    log_Z = np.full((len(designs), len(SWITCH_STATES)), np.nan)
+    if unique:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(min(workers, len(unique)), 1)
+
+        chunks = [[unique[j] for j in chunk] for chunk in np.array_split(np.arange(len(unique)), workers) if len(chunk)]
+        results = parallel.map(log_Z_jobs_, chunks, workers=workers, raise_on_error=True, package=package, **kwargs)
+        results = np.array([x for chunk in results for x in chunk])
+
+        for i, row in enumerate(rows):
+            if row is not None:
+                for state, j in row.items():
+                    log_Z[i, SWITCH_STATES.index(state)] = results[j]
+
+    table = {'sequence': np.array(designs), 'switch': np.array([s.upper() for s in switch])}
+    for k, state in enumerate(SWITCH_STATES):
+        if state in states:
+            table['log_Z' if state == 'free' else 'log_Z_%s' % state] = log_Z[:, k]
+
+    if not ms2:
+        return table
+
+    # designs whose aptamers weren't found (already reported above) stay nan
+    ok = ~np.isnan(log_Z[:, [SWITCH_STATES.index(state) for state in states]]).any(axis=1)
+    Z, Z_ms2 = log_Z[ok, 0], log_Z[ok, 2]
+    log_Kd_free = np.full(len(designs), np.nan)
+    log_Kd_free[ok] = np.log(Kd_MS2) + Z - Z_ms2
+    if ligand is None:
+        log_Kd_ligand = log_Kd_free
+    else:
+        f = np.log(ligand_conc/Kd_ligand)
+        log_Kd_ligand = np.full(len(designs), np.nan)
+        log_Kd_ligand[ok] = np.log(Kd_MS2) + np.logaddexp(Z, log_Z[ok, 1] + f) - np.logaddexp(Z_ms2, log_Z[ok, 3] + f)
+
+    on = table['switch'] == 'ON'
+    table['log_Kd_ON'] = np.where(on, log_Kd_ligand, log_Kd_free)
+    table['log_Kd_OFF'] = np.where(on, log_Kd_free, log_Kd_ligand)
+    table['Kd_ON'] = np.exp(table['log_Kd_ON'])
+    table['Kd_OFF'] = np.exp(table['log_Kd_OFF'])
+    table['log_AR'] = table['log_Kd_OFF'] - table['log_Kd_ON']
+    table['AR'] = np.exp(table['log_AR'])
+    return table
+
+
+def log_Z_jobs_(jobs, package='vienna_2', **kwargs):
+    '''log Z of each (sequence, constraint) in `jobs`, from one pfunc_batch for the unconstrained and one for the constrained'''
+    log_Z = [None]*len(jobs)
+    free = [i for i, (_, constraint) in enumerate(jobs) if constraint is None]
+    constrained = [i for i, (_, constraint) in enumerate(jobs) if constraint is not None]
+
+    if free:
+        for i, value in zip(free, pfunc_batch([jobs[i][0] for i in free], package=package, return_log_Z=True, **kwargs)):
+            log_Z[i] = value
+    if constrained:
+        for i, value in zip(constrained, pfunc_batch([jobs[i][0] for i in constrained], package=package,
+                constraint=[jobs[i][1] for i in constrained], return_log_Z=True, **kwargs)):
+            log_Z[i] = value
+    return log_Z
@@ -0,0 +1,325 @@
+import os
+import numpy as np
+from .utils import *
+
+# ViennaRNA's Python bindings are optional, the RNAfold/RNAsubopt binaries are used without them
+try:
+    import RNA
+except ImportError:
+    RNA = None
+
+VIENNA_ENGINES = ['auto', 'rnalib', 'subprocess']
+
+_vienna_engine = None
+
+# mfe energies at or above this mean the constraint can't be satisfied
+_IMPOSSIBLE_ENERGY = 1e5
+
+
+def set_vienna_engine(engine=None):
+    '''Choose how vienna_2 is run for pfunc, bpps, mfe and sample_structures in this process.
+
+    The engine can also be set for every process with the environment variable ARNIE_VIENNA_ENGINE.
+
+    Args:
+        engine (str): 'rnalib' builds a fold compound in-process with the ViennaRNA Python bindings
+            (`import RNA`), 'subprocess' runs RNAfold/RNAsubopt, 'auto' uses rnalib when the bindings
+            are importable. None goes back to $ARNIE_VIENNA_ENGINE, else 'auto'.
+    '''
+    global _vienna_engine
+    if engine is not None and engine not in VIENNA_ENGINES:
+        raise ValueError('vienna engine %s not understood, choose from %s' % (engine, VIENNA_ENGINES))
+    _vienna_engine = engine
+
+
+def vienna_engine():
+    '''Engine selected for vienna_2: 'rnalib' or 'subprocess' (see `set_vienna_engine`)'''
+    engine = _vienna_engine or os.environ.get('ARNIE_VIENNA_ENGINE') or 'auto'
+    if engine not in VIENNA_ENGINES:
+        raise ValueError('ARNIE_VIENNA_ENGINE=%s not understood, choose from %s' % (engine, VIENNA_ENGINES))
+
+    if engine == 'auto':
+        return 'rnalib' if RNA is not None else 'subprocess'
+    if engine == 'rnalib' and RNA is None:
+        raise ImportError('vienna engine rnalib needs the ViennaRNA Python bindings (import RNA)')
+    return engine
+
+
+def vienna_engine_id_():
+    '''engine and library version, so that cached results from the binaries and the bindings aren't mixed'''
+    engine = vienna_engine()
+    if engine == 'rnalib':
+        return 'rnalib-%s' % RNA.__version__
+    return engine
+
+
+def use_rnalib_(version=None, motif=None, param_file=None, probing_signal=None, shapeMethod='W', **kwargs):
+    '''whether a vienna call with these options goes through the Python bindings.
+
+    Options the bindings path doesn't handle (vienna 1, motifs, parameter files, SHAPE methods other than W)
+    stay on the RNAfold/RNAsubopt path. Parameter files can only be loaded into the library's global
+    parameter set, which the bindings keep cached across fold compounds, so loading one in-process
+    would leak into every later call.
+    '''
+    if version and not version.startswith('2'):
+        return False
+    if motif is not None or param_file:
+        return False
+    if probing_signal is not None and shapeMethod != 'W':
+        return False
+    return vienna_engine() == 'rnalib'
+
+
+def model_details_(T=37, dangles=True, uniq_ML=False, compute_bpp=True):
+    '''ViennaRNA model settings, arguments as in `fold_compound_`'''
+    md = RNA.md()
+    md.temperature = float(T)
+    if not dangles:
+        md.dangles = 0
+    if uniq_ML:
+        md.uniq_ML = 1
+    if not compute_bpp:
+        md.compute_bpp = 0
+    return md
+
+
+def fold_compound_(seq, T=37, constraint=None, enforce=True, dangles=True, reweight=None,
+        probing_signal=None, probing_kws=None, uniq_ML=False, compute_bpp=True, DEBUG=False):
+    '''ViennaRNA fold compound with the same model as the corresponding RNAfold command line
+
+    Args:
+        enforce (bool): enforce base pairs in `constraint` (RNAfold --enforceConstraint)
+        uniq_ML (bool): needed for stochastic backtracking
+        compute_bpp (bool): compute base pair probabilities along with the partition function
+        other arguments as in `pfunc_vienna_`
+
+    Returns
+        RNA.fold_compound
+    '''
+    fc = RNA.fold_compound(seq, model_details_(T, dangles=dangles, uniq_ML=uniq_ML, compute_bpp=compute_bpp))
+
+    if constraint is not None:
+        options = RNA.CONSTRAINT_DB_DEFAULT
+        if enforce:
+            options |= RNA.CONSTRAINT_DB_ENFORCE_BP
+        if not fc.hc_add_from_db(constraint, options):
+            raise ValueError('Constraint %s could not be applied to %s' % (constraint, seq))
+
+    if reweight is not None:
+        fc.file_commands_apply(reweight)
+
+    if probing_signal is not None:
+        # perturbation energies for unpaired nucleotides, as RNAfold --shapeMethod=W
+        if probing_kws is None:
+            probing_kws = {}
+        probing_file = run_RNAPVmin(probing_signal, seq, package_locs['vienna_2'], DEBUG, **probing_kws)
+        values, _, _ = RNA.file_SHAPE_read(probing_file, len(seq), 0)
+        os.remove(probing_file)
+        fc.sc_set_up(list(values))
+
+    return fc
+
+
+def mfe_rnalib_(seq, return_dG_MFE=False, **kwargs):
+    '''MFE structure from the Python bindings, arguments as in `fold_compound_`
+
+    Returns
+        str (, float): MFE structure (and its free energy)
+    '''
+    struct, dG_MFE = fold_compound_(seq, **kwargs).mfe()
+
+    if dG_MFE >= _IMPOSSIBLE_ENERGY:
+        raise ValueError('Constraint caused impossible structure')
+
+    if return_dG_MFE:
+        return struct, dG_MFE
+    return struct
+
+
+def log_Z_rnalib_(fc, free_energy):
+    '''natural log of Z from the ensemble free energy of `fc`, with the fold compound's own kT'''
+    return -1*free_energy/(fc.exp_params.kT/1000)
+
+
+def bpps_rnalib_(fc, N, sparse=False, bpp_cutoff=None):
+    '''Base pair probabilities of a fold compound after fc.pf()
+
+    A sparse matrix is built from fc.plist_from_probs(), which only lists the pairs above
+    the cutoff, so the dense NxN matrix of fc.bpp() is only made when a dense one is asked for.
+
+    Args:
+        N (int): sequence length
+        sparse, bpp_cutoff: as in `pfunc_rnalib_`
+
+    Returns
+        NxN array or scipy.sparse.csr_matrix
+    '''
+    cutoff = 1e-10 if bpp_cutoff is None else bpp_cutoff
+    if sparse:
+        # plist entries are 1-indexed, i < j
+        plist = fc.plist_from_probs(cutoff)
+        i = np.fromiter((x.i - 1 for x in plist), np.int64, len(plist))
+        j = np.fromiter((x.j - 1 for x in plist), np.int64, len(plist))
+        p = np.fromiter((x.p for x in plist), np.float64, len(plist))
+        return bpp_matrix_from_pairs(i, j, p, N, sparse=True, cutoff=cutoff)
+
+    # fc.bpp() is the 1-indexed upper triangle
+    P = np.array(fc.bpp())[1:, 1:]
+    i, j = np.nonzero(P)
+    return bpp_matrix_from_pairs(i, j, P[i, j], N, cutoff=cutoff)
+
+
+def pfunc_rnalib_(seq, T=37, bpps=False, sparse=False, bpp_cutoff=None, return_log_Z=False, **kwargs):
+    '''Ensemble free energy, and optionally base pair probabilities, from one fold compound
+
+    Args:
+        bpps (bool): also compute base pair probabilities
+        sparse (bool): return bpps as a scipy.sparse CSR matrix
+        bpp_cutoff (float): drop pairs with probability below this (default: 1e-10, as RNAfold's dot plot)
+        return_log_Z (bool): also return log Z, with the fold compound's own kT
+        other arguments as in `fold_compound_`
+
+    Returns
+        float (, float) (, array): ensemble free energy (np.inf for an impossible constraint), log Z if
+            return_log_Z, and NxN bpps if bpps=True
+    '''
+    fc = fold_compound_(seq, T=T, compute_bpp=bpps, **kwargs)
+
+    # scale Boltzmann factors by the MFE like RNAfold does, so long sequences don't overflow
+    _, dG_MFE = fc.mfe()
+    if dG_MFE >= _IMPOSSIBLE_ENERGY:
+        free_energy, log_Z = np.inf, -np.inf
+        bpp = bpp_matrix_from_pairs([], [], [], len(seq), sparse=sparse) if bpps else None
+    else:
+        fc.exp_params_rescale(dG_MFE)
+        _, free_energy = fc.pf()
+        log_Z = log_Z_rnalib_(fc, free_energy)
+        bpp = bpps_rnalib_(fc, len(seq), sparse=sparse, bpp_cutoff=bpp_cutoff) if bpps else None
+
+    values = (free_energy,) + ((log_Z,) if return_log_Z else ()) + ((bpp,) if bpps else ())
+    return values if len(values) > 1 else free_energy
+
+
+def log_Z_rnalib_(fc, free_energy):
+    '''natural log of Z from the ensemble free energy of `fc`, with the fold compound's own kT'''
+    return -1*free_energy/(fc.exp_params.kT/1000)
+
+
+def bpps_rnalib_(fc, N, sparse=False, bpp_cutoff=None):
+    '''Base pair probabilities of a fold compound after fc.pf()
+
+    A sparse matrix is built from fc.plist_from_probs(), which only lists the pairs above
+    the cutoff, so the dense NxN matrix of fc.bpp() is only made when a dense one is asked for.
+
+    Args:
+        N (int): sequence length
+        sparse, bpp_cutoff: as in `pfunc_rnalib_`
+
+    Returns
+        NxN array or scipy.sparse.csr_matrix
+    '''
+    cutoff = 1e-10 if bpp_cutoff is None else bpp_cutoff
+    if sparse:
+        # plist entries are 1-indexed, i < j
+        plist = fc.plist_from_probs(cutoff)
+        i = np.fromiter((x.i - 1 for x in plist), np.int64, len(plist))
+        j = np.fromiter((x.j - 1 for x in plist), np.int64, len(plist))
+        p = np.fromiter((x.p for x in plist), np.float64, len(plist))
+        return bpp_matrix_from_pairs(i, j, p, N, sparse=True, cutoff=cutoff)
+
+    # fc.bpp() is the 1-indexed upper triangle
+    P = np.array(fc.bpp())[1:, 1:]
+    i, j = np.nonzero(P)
+    return bpp_matrix_from_pairs(i, j, P[i, j], N, cutoff=cutoff)
+
+
+def pfunc_rnalib_(seq, T=37, bpps=False, sparse=False, bpp_cutoff=None, return_log_Z=False, **kwargs):
+    '''Ensemble free energy, and optionally base pair probabilities, from one fold compound
+
+    Args:
+        bpps (bool): also compute base pair probabilities
+        sparse (bool): return bpps as a scipy.sparse CSR matrix
+        bpp_cutoff (float): drop pairs with probability below this (default: 1e-10, as RNAfold's dot plot)
+        return_log_Z (bool): also return log Z, with the fold compound's own kT
+        other arguments as in `fold_compound_`
+
+    Returns
+        float (, float) (, array): ensemble free energy (np.inf for an impossible constraint), log Z if
+            return_log_Z, and NxN bpps if bpps=True
+    '''
+    fc = fold_compound_(seq, T=T, compute_bpp=bpps, **kwargs)
+
+    # scale Boltzmann factors by the MFE like RNAfold does, so long sequences don't overflow
+    _, dG_MFE = fc.mfe()
+    if dG_MFE >= _IMPOSSIBLE_ENERGY:
+        values = (np.inf, -np.inf) if return_log_Z else (np.inf,)
+        if bpps:
+            return values + (bpp_matrix_from_pairs([], [], [], len(seq), sparse=sparse),)
+        return values if return_log_Z else values[0]
+
+    fc.exp_params_rescale(dG_MFE)
+    _, free_energy = fc.pf()
+    values = (free_energy, log_Z_rnalib_(fc, free_energy)) if return_log_Z else (free_energy,)
+
+    if not bpps:
+        return values if return_log_Z else free_energy
+
+    return values + (bpps_rnalib_(fc, len(seq), sparse=sparse, bpp_cutoff=bpp_cutoff),)
+
+
+def sample_rnalib_(seq, n_samples=10, constraint=None, nonredundant=False, **kwargs):
+    '''Structures sampled from the Boltzmann ensemble, as RNAsubopt --stochBT_en
+
+    Args:
+        nonredundant (bool): don't draw the same structure twice (RNAsubopt -N)
+        other arguments as in `fold_compound_`
+
+    Returns
+        list: sampled structures
+    '''
+    # RNAsubopt doesn't enforce constrained pairs
+    fc = fold_compound_(seq, constraint=constraint, enforce=False, uniq_ML=True, **kwargs)
+
+    _, dG_MFE = fc.mfe()
+    if dG_MFE >= _IMPOSSIBLE_ENERGY:
+        raise RuntimeError('Constraint omitted, Impossible structure')
+    fc.exp_params_rescale(dG_MFE)
+    fc.pf()
+
+    if nonredundant:
+        return list(fc.pbacktrack(n_samples, RNA.PBACKTRACK_NON_REDUNDANT))
+    return list(fc.pbacktrack(n_samples))
+
+
+def ensemble_rnalib_(seq, want, T=37, sparse=False, bpp_cutoff=None, **kwargs):
+    '''Ensemble quantities from one fold compound, as one RNAfold -p --MEA run
+
+    Args:
+        want (set): quantities to compute, as in `fold_ensemble`
+        other arguments as in `pfunc_rnalib_`
+
+    Returns
+        dict: mfe, dG_MFE and whichever of free_energy, log_Z, bpps, centroid, mea that `want` needs
+    '''
+    want_bpps = bool(want & {'bpps', 'mea', 'centroid', 'punp'})
+    fc = fold_compound_(seq, T=T, compute_bpp=want_bpps, **kwargs)
+
+    struct, dG_MFE = fc.mfe()
+    if dG_MFE >= _IMPOSSIBLE_ENERGY:
+        raise ValueError('Constraint caused impossible structure')
+    values = {'mfe': struct, 'dG_MFE': dG_MFE}
+
+    if not want_bpps and 'Z' not in want:
+        return values
+
+    fc.exp_params_rescale(dG_MFE)
+    _, values['free_energy'] = fc.pf()
+    values['log_Z'] = log_Z_rnalib_(fc, values['free_energy'])
+
+    if want_bpps:
+        values['bpps'] = bpps_rnalib_(fc, len(seq), sparse=sparse, bpp_cutoff=bpp_cutoff)
+        values['centroid'] = fc.centroid()[0]
+        if 'mea' in want:
+            values['mea'] = fc.MEA()[0]
+
+    return values
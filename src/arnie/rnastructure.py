@@ -0,0 +1,139 @@
+import os, shutil, tempfile, weakref
+import subprocess as sp
+import numpy as np
+from .utils import *
+from .pfunc import pfunc_rnastructure_, log_Z_, Z_kT_
+from .bpps import bpps_rnastructure_
+
+
+class RNAstructurePartition:
+    '''RNAstructure partition function save file (.pfs) for one sequence, kept for the lifetime of the object.
+
+    `partition` runs once, when the object is made. Ensemble energy, bpps, stochastic samples, MEA
+    (MaxExpect) and ProbKnot structures are then all read from the same .pfs, so each extra quantity
+    costs a cheap post-processing run instead of another partition function calculation.
+
+    `threads` runs partition-smp instead of partition, as in `pfunc`.
+
+    The .pfs lives in a private scratch directory that is removed by `close()`, at the end of a
+    `with` block, or when the object is garbage collected.
+
+    Example:
+        with RNAstructurePartition(seq, T=37) as pf:
+            Z, bpp = pf.Z, pf.bpps()
+            samples = pf.sample(1000)
+            mea, pk = pf.mea(gamma=1), pf.probknot()
+    '''
+
+    def __init__(self, seq, T=37, constraint=None, coaxial=True, threads=None, DEBUG=False):
+        self.seq = seq
+        self.T = T
+        self.DEBUG = DEBUG
+        self._free_energy = None
+
+        self.path = tempfile.mkdtemp(prefix='arnie_pfs_', dir=get_scratch_root())
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+        with scratch_dir(self.path):
+            _, self.pfs_file = pfunc_rnastructure_(seq, T=T, constraint=constraint, coaxial=coaxial,
+                bpps=True, DEBUG=DEBUG, threads=threads)
+
+    def close(self):
+        '''delete the .pfs file'''
+        self._finalizer()
+
+    @property
+    def closed(self):
+        return not self._finalizer.alive
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return '<RNAstructurePartition %d nt, T=%s%s>' % (len(self.seq), self.T, ', closed' if self.closed else '')
+
+    def _run(self, program, args):
+        if self.closed:
+            raise ValueError('RNAstructurePartition is closed')
+
+        command = ['%s/%s' % (package_locs['rnastructure'], program), self.pfs_file] + [str(x) for x in args]
+        if self.DEBUG: print(' '.join(command))
+        p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=self.path)
+        stdout, stderr = p.communicate()
+
+        if self.DEBUG:
+            print('stdout')
+            print(stdout)
+            print('stderr')
+            print(stderr)
+
+        if p.returncode:
+            raise Exception('RNAstructure %s failed: on %s\n%s' % (program, self.seq, stderr))
+        return stdout.decode('utf-8')
+
+    def _structures(self, program, args):
+        with scratch_dir(self.path):
+            ct_fname = '%s.ct' % filename()
+        self._run(program, [ct_fname] + list(args))
+        structs = ct_to_dotbrackets_(ct_fname)
+        os.remove(ct_fname)
+        return structs
+
+    @property
+    def free_energy(self):
+        '''ensemble free energy (kcal/mol), from EnsembleEnergy'''
+        if self._free_energy is None:
+            stdout = self._run('EnsembleEnergy', [])
+            self._free_energy = float(stdout.split('\n')[3].split(' ')[-2])
+        return self._free_energy
+
+    @property
+    def log_Z(self):
+        '''natural log of the partition function, as returned by `pfunc(..., return_log_Z=True)`'''
+        return log_Z_(self.free_energy, 'rnastructure', T=self.T)
+
+    @property
+    def Z(self):
+        '''partition function, as returned by `pfunc(..., package='rnastructure')`'''
+        return np.exp(-1*self.free_energy/Z_kT_('rnastructure', self.T))
+
+    def bpps(self, sparse=False, bpp_cutoff=None):
+        '''NxN base pair probabilities, from ProbabilityPlot (as in `bpps`)'''
+        if self.closed:
+            raise ValueError('RNAstructurePartition is closed')
+        with scratch_dir(self.path):
+            return bpps_rnastructure_(self.seq, self.pfs_file, DEBUG=self.DEBUG, sparse=sparse,
+                bpp_cutoff=bpp_cutoff, keep_pfs=True)
+
+    def sample(self, n_samples=1000, seed=None):
+        '''list of structures drawn from the Boltzmann ensemble, with `stochastic`'''
+        args = ['--ensemble', n_samples]
+        if seed is not None:
+            args.extend(['--seed', seed])
+        return self._structures('stochastic', args)
+
+    def mea(self, gamma=1.0):
+        '''maximum expected accuracy structure, from MaxExpect'''
+        return self._structures('MaxExpect', ['--gamma', gamma, '--structures', 1])[0]
+
+    def probknot(self, iterations=1, min_helix_length=3):
+        '''pseudoknotted ProbKnot structure, with brackets as in `convert_bp_list_to_dotbracket`'''
+        return self._structures('ProbKnot', ['--iterations', iterations, '--minimum', min_helix_length])[0]
+
+
+def ct_to_dotbrackets_(ct_file):
+    '''dot-brackets of every structure in a (multi-structure) CT file'''
+    with open(ct_file) as f:
+        lines = [line.split() for line in f if line.strip()]
+
+    structs = []
+    k = 0
+    while k < len(lines):
+        N = int(lines[k][0])
+        bp_list = [[int(row[0])-1, int(row[4])-1] for row in lines[k+1:k+1+N] if int(row[4]) > int(row[0])]
+        structs.append(convert_bp_list_to_dotbracket(bp_list, N))
+        k += N+1
+    return structs
@@ -3,15 +3,15 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
+from .rnalib import use_rnalib_, sample_rnalib_
 
 DEBUG=False
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
+@in_scratch_dir
 def sample_structures(seq, n_samples = 10, package='vienna_2', T=37, constraint=None, param_file=None,
 	dangles=True, reweight=None, nonredundant=False):
     ''' Draw stochastic sampled structures for RNA sequence. Possible packages: 'eternafold', 'vienna_2'
+        (vienna_2 samples in-process with the ViennaRNA Python bindings when they are installed, see `rnalib.set_vienna_engine`)
 
         Args:
         seq (str): nucleic acid sequence
@@ -35,9 +35,13 @@ def sample_structures(seq, n_samples = 10, package='vienna_2', T=37, constraint=
     if not dangles and pkg not in ['vienna','nupack']:
         print('Warning: %s does not support dangles options' % pkg)
 
-    if pkg=='vienna':
+    if pkg=='vienna' and use_rnalib_(version=version, param_file=param_file):
+        struct_list = sample_rnalib_(seq, n_samples=n_samples, T=T, dangles=dangles, constraint=constraint,
+            reweight=reweight, nonredundant=nonredundant)
+
+    elif pkg=='vienna':
         struct_list = sample_vienna_(seq, n_samples=n_samples, version=version, T=T, 
-        	dangles=dangles, constraint=constraint, reweight=reweight, nonredundant = nonredundant)
+        	dangles=dangles, constraint=constraint, reweight=reweight, nonredundant = nonredundant, param_file=param_file)
 
     elif pkg=='eternafold':
         struct_list = sample_eternafold_(seq, n_samples=n_samples, param_file=param_file, constraint=constraint, nonredundant = nonredundant)
@@ -48,7 +52,7 @@ def sample_structures(seq, n_samples = 10, package='vienna_2', T=37, constraint=
     return struct_list
 
 def sample_vienna_(seq, n_samples=10, T=37, version='2', constraint=None, 
-	dangles=True, reweight=None, nonredundant=False):
+	dangles=True, reweight=None, nonredundant=False, param_file=None):
     """Stochastically sample structures from Vienna RNAsubopt.
 
     Inputs:
@@ -89,10 +93,13 @@ def sample_vienna_(seq, n_samples=10, T=37, version='2', constraint=None,
     if reweight is not None:
         command.append('--commands=%s' % reweight)
 
+    if param_file:
+        command.append('--paramFile=%s' % param_file)
+
     with open(fname) as f:
         if DEBUG: print(fname)
         if DEBUG: print(' '.join(command))
-        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE)
+        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
     stdout, stderr = p.communicate()
 
     if DEBUG:
@@ -150,7 +157,7 @@ def sample_eternafold_(seq, n_samples=10, param_file=None, constraint=None, nonr
 
     if DEBUG: print(' '.join(command))
 
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
 
     stdout, stderr = p.communicate()
 
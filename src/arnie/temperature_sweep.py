@@ -0,0 +1,147 @@
+import os
+import numpy as np
+from .utils import *
+from . import parallel
+from .pfunc import kT_
+from .ensemble import fold_ensemble
+from .rnalib import use_rnalib_, fold_compound_, model_details_, bpps_rnalib_, log_Z_rnalib_
+
+SWEEP_OUTPUTS = ('log_Z', 'punp', 'bpps')
+
+
+class TemperatureSweep:
+    '''Ensemble quantities of one sequence over a range of temperatures, as returned by `temperature_sweep`.
+
+    Attributes:
+        temps (array): temperatures (Celsius), in the order given
+        log_Z (array): natural log of the partition function at each temperature (None if not computed)
+        punp (array): TxN probability of each nucleotide being unpaired (None if not computed)
+        bpps (list): NxN scipy.sparse CSR base pair probabilities at each temperature (None if not kept)
+    '''
+
+    def __init__(self, seq, package, temps, log_Z=None, punp=None, bpps=None):
+        self.seq = seq
+        self.package = package
+        self.temps = temps
+        self.log_Z = log_Z
+        self.punp = punp
+        self.bpps = bpps
+
+    @property
+    def free_energy(self):
+        '''ensemble free energy (kcal/mol) at each temperature'''
+        if self.log_Z is None:
+            raise ValueError("free energies need outputs=('log_Z', ...)")
+        return -1*kT_(self.package, self.temps)*self.log_Z
+
+    def heat_capacity(self):
+        '''heat capacity C = -T d^2G/dT^2 (kcal/mol/K) at each temperature, by finite differences.
+
+        Needs log_Z at three or more increasing temperatures; a finer grid gives a better estimate.
+        '''
+        temps = np.asarray(self.temps, dtype=float)
+        if len(temps) < 3 or np.any(np.diff(temps) <= 0):
+            raise ValueError('heat capacity needs at least 3 increasing temperatures')
+        dG = np.gradient(self.free_energy, temps, edge_order=2)
+        return -1*(273.15+temps)*np.gradient(dG, temps, edge_order=2)
+
+    def fraction_unfolded(self):
+        '''fraction of nucleotides unpaired at each temperature, the melt curve seen by e.g. UV absorbance'''
+        if self.punp is None:
+            raise ValueError("fraction unfolded needs outputs=('punp', ...) or ('bpps', ...)")
+        return self.punp.mean(axis=1)
+
+    def __repr__(self):
+        return '<TemperatureSweep %s, %d nt, %d temperatures from %s to %s>' % (self.package, len(self.seq),
+            len(self.temps), min(self.temps), max(self.temps))
+
+
+def temperature_sweep(seq, temps, package='vienna_2', outputs=SWEEP_OUTPUTS, workers=None, bpp_cutoff=None, **kwargs):
+    ''' Compute ensemble quantities for RNA sequence at many temperatures, e.g. for melt curves.
+
+    Temperatures are split between `workers` processes (see `arnie.parallel.map`). For vienna_2 with the
+    in-process engine (see `rnalib.set_vienna_engine`), each worker folds all its temperatures with one
+    fold compound, only recomputing the energy parameters. Other packages run `fold_ensemble` at each
+    temperature, so that e.g. RNAfold gives Z and bpps from one run.
+
+        Args:
+        seq (str): nucleic acid sequence
+        temps (list): temperatures (Celsius)
+        package (str): as in `fold_ensemble`
+        outputs (iterable): quantities to compute, from 'log_Z', 'punp', 'bpps'
+        workers (int): number of worker processes (default: number of cores, at most one per temperature)
+        bpp_cutoff (float): drop pairs with probability below this, as in `bpps`
+        kwargs: other options as in `fold_ensemble` (e.g. constraint, dangles, param_file)
+
+    Returns
+        TemperatureSweep: stacked results, with `heat_capacity()` and `fraction_unfolded()` curves
+    '''
+    outputs = set(outputs)
+    unknown = outputs - set(SWEEP_OUTPUTS)
+    if unknown:
+        raise ValueError('Unknown sweep outputs %s, choose from %s' % (sorted(unknown), SWEEP_OUTPUTS))
+
+    temps = np.asarray(temps, dtype=float)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(min(workers, len(temps)), 1)
+
+    # one chunk of temperatures per worker, so each worker sets up its fold compound once
+    chunks = [list(chunk) for chunk in np.array_split(temps, workers) if len(chunk)]
+    results = parallel.map(sweep_temperatures_, chunks, workers=workers, raise_on_error=True,
+        seq=seq, package=package, outputs=outputs, bpp_cutoff=bpp_cutoff, **kwargs)
+    results = [x for chunk in results for x in chunk]
+
+    sweep = TemperatureSweep(seq, package, temps)
+    if 'log_Z' in outputs:
+        sweep.log_Z = np.array([log_Z for log_Z, _ in results])
+    if outputs & {'punp', 'bpps'}:
+        bpp_list = [bpp for _, bpp in results]
+        if 'punp' in outputs:
+            sweep.punp = np.vstack([1 - np.asarray(bpp.sum(axis=0)).ravel() for bpp in bpp_list])
+        if 'bpps' in outputs:
+            sweep.bpps = bpp_list
+    return sweep
+
+
+def sweep_temperatures_(temps, seq=None, package='vienna_2', outputs=SWEEP_OUTPUTS, bpp_cutoff=None, **kwargs):
+    '''log Z and sparse bpps (None where not in `outputs`) at each of `temps`, for one worker'''
+    want_bpps = bool(set(outputs) & {'punp', 'bpps'})
+
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    if pkg == 'vienna' and not kwargs.get('linear') and use_rnalib_(version=version, **kwargs):
+        options = {k: v for k, v in kwargs.items() if k in ['constraint', 'dangles', 'reweight', 'probing_signal', 'probing_kws']}
+        fc = fold_compound_(seq, T=temps[0], compute_bpp=want_bpps, **options)
+
+        results = []
+        for T in temps:
+            # constraints stay on the fold compound, only the energy parameters change
+            md = model_details_(T, dangles=kwargs.get('dangles', True), compute_bpp=want_bpps)
+            fc.params_reset(md)
+            fc.exp_params_reset(md)
+
+            _, dG_MFE = fc.mfe()
+            fc.exp_params_rescale(dG_MFE)
+            _, free_energy = fc.pf()
+
+            bpp = None
+            if want_bpps:
+                bpp = bpps_rnalib_(fc, len(seq), sparse=True, bpp_cutoff=bpp_cutoff)
+            results.append((log_Z_rnalib_(fc, free_energy), bpp))
+        return results
+
+    want = set()
+    if 'log_Z' in outputs:
+        want.add('Z')
+    if want_bpps:
+        want.add('bpps')
+
+    results = []
+    for T in temps:
+        res = fold_ensemble(seq, package=package, want=want, T=T, sparse=True, bpp_cutoff=bpp_cutoff, **kwargs)
+        results.append((res.log_Z if 'Z' in want else None, res.bpps if want_bpps else None))
+    return results
@@ -1,9 +1,18 @@
 import os
 import re
+import shutil
 import subprocess as sp
 import random
 import string
+import tempfile
+import threading
+import functools
+import inspect
+import hashlib
+from collections.abc import Mapping
+from contextlib import contextmanager
 import numpy as np
+import scipy.sparse
 import arnie
 
 
@@ -23,7 +32,7 @@ def run_RNAPVmin(probing_signal, seq, LOC, DEBUG, tauSigmaRatio=1, shapeConversi
             print(fname)
         if DEBUG:
             print(' '.join(RNApvmin_command))
-        p = sp.Popen(RNApvmin_command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE)
+        p = sp.Popen(RNApvmin_command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
     rnapvmin_stdout, rnapvmin_stderr = p.communicate()
 
     shape_file = filename()
@@ -43,6 +52,85 @@ def run_RNAPVmin(probing_signal, seq, LOC, DEBUG, tauSigmaRatio=1, shapeConversi
     return shape_file
 
 
+def run_contrafold_batch(LOC, seqs, constraints=None, options=None, output=None, DEBUG=False):
+    '''Run a single `contrafold predict` over many sequences (one input file per sequence).
+
+    Args:
+      LOC (str): contrafold binary, or directory containing it
+      seqs (list): nucleic acid sequences
+      constraints (list): structure constraints, one per sequence (or None)
+      options (list): extra command line options, e.g. ['--params', param_file, '--partition']
+      output (list): output option and its arguments without the destination,
+        e.g. ['--posteriors', '0.0000000001'] or ['--parens']. Destinations are filled in per sequence.
+
+    Returns:
+      str: contrafold stdout
+      list: name of the input file used for each sequence (as contrafold reports it on stdout)
+      list: output file for each sequence, moved to TMP (None if no output option was given)
+    '''
+    batch_dir = filename()
+    os.mkdir(batch_dir)
+
+    in_fnames = ['%s/%06d.in' % (batch_dir, i) for i in range(len(seqs))]
+    for i, (seq, fname) in enumerate(zip(seqs, in_fnames)):
+        if constraints is not None and constraints[i] is not None:
+            convert_dbn_to_contrafold_input(seq, constraints[i], fname)
+        else:
+            convert_dbn_to_contrafold_input(seq, '.'*len(seq), fname)
+
+    if not os.path.isdir(LOC):
+        command = ['%s' % LOC, 'predict'] + in_fnames
+    else:
+        command = ['%s/contrafold' % LOC, 'predict'] + in_fnames
+
+    if options is not None:
+        command = command + options
+
+    if constraints is not None:
+        command.append('--constraints')
+
+    batch_out_fnames = [None]*len(seqs)
+    if output is not None:
+        # with several inputs contrafold treats the destination as a directory,
+        # writing one file per input named after the input file
+        if len(seqs) == 1:
+            batch_out_fnames = ['%s/000000.out' % batch_dir]
+            command = command + output + [batch_out_fnames[0]]
+        else:
+            out_dir = '%s/out' % batch_dir
+            batch_out_fnames = ['%s/%s' % (out_dir, os.path.basename(fname)) for fname in in_fnames]
+            command = command + output + [out_dir]
+
+    if DEBUG: print(' '.join(command))
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=current_scratch_dir())
+
+    stdout, stderr = p.communicate()
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    try:
+        if p.returncode:
+            raise Exception('Contrafold failed: on batch of %d sequences\n%s' % (len(seqs), stderr))
+
+        out_fnames = []
+        for fname in batch_out_fnames:
+            if fname is None:
+                out_fnames.append(None)
+            else:
+                if not os.path.exists(fname):
+                    raise Exception('Contrafold failed: missing output %s\n%s' % (fname, stderr))
+                out_fnames.append('%s.%s' % (filename(), output[0].strip('-')))
+                os.replace(fname, out_fnames[-1])
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+    return stdout.decode('utf-8'), in_fnames, out_fnames
+
+
 ###############################################################################
 # File writing
 ###############################################################################
@@ -161,26 +249,167 @@ def local_rand_filename(n=6):
 
 def get_random_folder(n=6):
     """ generate randome foldername
-    that does not exist in current folder"""
-    out_folder = ''.join([random.choice(string.ascii_lowercase) for _ in range(n)])
+    that does not exist in the scratch (or TMP) folder"""
+    tmpdir = current_scratch_dir()
+    if tmpdir is None:
+        tmpdir = package_locs['TMP']
+    out_folder = f'{tmpdir}/{local_rand_filename(n)}'
     while os.path.isdir(out_folder):
-        out_folder = ''.join([random.choice(string.ascii_lowercase) for _ in range(n)])
-    tmpdir = load_package_locations()['TMP']
-    out_folder = f'{tmpdir}/{out_folder}'
+        out_folder = f'{tmpdir}/{local_rand_filename(n)}'
     return out_folder
 
 
 def filename(n=6):
-    """generate random filename
+    """generate random filename, inside the current scratch directory if there is one
 
     Args:
       n (int): number of characters
     """
     rand = ''.join([random.choice(string.ascii_lowercase) for _ in range(n)])
-    tmpdir = load_package_locations()['TMP']
+    tmpdir = current_scratch_dir()
+    if tmpdir is None:
+        tmpdir = package_locs['TMP']
     return '%s/%s' % (tmpdir, rand)
 
 
+###############################################################################
+# Scratch directories
+###############################################################################
+
+# per-thread stack of active scratch directories
+_scratch = threading.local()
+
+
+def get_scratch_root():
+    """directory in which scratch directories are made: $ARNIE_SCRATCH if set,
+    else tmpfs (/dev/shm) when available, else the TMP folder"""
+    if os.environ.get('ARNIE_SCRATCH'):
+        return os.path.abspath(os.environ['ARNIE_SCRATCH'])
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+        return '/dev/shm'
+    return os.path.abspath(package_locs['TMP'])
+
+
+def current_scratch_dir():
+    """the calling thread's active scratch directory, or None"""
+    stack = getattr(_scratch, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+def scratch_path(fname):
+    """path of a file that a package writes to its working directory"""
+    tmpdir = current_scratch_dir()
+    if tmpdir is None:
+        return fname
+    return os.path.join(tmpdir, fname)
+
+
+@contextmanager
+def scratch_dir(path=None):
+    """Give the calling thread a private working directory for package calls.
+
+    While active, `filename()` and `write()` put temporary files in it, and package
+    wrappers run their subprocesses with it as working directory, so files packages
+    drop in their cwd (dot plots, rna.ps, ...) can't collide between concurrent calls.
+    Nested uses share the outermost directory. A directory created here is deleted on
+    exit, whether the call succeeded, raised or was interrupted.
+
+    Args:
+      path (str): use this existing directory instead of making one (it is not deleted)
+    """
+    if not hasattr(_scratch, 'stack'):
+        _scratch.stack = []
+
+    if path is None and _scratch.stack:
+        yield _scratch.stack[-1]
+        return
+
+    created = path is None
+    if created:
+        path = tempfile.mkdtemp(prefix='arnie_', dir=get_scratch_root())
+
+    _scratch.stack.append(path)
+    try:
+        yield path
+    finally:
+        _scratch.stack.pop()
+        if created:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def in_scratch_dir(func):
+    """Decorator running a package wrapper inside `scratch_dir()`.
+
+    Files handed back to the caller (as in `pfunc(..., bpps=True)`) are moved
+    out to the TMP folder before the scratch directory is removed."""
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current_scratch_dir() is not None:
+            return func(*args, **kwargs)
+
+        # user files are given relative to the caller's cwd, not the scratch directory,
+        # whether they are passed by position, by keyword or through **kwargs
+        bound = signature.bind(*args, **kwargs)
+        for arguments in [bound.arguments] + [v for k, v in bound.arguments.items()
+                                              if signature.parameters[k].kind == inspect.Parameter.VAR_KEYWORD]:
+            for key in ['param_file', 'reweight']:
+                if isinstance(arguments.get(key), str) and os.path.exists(arguments[key]):
+                    arguments[key] = os.path.abspath(arguments[key])
+
+        with scratch_dir() as path:
+            result = func(*bound.args, **bound.kwargs)
+
+            if isinstance(result, tuple):
+                result = tuple(_keep_scratch_file(x, path) for x in result)
+            return result
+
+    return wrapper
+
+
+def _keep_scratch_file(x, path):
+    if isinstance(x, str) and x.startswith(path + os.sep) and os.path.isfile(x):
+        kept = '%s/%s%s' % (package_locs['TMP'], local_rand_filename(), os.path.splitext(x)[1])
+        shutil.move(x, kept)
+        return kept
+    return x
+
+
+###############################################################################
+# Threads
+###############################################################################
+
+def thread_budget():
+    """number of threads a multithreaded package call may use: $ARNIE_THREADS if set
+    (`arnie.parallel.map` sets it to each worker's share of the cores), else all cores"""
+    if os.environ.get('ARNIE_THREADS'):
+        return max(int(os.environ['ARNIE_THREADS']), 1)
+    return os.cpu_count() or 1
+
+
+def rnastructure_program_(program, threads=None):
+    """path of an RNAstructure program, and the environment to run it in (None: inherit)
+
+    With threads, the SMP build `<program>-smp` is used if it is installed, limited to that
+    many OpenMP threads ('auto': `thread_budget()`). Otherwise the serial program is used."""
+    LOC = package_locs['rnastructure']
+    serial = '%s/%s' % (LOC, program)
+    if threads is None:
+        return serial, None
+
+    if threads == 'auto':
+        threads = thread_budget()
+    smp = '%s-smp' % serial
+    if not os.path.exists(smp):
+        if threads > 1:
+            print('Warning: %s not found, running serial %s' % (smp, program))
+        return serial, None
+    return smp, dict(os.environ, OMP_NUM_THREADS=str(int(threads)))
+
+
 def write(lines, fname=None):
     """write lines to file
 
@@ -245,6 +474,52 @@ def prob_to_bpp(prob_file):
     return np.loadtxt(prob_file)
 
 
+def bpp_matrix_from_pairs(i, j, p, N, sparse=False, cutoff=None):
+    '''Build a symmetric NxN base pair probability matrix from lists of pairs.
+
+    Args:
+        i, j (array-like): 0-indexed positions of each pair (either order)
+        p (array-like): probability of each pair
+        N (int): sequence length
+        sparse (bool): return a scipy.sparse CSR matrix instead of a dense array,
+            without ever allocating the dense NxN matrix
+        cutoff (float): drop pairs with probability below this
+
+    Returns:
+        NxN array or scipy.sparse.csr_matrix
+    '''
+    i = np.asarray(i, dtype=np.int64).ravel()
+    j = np.asarray(j, dtype=np.int64).ravel()
+    p = np.asarray(p, dtype=np.float64).ravel()
+
+    lo, hi = np.minimum(i, j), np.maximum(i, j)
+
+    # a pair listed twice keeps its last value, as when filling the matrix entry by entry
+    # (package output is usually already sorted and duplicate-free, which is cheap to check)
+    pair_id = lo*N + hi
+    if np.any(pair_id[1:] <= pair_id[:-1]):
+        _, last = np.unique(pair_id[::-1], return_index=True)
+        keep = len(pair_id) - 1 - last
+        lo, hi, p = lo[keep], hi[keep], p[keep]
+
+    if cutoff is not None:
+        above = p >= cutoff
+        lo, hi, p = lo[above], hi[above], p[above]
+
+    if sparse:
+        nonzero = p != 0
+        lo, hi, p = lo[nonzero], hi[nonzero], p[nonzero]
+        off_diag = lo != hi
+        rows = np.concatenate([lo, hi[off_diag]])
+        cols = np.concatenate([hi, lo[off_diag]])
+        return scipy.sparse.csr_matrix((np.concatenate([p, p[off_diag]]), (rows, cols)), shape=(N, N))
+
+    probs = np.zeros([N, N])
+    probs[lo, hi] = p
+    probs[hi, lo] = p
+    return probs
+
+
 ###############################################################################
 # Package handling
 ###############################################################################
@@ -268,14 +543,14 @@ supported_packages = [
 ]
 
 def print_path_files():
-    package_dct = load_package_locations()
+    package_dct = package_locs
     for key, v in package_dct.items():
         print(key, v)
 
 
 def package_list():
     pkg_list = []
-    package_dct = load_package_locations()
+    package_dct = package_locs
     for key, v in package_dct.items():
         if key != "TMP" and key.lower() != 'bprna':
             if not key.startswith('linear'):
@@ -338,6 +613,103 @@ def load_package_locations(DEBUG=False):
     return return_dct
 
 
+class PackageLocations(Mapping):
+    '''Process-wide registry of package locations, shared by all arnie modules as `package_locs`.
+
+    Locations are read with `load_package_locations()` the first time one is needed and
+    then cached, so importing arnie doesn't touch the environment or the filesystem.
+    Call `reload()` after changing environment variables or ARNIEFILE.
+
+    Locations can be overridden for the calling thread, e.g.
+
+        with package_locs.override(vienna_2='/opt/vienna/bin'):
+            bpps(seq, package='vienna_2')
+    '''
+    def __init__(self):
+        self._locs = None
+        self._fingerprint = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _base(self):
+        if self._locs is None:
+            with self._lock:
+                if self._locs is None:
+                    locs = load_package_locations()
+                    self._fingerprint = _fingerprint(locs)
+                    self._locs = locs
+        return self._locs
+
+    def _overrides(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _resolved(self):
+        locs = self._base()
+        stack = self._overrides()
+        if stack:
+            locs = dict(locs)
+            for overrides in stack:
+                locs.update(overrides)
+        return locs
+
+    def __getitem__(self, key):
+        for overrides in reversed(self._overrides()):
+            if key in overrides:
+                return overrides[key]
+        return self._base()[key]
+
+    def __iter__(self):
+        return iter(self._resolved())
+
+    def __len__(self):
+        return len(self._resolved())
+
+    def __repr__(self):
+        return 'PackageLocations(%r)' % self._resolved()
+
+    def reload(self):
+        '''Forget the cached locations, they are read again on next use.'''
+        with self._lock:
+            self._locs = None
+            self._fingerprint = None
+
+    @contextmanager
+    def override(self, **locs):
+        '''Use the given package locations in the calling thread for the duration of the block.'''
+        stack = self._overrides()
+        stack.append(locs)
+        try:
+            yield self
+        finally:
+            stack.pop()
+
+    def fingerprint(self):
+        '''Short hash of the locations in effect, for use in cache keys.
+
+        Works without any packages configured, as the hash of the overrides alone (if any).
+        '''
+        try:
+            self._base()
+        except EnvironmentError:
+            locs = {}
+            for overrides in self._overrides():
+                locs.update(overrides)
+            return _fingerprint(locs)
+        if not self._overrides():
+            return self._fingerprint
+        return _fingerprint(self._resolved())
+
+
+def _fingerprint(locs):
+    return hashlib.sha1(repr(sorted(locs.items())).encode()).hexdigest()[:16]
+
+
+# load package locations from the environment or ARNIEFILE on first use, watch! global dict
+package_locs = PackageLocations()
+
+
 ###############################################################################
 # Structure representation conversion
 ###############################################################################
@@ -598,7 +970,7 @@ def get_expected_accuracy(dbn_string, bp_matrix, mode='mcc'):
 
     Inputs:
     dbn_string (str): Secondary structure string in dot-parens notation.
-    bp_matrix (NxN array):  symmetric matrix of base pairing probabilities.
+    bp_matrix (NxN array):  symmetric matrix of base pairing probabilities (dense or scipy.sparse).
     mode: ['mcc','fscore','sen','ppv']: accuracy metric for which to compute expected value.
 
     Returns: expected accuracy value.
@@ -607,18 +979,28 @@ def get_expected_accuracy(dbn_string, bp_matrix, mode='mcc'):
     assert bp_matrix.shape[0] == bp_matrix.shape[1]
     assert bp_matrix.shape[0] == len(dbn_string)
 
-    struct_matrix = convert_dotbracket_to_matrix(dbn_string, allow_pseudoknots=True)
     N = len(dbn_string)
 
-    pred_m = struct_matrix[np.triu_indices(N)]
-    probs = bp_matrix[np.triu_indices(N)]
+    if scipy.sparse.issparse(bp_matrix):
+        # same sums as below, over the predicted pairs and the stored probabilities only
+        bp_list = np.array(convert_dotbracket_to_bp_list(dbn_string, allow_pseudoknots=True), dtype=np.int64).reshape(-1, 2)
+        pair_probs, sum_probs = pair_probs_(bp_matrix, bp_list[:, 0], bp_list[:, 1])
+
+        TP = np.sum(pair_probs) + 1e-6
+        TN = 0.5*N*N-1 - len(bp_list) - sum_probs + TP + 1e-6
+        FP = np.sum(1-pair_probs) + 1e-6
+        FN = sum_probs - np.sum(pair_probs) + 1e-6
+    else:
+        struct_matrix = convert_dotbracket_to_matrix(dbn_string, allow_pseudoknots=True)
+
+        pred_m = struct_matrix[np.triu_indices(N)]
+        probs = bp_matrix[np.triu_indices(N)]
 
-    TP = np.sum(np.multiply(pred_m, probs)) + 1e-6
-    TN = 0.5*N*N-1 - np.sum(pred_m) - np.sum(probs) + TP + 1e-6
-    FP = np.sum(np.multiply(pred_m, 1-probs)) + 1e-6
-    FN = np.sum(np.multiply(1-pred_m, probs)) + 1e-6
+        TP = np.sum(np.multiply(pred_m, probs)) + 1e-6
+        TN = 0.5*N*N-1 - np.sum(pred_m) - np.sum(probs) + TP + 1e-6
+        FP = np.sum(np.multiply(pred_m, 1-probs)) + 1e-6
+        FN = np.sum(np.multiply(1-pred_m, probs)) + 1e-6
 
-    a, b = np.triu_indices(N)
     cFP = 1e-6  # compatible false positives
     # for i in range(len(pred_m)):
     #     if np.sum(struct_matrix,axis=0)[a[i]] + np.sum(struct_matrix,axis=0)[b[i]]==0:
@@ -636,6 +1018,104 @@ def get_expected_accuracy(dbn_string, bp_matrix, mode='mcc'):
         print('Error: mode not understood.')
 
 
+def rank_by_expected_accuracy(structures, bp_matrix, metric='mcc'):
+    '''Rank many candidate structures by their expected accuracy against one base pair matrix.
+
+    Expected accuracies are as in `get_expected_accuracy`. The total pairing probability is summed
+    once, and each structure is scored from its pair list, so a candidate costs O(#pairs) instead of
+    O(N^2). Repeated structures, e.g. from `sample_structures`, are scored once.
+
+    Inputs:
+    structures (list): candidate structures, as dbn strings (pseudoknots allowed) or base pair lists.
+    bp_matrix (NxN array): symmetric matrix of base pairing probabilities (dense or scipy.sparse).
+    metric: ['mcc','fscore','sen','ppv']: expected accuracy to rank by.
+
+    Returns: indices of the structures from best to worst, and a dict with the expected
+    'sen', 'ppv', 'mcc' and 'fscore' of every structure, as arrays in input order.
+    '''
+    if metric not in ['mcc', 'fscore', 'sen', 'ppv']:
+        raise ValueError('metric %s not understood, choose from mcc, fscore, sen, ppv' % metric)
+    assert bp_matrix.shape[0] == bp_matrix.shape[1]
+    N = bp_matrix.shape[0]
+
+    unique, index = [], {}
+    which = np.zeros(len(structures), dtype=np.int64)
+    for k, struct in enumerate(structures):
+        key = struct if isinstance(struct, str) else tuple(tuple(sorted(bp)) for bp in struct)
+        if key not in index:
+            index[key] = len(unique)
+            unique.append(key)
+        which[k] = index[key]
+
+    # pairs of all unique structures, and the structure each belongs to
+    if all(isinstance(struct, str) for struct in unique) and set(''.join(unique)) <= set('().'):
+        owner, rows, cols = nested_pairs_(unique, N)
+    else:
+        bp_lists = [convert_dotbracket_to_bp_list(struct, allow_pseudoknots=True) if isinstance(struct, str)
+            else struct for struct in unique]
+        pairs = np.array([bp for bp_list in bp_lists for bp in bp_list], dtype=np.int64).reshape(-1, 2)
+        owner = np.repeat(np.arange(len(unique)), [len(bp_list) for bp_list in bp_lists])
+        rows, cols = pairs.min(axis=1), pairs.max(axis=1)
+
+    pair_probs, sum_probs = pair_probs_(bp_matrix, rows, cols)
+    n_pairs = np.bincount(owner, minlength=len(unique))
+    probs = np.bincount(owner, weights=pair_probs, minlength=len(unique))
+
+    TP = probs + 1e-6
+    TN = 0.5*N*N-1 - n_pairs - sum_probs + TP + 1e-6
+    FP = n_pairs - probs + 1e-6
+    FN = sum_probs - probs + 1e-6
+    cFP = 1e-6  # compatible false positives, as in get_expected_accuracy
+
+    expected = {'sen': TP/(TP + FN),
+        'ppv': TP/(TP + FP - cFP),
+        'mcc': (TP*TN - (FP - cFP)*FN)/np.sqrt((TP + FP - cFP)*(TP + FN)*(TN + FP - cFP)*(TN + FN)),
+        'fscore': 2*TP/(2*TP + FP - cFP + FN)}
+    expected = {mode: values[which] for mode, values in expected.items()}
+    return np.argsort(-expected[metric], kind='stable'), expected
+
+
+def nested_pairs_(structures, N):
+    '''base pairs of dbn strings of length N made of '(', ')' and '.', parsed all at once.
+
+    Returns: structure index, 5' and 3' position of every pair.
+    '''
+    assert all(len(struct) == N for struct in structures)
+    chars = np.frombuffer(''.join(structures).encode(), dtype=np.uint8)
+    opening, closing = chars == ord('('), chars == ord(')')
+    depth = np.cumsum(opening.astype(np.int64) - closing)
+    if len(depth) and (depth.min() < 0 or np.any(depth[N-1::N] != 0)):
+        raise Exception('Unbalanced parenthesis notation')
+
+    # at each nesting level, opening and closing brackets alternate in order, so sorting
+    # the brackets by level and position puts every pair next to each other
+    positions = np.flatnonzero(opening | closing)
+    level = depth[positions] + closing[positions]
+    pairs = positions[np.lexsort((positions, level))].reshape(-1, 2)
+    return pairs[:, 0]//N, pairs[:, 0] % N, pairs[:, 1] % N
+
+
+def pair_probs_(bp_matrix, rows, cols):
+    '''probabilities of pairs (rows[k], cols[k]) with rows < cols, and the sum over the upper triangle'''
+    if not scipy.sparse.issparse(bp_matrix):
+        return bp_matrix[rows, cols], np.sum(np.triu(bp_matrix))
+
+    N = bp_matrix.shape[0]
+    upper = scipy.sparse.triu(bp_matrix).tocoo()
+    upper.sum_duplicates()
+    # sum_duplicates doesn't sort the entries on every scipy version, so sort them for searchsorted
+    upper_ids = upper.row.astype(np.int64)*N + upper.col
+    order = np.argsort(upper_ids, kind='stable')
+    upper_ids, upper_data = upper_ids[order], upper.data[order]
+    pair_ids = rows*N + cols
+    pos = np.searchsorted(upper_ids, pair_ids)
+    found = pos < len(upper_ids)
+    found[found] = upper_ids[pos[found]] == pair_ids[found]
+    pair_probs = np.zeros(len(pair_ids))
+    pair_probs[found] = upper_data[pos[found]]
+    return pair_probs, upper_data.sum()
+
+
 def get_mean_base_pair_propensity(dbn_string):
     '''Measure of base pair locality.'''
     mat = convert_dotbracket_to_matrix(dbn_string)
@@ -0,0 +1,143 @@
+import os
+import tempfile
+import numpy as np
+from arnie.cache import DiskCache, MemoCache, encode_value, decode_value, cached, cached_batch, disk_cache, memo, get_memo
+from arnie.utils import package_locs
+
+bpp = np.zeros((12, 12))
+bpp[0, 11] = bpp[11, 0] = 0.9
+bpp[1, 10] = bpp[10, 1] = 0.45
+
+
+def test_encode_value():
+    for value in [bpp, np.float64(1.5e10), -8.94, '((((....))))', ('((((....))))', -3.2), None]:
+        decoded = decode_value(encode_value(value))
+        if isinstance(value, np.ndarray):
+            assert(np.array_equal(decoded, value))
+        else:
+            assert(decoded == value)
+            assert(type(decoded) == type(value))
+
+
+def test_disk_cache():
+    with tempfile.TemporaryDirectory() as path:
+        cache = DiskCache(path)
+        assert(cache.get('abcd') == (False, None))
+        cache.put('abcd', bpp)
+        hit, value = cache.get('abcd')
+        assert(hit and np.array_equal(value, bpp))
+
+        stats = cache.stats()
+        assert(stats['hits'] == 1 and stats['misses'] == 1 and stats['writes'] == 1)
+
+        # least recently used entries go first
+        cache.max_bytes = 2.5*cache.size()
+        os.utime(cache._fname('abcd'), (0, 0))
+        cache.put('efgh', bpp)
+        cache.put('ijkl', bpp)
+        assert(not cache.get('abcd')[0])
+        assert(cache.get('ijkl')[0])
+        assert(cache.stats()['evictions'] == 1)
+
+
+def test_cached():
+    calls = []
+
+    @cached('fold')
+    def fold(seq, T=37, DEBUG=False):
+        calls.append(seq)
+        return '.'*len(seq)
+
+    # keys don't depend on which packages are configured in the environment
+    with memo(False), package_locs.override(vienna_2='/opt/vienna/bin'):
+        with tempfile.TemporaryDirectory() as path:
+            with disk_cache(path) as cache:
+                fold('GGGGAAAACCCC')
+                fold('GGGGAAAA CCCC\n')
+                fold('GGGGAAAACCCC', DEBUG=True)
+                fold('GGGGAAAACCCC', T=24)
+                assert(len(calls) == 3)
+                assert(cache.stats()['hits'] == 1)
+        fold('GGGGAAAACCCC')
+        assert(len(calls) == 4)
+
+    with memo() as m, package_locs.override(vienna_2='/opt/vienna/bin'):
+        fold('GGGGAAAACCCC')
+        fold('GGGGAAAACCCC')
+        assert(len(calls) == 5)
+        assert(m.stats()['hits'] == 1)
+
+
+def test_cached_batch():
+    calls = []
+
+    @cached('fold')
+    def fold(seq, T=37, constraint=None, DEBUG=False):
+        calls.append(seq)
+        return '.'*len(seq)
+
+    @cached_batch('fold', fold)
+    def fold_batch(seqs, T=37, constraint=None, jobs=None, DEBUG=False):
+        calls.extend(seqs)
+        return ['.'*len(seq) for seq in seqs]
+
+    with memo() as m, package_locs.override(vienna_2='/opt/vienna/bin'):
+        fold('GGGGAAAACCCC')
+        # batch entries are shared with the single function, only misses are folded
+        assert(fold_batch(['GGGGAAAACCCC', 'GGAAACC'], jobs=4) == ['.'*12, '.'*7])
+        assert(calls == ['GGGGAAAACCCC', 'GGAAACC'])
+        fold('GGAAACC')
+        assert(len(calls) == 2)
+
+        fold_batch(['GGAAACC', 'GGAAACC'], constraint=['((...))', None])
+        assert(calls[2:] == ['GGAAACC'])
+        assert(fold('GGAAACC', constraint='((...))') == '.'*7)
+        assert(len(calls) == 3)
+
+
+def test_fingerprint_without_packages():
+    package_locs.reload()
+    arniefile = os.environ.pop('ARNIEFILE', None)
+    try:
+        with package_locs.override(vienna_2='/opt/vienna/bin'):
+            assert(len(package_locs.fingerprint()) == 16)
+    finally:
+        if arniefile is not None:
+            os.environ['ARNIEFILE'] = arniefile
+        package_locs.reload()
+
+
+def test_memo_cache():
+    # off unless asked for, so results are never shared between calls by default
+    if not os.environ.get('ARNIE_MEMO'):
+        assert(get_memo() is None)
+
+    m = MemoCache(max_entries=2)
+    m.put('a', bpp)
+    hit, value = m.get('a')
+    assert(hit and np.array_equal(value, bpp))
+
+    # every hit is a writable copy, changing it doesn't change the memo
+    value[0, 0] = 1
+    assert(m.get('a')[1][0, 0] == 0)
+
+    m.put('b', 'x')
+    m.get('a')
+    m.put('c', 'y')
+    assert(not m.get('b')[0])
+    assert(m.get('a')[0] and m.get('c')[0])
+
+    m = MemoCache(max_bytes=1.5*bpp.nbytes)
+    m.put('a', bpp)
+    m.put('b', bpp)
+    assert(len(m) == 1)
+    assert(m.stats()['evictions'] == 1)
+
+
+if __name__ == '__main__':
+    test_encode_value()
+    test_disk_cache()
+    test_cached()
+    test_cached_batch()
+    test_fingerprint_without_packages()
+    test_memo_cache()
@@ -0,0 +1,54 @@
+import numpy as np
+from arnie.ensemble import EnsembleResult, add_vienna_output_
+from arnie.pfunc import log_Z_
+
+seq = 'GGGGAAAACCCC'
+
+rnafold_stdout = '''GGGGAAAACCCC
+((((....)))) ( -5.40)
+((((....)))) [ -5.51]
+((((....)))) { -5.40 d=1.62}
+((((....)))) { -5.40 MEA=10.91}
+ frequency of mfe structure in ensemble 0.840049; ensemble diversity 1.62
+'''
+
+# written by RNAfold -p for seq
+with open('test_files/GGGGAAAACCCC_dp.ps') as f:
+    dot_plot = f.read()
+
+
+def test_vienna_output():
+    res = EnsembleResult(seq)
+    add_vienna_output_(res, rnafold_stdout, dot_plot, T=37)
+
+    assert(res.mfe == res.mea == res.centroid == '((((....))))')
+    assert(res.dG_MFE == -5.40 and res.free_energy == -5.51)
+    assert(np.isclose(res.Z, np.exp(5.51/(.0019899*310))))
+    # log Z uses ViennaRNA's own kT, Z keeps arnie's older constant
+    assert(np.isclose(res.log_Z, 5.51/(.0019872*310.15)))
+    assert(np.isclose(res.bpps[0, 11], 0.8508, atol=1e-4) and res.bpps[11, 0] == res.bpps[0, 11])
+    assert(np.isclose(res.punp[3], 0.1328, atol=1e-4))
+
+
+def test_derived():
+    # without an MEA line, MEA and centroid come from the bpps
+    res = EnsembleResult(seq)
+    add_vienna_output_(res, '\n'.join(rnafold_stdout.split('\n')[:3]), dot_plot)
+    assert(res.centroid == '((((....))))')
+    assert(res.mea == '((((....))))')
+
+
+def test_log_Z():
+    # contrafold reports -log Z as its free energy
+    assert(log_Z_(-12.5, 'eternafold') == 12.5)
+    assert(np.isclose(log_Z_(-10, 'rnastructure', T=25), 10/(.0019*298)))
+
+    # a few thousand nucleotides: Z overflows, log Z doesn't
+    log_Z = log_Z_(-1500, 'vienna_2')
+    assert(np.isfinite(log_Z) and log_Z > np.log(np.finfo(float).max))
+
+
+if __name__ == '__main__':
+    test_vienna_output()
+    test_derived()
+    test_log_Z()
@@ -1,4 +1,6 @@
+import tempfile
 from arnie.utils import *
+from arnie.rnastructure import ct_to_dotbrackets_
 
 bp_list = [[1, 53], [2, 52], [3, 51], [4, 50]]
 bpseq_file = "test_files/seq.bpseq"
@@ -27,5 +29,17 @@ def test_file_converters():
     assert(bpseq_to_bp_list(bpseq_file, header_length=3) != bp_list)
     assert(ct_to_bp_list(ct_file, header_length=4) != bp_list)
 
+
+def test_multi_structure_ct():
+    struct = convert_bp_list_to_dotbracket(bp_list, 54)
+    assert(ct_to_dotbrackets_(ct_file) == [struct])
+
+    # stochastic and MaxExpect write several structures to one file
+    with tempfile.NamedTemporaryFile('w', suffix='.ct') as f:
+        f.write(open(ct_file).read()*3)
+        f.flush()
+        assert(ct_to_dotbrackets_(f.name) == [struct]*3)
+
 if __name__ == '__main__':
     test_file_converters()
+    test_multi_structure_ct()
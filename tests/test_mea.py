@@ -0,0 +1,110 @@
+import sys
+import numpy as np
+import scipy.sparse
+from arnie.mea.mea import MEA, mea_gamma_sweep
+from arnie.mea.mea_utils import convert_dotbracket_to_matrix, score_ground_truth, score_ground_truth_batch
+
+
+def nested_bpps(N, seed=0):
+    '''bpps of two competing hairpin sets plus low-probability noise'''
+    rng = np.random.default_rng(seed)
+    bpp = np.zeros((N, N))
+    for i in range(N//4 - 2):
+        bpp[i, N//2 - 1 - i] = 0.6
+        bpp[N//2 + i, N - 1 - i] = 0.3
+        bpp[i, N - 1 - i] = 0.35
+    i, j = np.triu_indices(N, k=4)
+    noise = rng.random(len(i)) < 0.05
+    bpp[i[noise], j[noise]] += 0.02*rng.random(noise.sum())
+    return bpp + bpp.T
+
+
+def test_vectorized_mea():
+    for N, gamma in [(24, 1.0), (60, 0.5), (60, 4.0), (81, 2.0)]:
+        bpp = nested_bpps(N, seed=N)
+        legacy = MEA(bpp, gamma=gamma, vectorized=False)
+        mea = MEA(bpp, gamma=gamma)
+        assert(mea.structure == legacy.structure)
+        assert(mea.MEA_bp_list == legacy.MEA_bp_list)
+        assert(np.array_equal(mea.W, legacy.W))
+
+
+def test_mea_gamma_sweep():
+    bpp = nested_bpps(60)
+    gammas = [2.0**g for g in range(-3, 4)]
+    meas, metrics = mea_gamma_sweep(bpp, gammas)
+    assert(metrics.shape == (len(gammas), 4))
+    for gamma, mea, row in zip(gammas, meas, metrics):
+        single = MEA(bpp, gamma=gamma)
+        assert(mea.structure == single.structure)
+        assert(np.allclose(row, single.score_expected()))
+
+
+def test_sparse_mea():
+    for N, gamma in [(60, 0.5), (60, 4.0), (120, 1.0)]:
+        bpp = nested_bpps(N, seed=N)
+        dense = MEA(bpp, gamma=gamma)
+        sparse = MEA(scipy.sparse.csr_matrix(bpp), gamma=gamma, bpp_cutoff=0)
+        assert(sparse.structure == dense.structure)
+        assert(np.isclose(sparse.W[0, N-1], dense.W[0, N-1]))
+        assert(sparse.dp_stats['candidate_pairs'] < sparse.dp_stats['possible_pairs'])
+        assert(0 < sparse.dp_stats['pruned'] < 1)
+
+    # pairs below the cutoff are never used
+    sparse = MEA(nested_bpps(60), gamma=4.0, bpp_cutoff=0.5)
+    assert(len(sparse.MEA_bp_list) == 13)
+
+
+def test_banded_mea():
+    for N, gamma, L in [(60, 1.0, 10), (120, 0.5, 40), (120, 4.0, 200)]:
+        bpp = nested_bpps(N, seed=N)
+        i, j = np.indices(bpp.shape)
+        dense = MEA(np.where(np.abs(i - j) <= L, bpp, 0), gamma=gamma)
+        banded = MEA(scipy.sparse.csr_matrix(bpp), gamma=gamma, max_bp_span=L)
+        assert(banded.W.shape == (N, min(L, N-1) + 1))
+        assert(banded.structure == dense.structure)
+        assert(scipy.sparse.issparse(banded.MEA_bp_matrix))
+        assert(np.allclose(banded.score_expected(), MEA(bpp, gamma=gamma, max_bp_span=L).score_expected()))
+
+        sparse = MEA(scipy.sparse.csr_matrix(bpp), gamma=gamma, max_bp_span=L, bpp_cutoff=0)
+        assert(sparse.structure == dense.structure)
+
+    gammas = [0.5, 2.0, 8.0]
+    meas, _ = mea_gamma_sweep(nested_bpps(80), gammas, max_bp_span=20)
+    for gamma, mea in zip(gammas, meas):
+        assert(mea.structure == MEA(nested_bpps(80), gamma=gamma, max_bp_span=20).structure)
+
+
+def test_score_ground_truth():
+    # the extra pair 7-8 is between nucleotides unpaired in the true structure, a compatible false positive
+    true, pred = convert_dotbracket_to_matrix('((...))..'), convert_dotbracket_to_matrix('((...))()')
+    assert(score_ground_truth(pred, true) == (1.0, 1.0, 1.0, 1.0, 9))
+    assert(score_ground_truth(np.zeros([9, 9]), true) == (0.0, 1, 0, 0.0, 9))
+
+    table, aggregate = score_ground_truth_batch(['((...))()', '.....'], ['((...))..', '(...)'],
+        names=['a', 'b'], weight_by_n_bps=True, workers=1)
+    assert(list(table['name']) == ['a', 'b'])
+    assert(list(table['sen']) == [1, 0] and list(table['ppv']) == [1, 1] and list(table['N']) == [9, 5])
+    assert(np.isclose(aggregate['sen'], 9/14))
+    _, aggregate = score_ground_truth_batch(['((...))()', '.....'], ['((...))..', '(...)'], workers=2)
+    assert(np.isclose(aggregate['fscore'], 0.5))
+
+
+def test_mea_traceback_depth():
+    # the traceback walks every unpaired position, which used to recurse once per nucleotide
+    limit = sys.getrecursionlimit()
+    try:
+        sys.setrecursionlimit(150)
+        mea = MEA(nested_bpps(300), gamma=1.0)
+    finally:
+        sys.setrecursionlimit(limit)
+    assert(len(mea.MEA_bp_list) == 73)
+
+
+if __name__ == '__main__':
+    test_vectorized_mea()
+    test_mea_gamma_sweep()
+    test_sparse_mea()
+    test_banded_mea()
+    test_score_ground_truth()
+    test_mea_traceback_depth()
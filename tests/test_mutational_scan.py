@@ -0,0 +1,38 @@
+import numpy as np
+from arnie.mutational_scan import MutationalScan, scan_variants_
+
+
+def test_scan_variants():
+    seq = 'GGAAACC'
+    unique, jobs = scan_variants_(seq, [0, 2], 'ACGU')
+    # 3 substitutions per position, plus the wild type folded once
+    assert(len(unique) == 7)
+    assert(len(jobs) == 6)
+    mutant, wild_type, lo = jobs[(2, 1)]
+    assert(unique[mutant] == 'GGCAACC')
+    assert(unique[wild_type] == seq)
+    assert(lo == 0)
+
+    # windows near the ends are clipped, identical windows are folded once
+    unique, jobs = scan_variants_('AAAAAAAA', [0, 3, 4], 'ACGU', window=1)
+    mutant, wild_type, lo = jobs[(0, 1)]
+    assert(unique[mutant] == 'CA')
+    assert(unique[wild_type] == 'AA')
+    assert(lo == 0)
+    assert(jobs[(3, 2)][:2] == jobs[(4, 2)][:2])
+    assert(jobs[(4, 2)][2] == 3)
+
+
+def test_dpunp_site():
+    dpunp = np.zeros((3, 4, 3))
+    dpunp[1, 2, 1] = 0.5
+    dpunp[1, 2, 0] = -0.2
+    scan = MutationalScan('GAC', 'vienna_2', [0, 1, 2], 'ACGU', dpunp=dpunp)
+    assert(scan.dpunp_site.shape == (3, 4))
+    assert(scan.dpunp_site[1, 2] == 0.5)
+    assert(scan.dpunp_site.sum() == 0.5)
+
+
+if __name__ == '__main__':
+    test_scan_variants()
+    test_dpunp_site()
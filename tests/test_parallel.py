@@ -0,0 +1,42 @@
+import os
+from arnie import parallel
+from arnie.utils import convert_dotbracket_to_bp_list, thread_budget
+
+structs = ['((((....))))', '((..))', '(((...)))).', '.(((....))).']
+
+
+def test_map():
+    results = parallel.map(convert_dotbracket_to_bp_list, structs, workers=2)
+    assert(results[0] == convert_dotbracket_to_bp_list(structs[0]))
+    assert(results[1] == [[0, 5], [1, 4]])
+    assert(results[3] == convert_dotbracket_to_bp_list(structs[3]))
+
+    # unbalanced structure fails without losing the rest of the batch
+    assert(isinstance(results[2], parallel.ItemFailure))
+    assert(results[2].index == 2)
+    assert('Unbalanced' in results[2].error)
+
+
+def test_map_serial_matches_pool():
+    progress = []
+    serial = parallel.map(convert_dotbracket_to_bp_list, structs[:2], workers=1,
+                          progress=lambda n_done, n_total: progress.append(n_done))
+    pooled = parallel.map(convert_dotbracket_to_bp_list, structs[:2], workers=2, chunksize=2)
+    assert(serial == pooled)
+    assert(progress == [1, 2])
+
+
+def _budget(_):
+    return thread_budget()
+
+
+def test_thread_budget():
+    # workers split the cores between them
+    cores = os.cpu_count() or 1
+    assert(parallel.map(_budget, range(4), workers=2) == [max(cores // 2, 1)]*4)
+
+
+if __name__ == '__main__':
+    test_map()
+    test_map_serial_matches_pool()
+    test_thread_budget()
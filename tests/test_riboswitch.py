@@ -0,0 +1,61 @@
+import warnings
+import numpy as np
+from arnie.riboswitch import switch_constraints_, activation_ratio_batch, LIGAND_APTAMERS
+from arnie.pfunc import pfunc
+
+# FMN - ON design from examples/data_for_examples/ribologic_SI.txt
+seq = 'ACUAAACAUGAGGAUCACCCAUGUAAUUGAAGCUAAGGAUAUCAGAAGAAUGGUGAUUCAUGAGAAGGAAGCGAUU'
+
+
+def test_switch_constraints():
+    constraints = switch_constraints_(seq, ligand=LIGAND_APTAMERS['FMN'])
+    assert(constraints['free'] is None)
+    assert(constraints['ms2'] == '.....(((((x((xxxx)))))))' + '.'*52)
+    assert(constraints['ligand'].count('(') == 2 and constraints['ligand'].count(')') == 2)
+    # both aptamers together
+    assert(constraints['ms2_ligand'].replace('.', '') == (constraints['ms2'] + constraints['ligand']).replace('.', ''))
+
+    constraints = switch_constraints_(seq, ligand=None, ms2=True)
+    assert(sorted(constraints) == ['free', 'ms2'])
+
+    try:
+        switch_constraints_('GGGGAAAACCCC', ligand=LIGAND_APTAMERS['FMN'])
+        assert(False)
+    except RuntimeError:
+        pass
+
+
+def test_activation_ratio():
+    # the same design read as an ON and as an OFF switch
+    table = activation_ratio_batch([seq, seq], ligand='FMN', switch=['ON', 'OFF'], ligand_conc=200., Kd_ligand=2., Kd_MS2=0.5, workers=1)
+
+    constraints = switch_constraints_(seq, ligand=LIGAND_APTAMERS['FMN'])
+    log_Z = {state: pfunc(seq, constraint=constraint, return_log_Z=True) for state, constraint in constraints.items()}
+    for state, column in [('free', 'log_Z'), ('ligand', 'log_Z_ligand'), ('ms2', 'log_Z_ms2'), ('ms2_ligand', 'log_Z_ms2_ligand')]:
+        assert(np.allclose(table[column], log_Z[state]))
+
+    # Kd(no ligand) = Kd_MS2 * Z / Z_ms2, Kd(ligand) = Kd_MS2 * (Z + Z_ligand*c/Kd_ligand) / (Z_ms2 + Z_ms2_ligand*c/Kd_ligand)
+    Z = {state: np.exp(value) for state, value in log_Z.items()}
+    Kd_free = 0.5*Z['free']/Z['ms2']
+    Kd_ligand = 0.5*(Z['free'] + Z['ligand']*100)/(Z['ms2'] + Z['ms2_ligand']*100)
+
+    assert(np.allclose(table['Kd_ON'], [Kd_ligand, Kd_free]))
+    assert(np.allclose(table['Kd_OFF'], [Kd_free, Kd_ligand]))
+    assert(np.allclose(table['log_Kd_ON'], np.log(table['Kd_ON'])) and np.allclose(table['log_Kd_OFF'], np.log(table['Kd_OFF'])))
+    assert(np.allclose(table['AR'], [Kd_free/Kd_ligand, Kd_ligand/Kd_free]))
+    assert(np.allclose(table['log_AR'], np.log(table['AR'])))
+
+
+def test_missing_aptamer():
+    # a design without the aptamers stays nan, without numpy warnings on top of the printed one
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        table = activation_ratio_batch([seq, 'GGGGAAAACCCC'], ligand='FMN', workers=1)
+    for column in ['log_Z', 'log_Kd_ON', 'log_Kd_OFF', 'AR']:
+        assert(np.isfinite(table[column][0]) and np.isnan(table[column][1]))
+
+
+if __name__ == '__main__':
+    test_switch_constraints()
+    test_activation_ratio()
+    test_missing_aptamer()
@@ -0,0 +1,69 @@
+from arnie import rnalib
+from arnie.rnalib import set_vienna_engine, vienna_engine, use_rnalib_
+from arnie.mfe import mfe
+from arnie.pfunc import pfunc
+import numpy as np
+
+
+def test_vienna_engine():
+    try:
+        set_vienna_engine('subprocess')
+        assert(vienna_engine() == 'subprocess')
+        assert(not use_rnalib_())
+
+        set_vienna_engine('auto')
+        assert(vienna_engine() == ('subprocess' if rnalib.RNA is None else 'rnalib'))
+
+        if rnalib.RNA is not None:
+            set_vienna_engine('rnalib')
+            assert(use_rnalib_(version='2'))
+            # options the bindings path doesn't cover stay on RNAfold
+            assert(not use_rnalib_(version='1'))
+            assert(not use_rnalib_(motif='GAAA'))
+            assert(not use_rnalib_(param_file='rna_andronescu2007.par'))
+            assert(not use_rnalib_(probing_signal=[0.1, 0.5], shapeMethod='D'))
+
+        try:
+            set_vienna_engine('RNAfold')
+            assert(False)
+        except ValueError:
+            pass
+    finally:
+        set_vienna_engine(None)
+
+
+def test_mfe_return_dG_MFE():
+    if rnalib.RNA is None:
+        return
+    try:
+        set_vienna_engine('rnalib')
+        struct, dG_MFE = mfe('GGGGAAAACCCC', return_dG_MFE=True)
+        assert(struct == '((((....))))')
+        assert(abs(dG_MFE - -5.4) < 1e-6)
+        assert(mfe('GGGGAAAACCCC') == struct)
+    finally:
+        set_vienna_engine(None)
+
+
+def test_log_Z_kT():
+    if rnalib.RNA is None:
+        return
+    seq = 'ACUAAACAUGAGGAUCACCCAUGUAAUUGAAGCUAAGGAUAUCAGAAGAAUGGUGAUUCAUGAGAAGGAAGCGAUU'
+    try:
+        set_vienna_engine('rnalib')
+        for T in [25, 37]:
+            fc = rnalib.fold_compound_(seq, T=T)
+            _, dG_MFE = fc.mfe()
+            fc.exp_params_rescale(dG_MFE)
+            _, free_energy = fc.pf()
+            # log Z with ViennaRNA's own kT, Z with arnie's older constant
+            assert(np.isclose(pfunc(seq, T=T, return_log_Z=True), -1*free_energy/(fc.exp_params.kT/1000), rtol=1e-12))
+            assert(np.isclose(pfunc(seq, T=T), np.exp(-1*free_energy/(.0019899*(273+T)))))
+    finally:
+        set_vienna_engine(None)
+
+
+if __name__ == '__main__':
+    test_vienna_engine()
+    test_mfe_return_dG_MFE()
+    test_log_Z_kT()
@@ -0,0 +1,49 @@
+import os
+from arnie.utils import scratch_dir, current_scratch_dir, filename, write, in_scratch_dir
+
+
+def test_scratch_dir():
+    assert(current_scratch_dir() is None)
+
+    with scratch_dir() as path:
+        assert(os.path.isdir(path))
+        fname = write(['GGGGAAAACCCC'])
+        assert(os.path.dirname(fname) == path)
+
+        # nested calls share the outer directory
+        with scratch_dir() as inner:
+            assert(inner == path)
+            assert(os.path.dirname(filename()) == path)
+
+    assert(current_scratch_dir() is None)
+    assert(not os.path.exists(path))
+
+
+def test_scratch_dir_cleanup_on_error():
+    try:
+        with scratch_dir() as path:
+            write(['GGGGAAAACCCC'])
+            raise ValueError
+    except ValueError:
+        pass
+    assert(not os.path.exists(path))
+
+
+def test_in_scratch_dir_user_files():
+    @in_scratch_dir
+    def wrapped(seq, package='vienna', param_file=None, **kwargs):
+        return param_file, kwargs.get('reweight'), current_scratch_dir()
+
+    # relative user files are resolved against the caller's cwd however they are passed
+    param_file = os.path.relpath(__file__)
+    for args, kwargs in [(('A', 'vienna', param_file), {}), (('A',), {'param_file': param_file, 'reweight': param_file})]:
+        resolved, reweight, path = wrapped(*args, **kwargs)
+        assert(resolved == os.path.abspath(param_file))
+        assert(reweight in [None, os.path.abspath(param_file)])
+        assert(path is not None and not os.path.exists(path))
+
+
+if __name__ == '__main__':
+    test_scratch_dir()
+    test_scratch_dir_cleanup_on_error()
+    test_in_scratch_dir_user_files()
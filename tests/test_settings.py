@@ -1,5 +1,5 @@
 import os
-from arnie.utils import load_package_locations
+from arnie.utils import load_package_locations, package_locs
 
 
 def test_settings():
@@ -10,5 +10,18 @@ def test_settings():
     return
 
 
+def test_package_locs_override():
+    fingerprint = package_locs.fingerprint()
+    with package_locs.override(TMP='/some/other/tmp'):
+        assert(package_locs['TMP'] == '/some/other/tmp')
+        assert(package_locs.fingerprint() != fingerprint)
+    assert(package_locs['TMP'] != '/some/other/tmp')
+
+    package_locs.reload()
+    assert(package_locs.fingerprint() == fingerprint)
+    assert(dict(package_locs) == load_package_locations())
+
+
 if __name__ == '__main__':
     test_settings()
+    test_package_locs_override()
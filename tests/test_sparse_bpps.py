@@ -0,0 +1,79 @@
+import numpy as np
+import scipy.sparse
+from arnie.utils import prob_to_bpp, bpp_matrix_from_pairs, get_expected_accuracy, rank_by_expected_accuracy, convert_dotbracket_to_bp_list
+from arnie.pk_predictors import pk_predict_from_bpp
+from arnie.mea.mea import MEA
+from arnie.pfunc import cutoff_arg_
+
+bpp_file = "test_files/samiv_eternafold.prob"
+bpp = prob_to_bpp(bpp_file)
+sparse_bpp = scipy.sparse.csr_matrix(bpp)
+
+
+def test_bpp_matrix_from_pairs():
+    # pairs in either order, the last value of a repeated pair wins
+    i, j, p = [0, 5, 1, 0], [5, 2, 4, 5], [0.5, 0.2, 0.7, 0.6]
+    dense = bpp_matrix_from_pairs(i, j, p, 6)
+    assert(dense[0, 5] == dense[5, 0] == 0.6)
+    assert(dense[2, 5] == dense[5, 2] == 0.2)
+    assert(np.array_equal(dense, dense.T))
+
+    sparse = bpp_matrix_from_pairs(i, j, p, 6, sparse=True)
+    assert(scipy.sparse.issparse(sparse))
+    assert(sparse.nnz == 6)
+    assert(np.array_equal(sparse.toarray(), dense))
+
+    above = bpp_matrix_from_pairs(i, j, p, 6, sparse=True, cutoff=0.5)
+    assert(above.nnz == 4 and above[0, 5] == 0.6 and above[2, 5] == 0)
+
+
+def test_cutoff_arg():
+    assert(cutoff_arg_(None) == '0.0000000001')
+    assert(cutoff_arg_(None, default='0.000001') == '0.000001')
+    assert(cutoff_arg_(1e-4) == '0.0001')
+
+
+def test_sparse_consumers():
+    for theta, max_iter in [(0.1, 1), (0.4, 1), (0.1, 5)]:
+        assert(pk_predict_from_bpp(bpp, heuristic="threshknot", theta=theta, max_iter=max_iter) ==
+               pk_predict_from_bpp(sparse_bpp, heuristic="threshknot", theta=theta, max_iter=max_iter))
+    assert(pk_predict_from_bpp(bpp, heuristic="hungarian", theta=0.3) ==
+           pk_predict_from_bpp(sparse_bpp, heuristic="hungarian", theta=0.3))
+
+    structure = MEA(bpp).structure
+    assert(MEA(sparse_bpp).structure == structure)
+    for mode in ['mcc', 'fscore', 'sen', 'ppv']:
+        assert(np.isclose(get_expected_accuracy(structure, bpp, mode=mode),
+                          get_expected_accuracy(structure, sparse_bpp, mode=mode)))
+
+
+def test_rank_by_expected_accuracy():
+    structures = [MEA(bpp, gamma=gamma).structure for gamma in [0.1, 1.0, 10.0]]
+    structures += ['.'*len(structures[0]), structures[1]]
+    pk = pk_predict_from_bpp(bpp, heuristic="threshknot", theta=0.3)
+    structures.append(pk)
+
+    order, expected = rank_by_expected_accuracy(structures, bpp, metric='fscore')
+    for mode in ['mcc', 'fscore', 'sen', 'ppv']:
+        assert(np.allclose(expected[mode], [get_expected_accuracy(s, bpp, mode=mode) for s in structures]))
+    assert(list(order) == list(np.argsort(-expected['fscore'], kind='stable')))
+    assert(order[-1] == 3)
+
+    _, from_sparse = rank_by_expected_accuracy(structures, sparse_bpp)
+    _, from_pairs = rank_by_expected_accuracy([convert_dotbracket_to_bp_list(s, allow_pseudoknots=True) for s in structures], bpp)
+    assert(np.allclose(from_sparse['mcc'], expected['mcc']) and np.allclose(from_pairs['mcc'], expected['mcc']))
+
+    coo = scipy.sparse.coo_matrix(bpp)
+    shuffle = np.random.default_rng(0).permutation(coo.nnz)
+    shuffled = scipy.sparse.coo_matrix((coo.data[shuffle], (coo.row[shuffle], coo.col[shuffle])), shape=coo.shape)
+    _, from_shuffled = rank_by_expected_accuracy(structures, shuffled)
+    assert(np.allclose(from_shuffled['mcc'], expected['mcc']))
+    _, nested = rank_by_expected_accuracy(structures[:5], bpp)
+    assert(np.allclose(nested['mcc'], expected['mcc'][:5]))
+
+
+if __name__ == '__main__':
+    test_bpp_matrix_from_pairs()
+    test_cutoff_arg()
+    test_sparse_consumers()
+    test_rank_by_expected_accuracy()
@@ -0,0 +1,30 @@
+import numpy as np
+from arnie.temperature_sweep import TemperatureSweep
+
+seq = 'GGGGAAAACCCC'
+temps = np.arange(20., 90., 5.)
+
+
+def test_heat_capacity():
+    # G = a + b*T + c*T^2 has C = -T d^2G/dT^2 = -2c*T
+    G = 3.0 - 0.2*temps + 0.001*temps**2
+    sweep = TemperatureSweep(seq, 'vienna_2', temps, log_Z=-G/(.0019872*(273.15+temps)))
+    assert(np.allclose(sweep.free_energy, G))
+    assert(np.allclose(sweep.heat_capacity(), -0.002*(273.15+temps)))
+
+
+def test_fraction_unfolded():
+    punp = np.vstack([np.full(len(seq), x) for x in np.linspace(0.3, 0.9, len(temps))])
+    sweep = TemperatureSweep(seq, 'vienna_2', temps, punp=punp)
+    assert(np.allclose(sweep.fraction_unfolded(), np.linspace(0.3, 0.9, len(temps))))
+
+    try:
+        sweep.heat_capacity()
+        assert(False)
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+    test_heat_capacity()
+    test_fraction_unfolded()